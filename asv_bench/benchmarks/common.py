@@ -0,0 +1,101 @@
+"""
+Synthetic CPS-like data for the benchmarks, made by ``pycps.synthetic``.
+"""
+import os
+import json
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import pycps
+import pycps.parsers as par
+import pycps.synthetic as s
+from pycps import merge as m
+
+HERE = Path(pycps.__file__).parent
+
+# 2.5 people per household, less the 10% of households not responding
+PEOPLE_PER_HOUSEHOLD = 2.25
+
+# id, width. Just what merging needs.
+PANEL_FIELDS = [('HRHHID', 15), ('HRHHID2', 5), ('PULINENO', 2),
+                ('HRMIS', 2), ('HRYEAR4', 4), ('HRMONTH', 2), ('PRTAGE', 2),
+                ('PESEX', 2), ('PTDTRACE', 2)]
+# before 2004-05: HRHHID2 is made from HRSAMPLE, HRSERSUF and HUHHNUM,
+# and the year has two digits
+OLD_FIELDS = [('HRHHID', 15), ('HRSAMPLE', 4), ('HRSERSUF', 2),
+              ('HUHHNUM', 1), ('PULINENO', 2), ('HRMIS', 2), ('HRYEAR4', 2)]
+
+
+def make_dd(fields):
+    """
+    A data dictionary laying out ``fields`` side by side.
+    """
+    widths = np.array([w for _, w in fields])
+    ends = np.cumsum(widths)
+    return pd.DataFrame({'id': [x for x, _ in fields], 'length': widths,
+                         'start': ends - widths + 1, 'end': ends},
+                        columns=['id', 'length', 'start', 'end'])
+
+
+def households(records):
+    """
+    Households to ask for about ``records`` records a month.
+    """
+    return int(records / PEOPLE_PER_HOUSEHOLD)
+
+
+def dd_parser(tmpdir):
+    """
+    A ``DDParser`` for ``cpsm2014-01.ddf``, writing to ``tmpdir``.
+    """
+    settings = par.read_settings(str(HERE / 'settings.json'))
+    settings['dd_path'] = tmpdir
+    settings['dd_store'] = os.path.join(tmpdir, 'dds.hdf')
+    with (HERE / 'info.json').open() as f:
+        info = json.load(f)
+    return par.DDParser(HERE / 'cpsm2014-01.ddf', settings, info)
+
+
+def read_dd():
+    """
+    The data dictionary for January 2014 onwards: 400 odd fields.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        return dd_parser(tmpdir).run()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def write_panel_months(months, per_panel):
+    """
+    Write each of ``months`` with each of ``per_panel`` households in
+    every rotation group, in the current directory.
+
+    Returns
+    -------
+    paths: dict
+        (month, households) -> path, for ``read_panel_month``
+    """
+    dd = make_dd(PANEL_FIELDS)
+    paths = {}
+    for n in per_panel:
+        for month in months:
+            month = pd.Period(month, freq='M')
+            path = os.path.abspath(month.strftime(
+                'panel_{}_%Y-%m.zip'.format(n)))
+            s.write_month(path, dd, month, n * len(m.PANEL_OFFSETS))
+            paths[str(month), n] = path
+    return paths
+
+
+def read_panel_month(path):
+    """
+    A month written by ``write_panel_months``, indexed by person.
+    """
+    df = par.read_monthly(path, make_dd(PANEL_FIELDS))
+    return m.set_person_index(df)
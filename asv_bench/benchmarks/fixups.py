@@ -0,0 +1,65 @@
+import os
+import logging
+
+import pycps.parsers as par
+import pycps.synthetic as s
+import pycps.monthly_data_fixups as mdf
+
+from .common import make_dd, households, OLD_FIELDS
+
+logging.disable(logging.CRITICAL)
+
+PARAMS = [10 ** 4, 10 ** 5, 10 ** 6]
+
+
+def write_old_months():
+    """
+    A January 1998 of each size in ``PARAMS``, with the old ids.
+    """
+    dd = make_dd(OLD_FIELDS)
+    paths = {}
+    for n in PARAMS:
+        paths[n] = os.path.abspath('old_{}.zip'.format(n))
+        s.write_month(paths[n], dd, '1998-01', households(n))
+    return paths
+
+
+def read_old_month(path, columns):
+    return par.read_monthly(path, make_dd(OLD_FIELDS), columns=columns)
+
+
+class ComputeHRHHID2(object):
+
+    params = PARAMS
+    param_names = ['records']
+
+    def setup_cache(self):
+        return write_old_months()
+
+    def setup(self, paths, n):
+        self.df = read_old_month(paths[n],
+                                 ['HRSAMPLE', 'HRSERSUF', 'HUHHNUM'])
+
+    def time_compute_hrhhid2(self, paths, n):
+        mdf.compute_hrhhid2(self.df.copy())
+
+    def peakmem_compute_hrhhid2(self, paths, n):
+        mdf.compute_hrhhid2(self.df.copy())
+
+
+class Year2ToYear4(object):
+
+    params = PARAMS
+    param_names = ['records']
+
+    def setup_cache(self):
+        return write_old_months()
+
+    def setup(self, paths, n):
+        self.df = read_old_month(paths[n], ['HRYEAR4'])
+
+    def time_year2_to_year4(self, paths, n):
+        mdf.year2_to_year4(self.df.copy())
+
+    def peakmem_year2_to_year4(self, paths, n):
+        mdf.year2_to_year4(self.df.copy())
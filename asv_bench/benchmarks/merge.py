@@ -0,0 +1,115 @@
+import os
+import shutil
+import logging
+import tempfile
+
+import pandas as pd
+
+import pycps.parsers as par
+import pycps.synthetic as s
+from pycps import api
+from pycps import merge as m
+from pycps.storage import get_storage
+
+from .common import (read_dd, households, write_panel_months,
+                     read_panel_month)
+
+logging.disable(logging.CRITICAL)
+
+MATCH_FUNCS = [m.match_age, m.match_sex, m.match_race]
+START = pd.Period('2009-01', freq='M')
+
+
+class Match(object):
+    """
+    Matching a panel's first month against its second.
+    """
+    params = [10 ** 3, 10 ** 4, 10 ** 5]
+    param_names = ['households']
+    timeout = 300
+
+    def setup_cache(self):
+        return write_panel_months([START, START + 1], self.params)
+
+    def setup(self, paths, households):
+        left = read_panel_month(paths[str(START), households])
+        right = read_panel_month(paths[str(START + 1), households])
+        self.left = left[left.HRMIS == 1]
+        self.right = right[right.HRMIS == 2]
+
+    def time_match(self, paths, households):
+        m.match(self.left, self.right, MATCH_FUNCS)
+
+    def peakmem_match(self, paths, households):
+        m.match(self.left, self.right, MATCH_FUNCS)
+
+    def time_join_match(self, paths, households):
+        m.join_match(self.left, self.right, m.MATCH_PREDICATES)
+
+    def peakmem_join_match(self, paths, households):
+        m.join_match(self.left, self.right, m.MATCH_PREDICATES)
+
+
+class MergeWave(object):
+    """
+    Stacking a panel's eight months and tagging the wave.
+    """
+    params = [10 ** 3, 10 ** 4, 10 ** 5]
+    param_names = ['households']
+    timeout = 300
+
+    def setup_cache(self):
+        return write_panel_months([START + x for x in m.PANEL_OFFSETS],
+                                  self.params)
+
+    def setup(self, paths, households):
+        self.dfs = []
+        for mis, offset in enumerate(m.PANEL_OFFSETS, 1):
+            df = read_panel_month(paths[str(START + offset), households])
+            self.dfs.append(df[df.HRMIS == mis])
+
+    def time_merge(self, paths, households):
+        m.make_wave_id(m.merge(self.dfs).sort_index())
+
+    def peakmem_merge(self, paths, households):
+        m.make_wave_id(m.merge(self.dfs).sort_index())
+
+
+class APIMerge(object):
+    """
+    ``api.merge`` over 16 synthetic months laid out like January 2014's:
+    every panel starting in the window, the first of them complete.
+    """
+    records = 5 * 10 ** 4
+    timeout = 600
+
+    def setup_cache(self):
+        dd = read_dd()
+        months = pd.period_range(START, periods=16, freq='M')
+        paths = s.write_months('monthly', dd, months,
+                               households(self.records))
+        path = os.path.abspath('monthly.hdf')
+        store = get_storage(path)
+        for f in paths:
+            df = par.read_monthly(str(f), dd,
+                                  columns=api.ID_COLS + api.MERGE_COLS)
+            store.write(df.set_index(api.ID_COLS), f.stem)
+        return path
+
+    def setup(self, path):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = {
+            'monthly_store': path,
+            'merged_store': os.path.join(self.tmpdir, 'merged.hdf'),
+            'date_start': '2009-01',
+            'date_end': '2010-05',
+        }
+
+    def teardown(self, path):
+        shutil.rmtree(self.tmpdir)
+
+    def time_merge(self, path):
+        api.merge(self.settings, overwrite=True)
+
+    def peakmem_merge(self, path):
+        api.merge(self.settings, overwrite=True)
@@ -0,0 +1,69 @@
+import os
+import shutil
+import logging
+import tempfile
+
+import pycps.parsers as par
+import pycps.synthetic as s
+
+from .common import dd_parser, read_dd, households
+
+logging.disable(logging.CRITICAL)
+
+
+class DDParserRun(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.parser = dd_parser(self.tmpdir)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def time_run(self):
+        self.parser.run()
+
+    def peakmem_run(self):
+        self.parser.run()
+
+
+class ReadMonthly(object):
+    """
+    Decoding a synthetic month laid out like January 2014's.
+    """
+    params = [10 ** 4, 10 ** 5, 10 ** 6]
+    param_names = ['records']
+    timeout = 600
+
+    def setup_cache(self):
+        # written once per environment, in asv's cache directory
+        dd = read_dd()
+        paths = {}
+        for n in self.params:
+            paths[n] = os.path.abspath('month_{}.zip'.format(n))
+            s.write_month(paths[n], dd, '2014-01', households(n))
+        return dd, paths
+
+    def setup(self, cache, n):
+        self.dd, paths = cache
+        self.path = paths[n]
+
+    def time_read_monthly(self, cache, n):
+        par.read_monthly(self.path, self.dd)
+
+    def peakmem_read_monthly(self, cache, n):
+        par.read_monthly(self.path, self.dd)
+
+    def time_read_monthly_columns(self, cache, n):
+        par.read_monthly(self.path, self.dd,
+                         columns=['HRHHID', 'PULINENO', 'PRTAGE'])
+
+    def peakmem_read_monthly_columns(self, cache, n):
+        par.read_monthly(self.path, self.dd,
+                         columns=['HRHHID', 'PULINENO', 'PRTAGE'])
+
+    def time_read_monthly_compact(self, cache, n):
+        par.read_monthly(self.path, self.dd, compact=True)
+
+    def peakmem_read_monthly_compact(self, cache, n):
+        par.read_monthly(self.path, self.dd, compact=True)
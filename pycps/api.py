@@ -4,7 +4,7 @@ Functions to step through
 
 1. Downloading Data Dictionaries and Monthly files
 2. Parsing downloaded files
-3. Storing parsed files in HDF stores.
+3. Storing parsed files in HDF stores (or Parquet files).
 4. Merging stored files.
 
 Define your preferences in settings.json in this folder.
@@ -14,12 +14,20 @@ import logging
 import argparse
 from pathlib import Path
 from operator import itemgetter
+import time
+from concurrent.futures import (ProcessPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
 
 import pandas as pd
 
 import pycps.merge as m
 import pycps.parsers as par
 import pycps.downloaders as dl
+from pycps import __version__
+from pycps.storage import get_storage
+from pycps.manifest import (open_manifest, fingerprint, hash_frame,
+                            hash_fixups)
+from pycps.telemetry import open_telemetry, measure, make_record
 from pycps.setup_logging import setup_logging
 
 
@@ -28,12 +36,15 @@ logger = logging.getLogger(__name__)
 # TODO argparse CLI
 
 _HERE_ = Path(__file__).parent
+ID_COLS = m.PERSON_COLS
+# read by merge whatever ``merge_columns`` says
+MERGE_COLS = ['HRMIS', 'HRYEAR4', 'HRMONTH', 'PRTAGE', 'PESEX', 'PTDTRACE']
 #-----------------------------------------------------------------------------
 # Downloading
 #-----------------------------------------------------------------------------
 
 
-def download(kind, settings, overwrite=False):
+def download(kind, settings, overwrite=False, jobs=1, telemetry=None):
     """
     Download files from NBER.
 
@@ -41,11 +52,24 @@ def download(kind, settings, overwrite=False):
     settings : dict
     overwrite : bool; default True
         Whether to overwrite existing files
+    jobs : int
+        number of files to download at once
+    telemetry : Telemetry, optional
+        where to send timings; defaults to ``open_telemetry(settings)``
     """
+    if telemetry is None:
+        telemetry = open_telemetry(settings)
+    with telemetry.stage('download', kind=kind):
+        _download(kind, settings, overwrite, jobs, telemetry)
+
+
+def _download(kind, settings, overwrite, jobs, telemetry):
     s_path = {'dictionary': 'dd_path', 'data': 'monthly_path'}[kind]
-    cached = dl.check_cached(settings[s_path], kind=kind)
+    cached = dl.check_cached(settings[s_path], kind=kind,
+                             verify=settings.get('verify_downloads', False))
 
-    files = dl.all_monthly_files(kind=kind)
+    files = dl.all_monthly_files(kind=kind,
+                                 cache=settings.get('index_cache'))
     if kind == 'dictionary':
         files = filter(itemgetter(1), files)   # make sure not None cpsdec!
         months = [par._month_to_dd(settings['date_start']),
@@ -58,19 +82,24 @@ def download(kind, settings, overwrite=False):
     def is_new(x, cache=None):
         return dl.rename_cps_monthly(x[1]) not in cache
 
+    new = []
     for month, renamed in files:
         if is_new((month, renamed), cache=cached) or overwrite:
-            dl.download_month(month, Path(settings[s_path]))
-            logger.info("Downloaded {}".format(renamed))
+            new.append(month)
         else:
             logger.info("Using cached {}".format(renamed))
+            telemetry.emit(make_record('download', renamed, cache='hit'))
+
+    for month in dl.download_months(new, Path(settings[s_path]),
+                                    workers=jobs, telemetry=telemetry):
+        logger.info("Downloaded {}".format(dl.rename_cps_monthly(month)))
 
 #-----------------------------------------------------------------------------
 # Parsing
 #-----------------------------------------------------------------------------
 
 
-def parse(kind, settings, overwrite=False):
+def parse(kind, settings, overwrite=False, jobs=1, telemetry=None):
     """
     Parse downloaded files, store in HDFStore.
 
@@ -80,7 +109,18 @@ def parse(kind, settings, overwrite=False):
     kind : {'dictionary', 'data'}
     settings : dict
     overwrite : bool
+    jobs : int
+        number of processes to parse monthly files with
+    telemetry : Telemetry, optional
+        where to send timings; defaults to ``open_telemetry(settings)``
     """
+    if telemetry is None:
+        telemetry = open_telemetry(settings)
+    with telemetry.stage('parse', kind=kind):
+        _parse(kind, settings, overwrite, jobs, telemetry)
+
+
+def _parse(kind, settings, overwrite, jobs, telemetry):
     with open(settings['info_path']) as f:
         info = json.load(f)
 
@@ -94,54 +134,192 @@ def parse(kind, settings, overwrite=False):
     suffixes = suffix_d[kind]
 
     files = [x for x in path_.iterdir() if x.suffix in suffixes]
-    id_cols = ['HRHHID', 'HRHHID2', 'PULINENO']
+    id_cols = ID_COLS
 
     with open(settings['info']) as f:
         data = json.load(f)
 
+    manifest = open_manifest(settings)
+
     if kind == 'dictionary':
         files.append(_HERE_ / Path('cpsm2014-01.ddf'))
         for f in files:
             parser = par.DDParser(f, settings, info)
-            df = parser.run()
-            parser.write(df)
+            artifact = 'dd/' + f.stem
+            if manifest is not None:
+                fp = fingerprint(manifest.file_digest(f),
+                                 hash_fixups(parser.fixups),
+                                 parser.col_rename, parser.style,
+                                 __version__)
+                if (not overwrite and manifest.is_fresh(artifact, fp) and
+                        f.stem in parser.storage.keys()):
+                    logger.info("Using cached {}".format(f.stem))
+                    telemetry.emit(make_record('parse', f.stem,
+                                               cache='hit'))
+                    continue
+            with measure('parse', f.stem, cache='miss') as record:
+                df = parser.run()
+                parser.write(df)
+                record['bytes_read'] = f.stat().st_size
+                record['bytes_written'] = parser.storage.nbytes(f.stem)
+                record['records'] = len(df)
+            telemetry.emit(record)
             logging.info("Added {} to {}".format(f, parser.store_path))
+            if manifest is not None:
+                manifest.record(artifact, fp)
+                manifest.save()
     else:
-        for f in files:
-            dd_name = par._month_to_dd(str(f))
-            store_path = settings['monthly_store']
-
-            dd = pd.read_hdf(settings['dd_store'], key=dd_name)
+        store_path = settings['monthly_store']
+        backend = settings.get('storage', 'hdf')
+        store = get_storage(store_path, backend,
+                            by_mis=settings.get('partition_by_mis', False))
+        dd_store = get_storage(settings['dd_store'], backend)
+        compact = settings.get('compact_dtypes', False)
+        packed = settings.get('packed_person_id', False)
+        chunksize = settings.get('parse_chunksize')
+        options = {'storage': backend, 'compact': compact, 'packed': packed,
+                   'by_mis': settings.get('partition_by_mis', False),
+                   'chunked': bool(chunksize)}
+        # one look at the store's metadata, not a read per month
+        catalog = store.catalog()
+        plans = par.PlanCache(dd_store)
+        dd_hashes = {}
+        fps = {}
+        todo = []
+        dd_names = par._months_to_dd([str(f) for f in files])
+        for f, dd_name in zip(files, dd_names):
             cols = data['columns_by_dd'][dd_name]
-            sub_dd = dd[dd.id.isin(cols)]
+            fixups = settings['FIXUP_BY_DD'].get(dd_name)
+            fixups = par.resolve_fixups(fixups)
+
+            if manifest is not None:
+                if dd_name not in dd_hashes:
+                    dd_hashes[dd_name] = hash_frame(plans.dd(dd_name))
+                # the raw file, dictionary, columns, and fixups together
+                fps[f.stem] = fingerprint(
+                    manifest.file_digest(f), dd_hashes[dd_name], cols,
+                    hash_fixups(fixups), options)
+                if (not overwrite and f.stem in catalog and
+                        manifest.is_fresh('monthly/' + f.stem,
+                                          fps[f.stem])):
+                    logger.info("Using cached {}".format(f.stem))
+                    telemetry.emit(make_record('parse', f.stem,
+                                               cache='hit'))
+                    continue
+            elif f.stem in catalog:
+                cached_cols = catalog[f.stem]['columns']
+                newcols = set(cols) - set(cached_cols) - set(id_cols)
+                if len(newcols) == 0:
+                    logger.info("Using cached {}".format(f.stem))
+                    telemetry.emit(make_record('parse', f.stem,
+                                               cache='hit'))
+                    continue
+
+            plan = plans.plan(dd_name, cols)
+            todo.append((f, plan, fixups, compact, packed))
+
+        def added(f, record):
+            logging.info("Added {} to {}".format(f, store_path))
+            telemetry.emit(record)
+            if manifest is not None:
+                manifest.record('monthly/' + f.stem, fps[f.stem])
+                manifest.save()
+
+        if not chunksize:
+            # Workers only read and transform; every write to the store
+            # happens here, in this process, one month at a time.
+            for f, df, record in _map_months(_parse_month, todo, jobs=jobs):
+                t0 = time.time()
+                store.write(df, f.stem)
+                record['wall_seconds'] += time.time() - t0
+                record['bytes_written'] = store.nbytes(f.stem)
+                added(f, record)
+            return
+
+        # Each month is written by whoever reads it, a chunk at a time.
+        # Parquet months are separate files, but there's only one
+        # HDFStore, so it gets one writer.
+        if backend == 'hdf' and jobs > 1:
+            logger.info("Parsing one month at a time into {}".format(
+                store_path))
+            jobs = 1
+        todo = [args + (store, chunksize) for args in todo]
+        for f, record in _map_months(_parse_month_chunked, todo, jobs=jobs):
+            added(f, record)
+
+
+def _parse_month(f, plan, fixups, compact=False, packed=False):
+    """
+    Read and fixup a single monthly file. Top-level so that it can be
+    sent to a worker process.
 
-            if len(cols) != len(sub_dd):
-                missing = set(cols) - set(sub_dd.id.values)
-                raise ValueError("IDs {} are not in the Data "
-                                 "Dictionary".format(missing))
+    Returns
+    -------
+    f, df, record : the file, its frame, and telemetry for reading it
+    """
+    with measure('parse', f.stem, cache='miss') as record:
+        # Assuming no new rows
+        df = par.read_monthly(str(f), plan, compact=compact)
 
-            with pd.get_store(store_path) as store:
-                try:
-                    cached_cols = store.select(f.stem).columns
-                    newcols = set(cols) - set(cached_cols) - set(id_cols)
-                    if len(newcols) == 0:
-                        logger.info("Using cached {}".format(f.stem))
-                        continue
+        logger.info("Applying {} to {}".format(fixups, f.stem))
+        # the ids are always wanted, even where a fixup makes them
+        df = par.fixup_by_dd(df, fixups, columns=list(plan.names) + ID_COLS)
+        # TODO: special stuff
 
-                except KeyError:
-                    pass
+        df = m.set_person_index(df, packed=packed)
+        record['bytes_read'] = f.stat().st_size
+        record['records'] = len(df)
+    return f, df, record
 
-            # Assuming no new rows
-            df = par.read_monthly(str(f), sub_dd)
 
-            fixups = settings['FIXUP_BY_DD'].get(dd_name)
-            logger.info("Applying {} to {}".format(fixups, f.stem))
-            df = par.fixup_by_dd(df, fixups)
-            # TODO: special stuff
+def _parse_month_chunked(f, plan, fixups, compact, packed, store,
+                         chunksize):
+    """
+    Like ``_parse_month``, but read, fixup and write ``f`` to ``store``
+    ``chunksize`` records at a time, so that memory use doesn't grow
+    with the size of the month. Returns the file and its telemetry.
+    """
+    widths = dict(zip(plan.names, plan.ends - plan.starts))
+    with measure('parse', f.stem, cache='miss', records=0) as record:
+        with store.writer(f.stem, widths=widths) as append:
+            for df in par.iter_monthly(str(f), plan, chunksize=chunksize,
+                                       compact=compact):
+                df = par.fixup_by_dd(df, fixups,
+                                     columns=list(plan.names) + ID_COLS)
+                # ids may be missing (HRHHID2 before 2004-05), just as
+                # in _parse_month; packing refuses them there and here
+                df = par.stable_dtypes(df)
+                append(m.set_person_index(df, packed=packed))
+                record['records'] += len(df)
+        record['bytes_read'] = f.stat().st_size
+        record['bytes_written'] = store.nbytes(f.stem)
+    return f, record
+
+
+def _map_months(func, todo, jobs=1):
+    """
+    Apply ``func`` to each tuple of arguments in ``todo``, yielding
+    results as they finish. With ``jobs > 1`` the calls are spread over
+    a pool of that many processes.
 
-            df = df.set_index(id_cols)
-            par.write_monthly(df, store_path, f.stem)
-            logging.info("Added {} to {}".format(f, settings['monthly_store']))
+    ``todo`` may be a generator; it's consumed lazily, with at most
+    ``2 * jobs`` calls submitted and not yet collected at any time.
+    """
+    if jobs <= 1 or (hasattr(todo, '__len__') and len(todo) <= 1):
+        for args in todo:
+            yield func(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        running = set()
+        for args in todo:
+            running.add(pool.submit(func, *args))
+            if len(running) >= 2 * jobs:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(running):
+            yield future.result()
 
 
 # -----------------------------------------------------------------------------
@@ -149,7 +327,7 @@ def parse(kind, settings, overwrite=False):
 # -----------------------------------------------------------------------------
 
 
-def merge(settings, overwrite=False):
+def merge(settings, overwrite=False, jobs=1, telemetry=None):
     """
     Merges interviews over time by household.
 
@@ -158,54 +336,137 @@ def merge(settings, overwrite=False):
     settings : JSON settings file
     overwrite : bool
         whether to overwrite existing files
+    jobs : int
+        number of processes to match panels with
+    telemetry : Telemetry, optional
+        where to send timings; defaults to ``open_telemetry(settings)``
 
     Returns
     -------
     None (IO)
     """
+    if telemetry is None:
+        telemetry = open_telemetry(settings)
+    with telemetry.stage('merge'):
+        _merge(settings, overwrite, jobs, telemetry)
+
+
+def _merge(settings, overwrite, jobs, telemetry):
     STORE_FMT = 'm%Y_%m'
-    store_path = settings['monthly_store']
+    store = get_storage(settings['monthly_store'],
+                        settings.get('storage', 'hdf'))
+    columns = _merge_columns(settings.get('merge_columns'))
     start = settings['date_start']
     end = settings['date_end']
     all_months = pd.date_range(start=start, end=end, freq='m')
+    manifest = open_manifest(settings)
+    fps = {}
+    if manifest is not None:
+        fps = {x.strftime(STORE_FMT): _panel_fingerprint(manifest, x, columns)
+               for x in all_months}
 
+    hits = []
     if overwrite:
         logger.info("Merging for {}".format(all_months))
+    elif manifest is not None:
+        cached = set(get_storage(settings['merged_store']).keys())
+        fresh = set(k for k, fp in fps.items()
+                    if k in cached and manifest.is_fresh('merged/' + k, fp))
+        logger.info("Using cached for {}".format(sorted(fresh)))
+        all_months = [x for x in all_months
+                      if x.strftime(STORE_FMT) not in fresh]
+        hits = fresh
     else:
-        with pd.get_store(settings['merged_store']) as store:
-            cached = set(store.keys())
-            all_m = set([x.strftime('/' + STORE_FMT) for x in all_months])
-            logger.info("Using cached for {}".format(cached & all_m))
-            new = all_m - cached
-            all_months = filter(lambda x: x.strftime('/' + STORE_FMT) in new,
-                                all_months)
-
-    for m0 in all_months:
-        months = (x.strftime('cpsm%Y-%m')
-                  for x in m.make_months(m0.strftime('%Y-%m-%d')))
-        months = enumerate(months, 1)
-
-        mis, month = next(months)
-        df0 = pd.read_hdf(store_path, key=month).query('HRMIS == @mis')
-        match_funcs = [m.match_age, m.match_sex, m.match_race]
+        cached = set(get_storage(settings['merged_store']).keys())
+        all_m = set(x.strftime(STORE_FMT) for x in all_months)
+        hits = cached & all_m
+        logger.info("Using cached for {}".format(sorted(hits)))
+        all_months = [x for x in all_months
+                      if x.strftime(STORE_FMT) not in hits]
+    for key in sorted(hits):
+        telemetry.emit(make_record('merge', key, cache='hit'))
+
+    def read(month, mis):
+        return store.read_rotation_group(month, mis, columns=columns)
+
+    # every monthly file is read once, not once per panel it's in.
+    # Workers match panels; every write to the merged store happens
+    # here, one panel at a time.
+    panels = m.stream_panels(all_months, read)
+    n_panels = len(all_months)
+    merged = get_storage(settings['merged_store'])
+    for i, (m0, df, record) in enumerate(
+            _map_months(_merge_panel, panels, jobs=jobs), 1):
+        if df is None:
+            continue
+        store_key = df['wave_id'].iloc[0].strftime(STORE_FMT)
+        seconds = record['wall_seconds']
+        t0 = time.time()
+        df.to_hdf(settings["merged_store"], store_key)
+        record['item'] = store_key
+        record['wall_seconds'] += time.time() - t0
+        record['bytes_written'] = merged.nbytes(store_key)
+        telemetry.emit(record)
+        if manifest is not None:
+            manifest.record('merged/' + store_key, fps[store_key])
+            manifest.save()
+        logger.info("Added merged {} to {} ({} rows, matched in {:.1f}s; "
+                    "{}/{})".format(store_key, settings['merged_store'],
+                                    len(df), seconds, i, n_panels))
+
+
+def _merge_panel(m0, parts):
+    """
+    Match the later months of the panel starting in ``m0`` to its first
+    month. Top-level so that it can be sent to a worker process.
+
+    Returns
+    -------
+    m0, df, record : the start month, the merged panel (None if the
+        first month is missing), and telemetry for matching it
+    """
+    with measure('merge', cache='miss') as record:
+        (_, month, df0), rest = parts[0], parts[1:]
+        msg = "The panel for {} has no monthly data file for {}"
+        if df0 is None:
+            logger.warn(msg.format(m0, month))
+            return m0, None, record
+
         dfs = [df0]
-        for mis, month in months:
-            try:
-                dfn = pd.read_hdf(store_path, key=month).query('HRMIS == @mis')
-                dfs.append(m.match(df0, dfn, match_funcs))
-            except KeyError:
-                msg = "The panel for {} has no monthly data file for {}"
+        for mis, month, dfn in rest:
+            if dfn is None:
                 logger.warn(msg.format(m0, month))
                 continue
+            dfs.append(m.join_match(df0, dfn, m.MATCH_PREDICATES))
 
         df = m.merge(dfs)
         df = df.sort_index()
         df = m.make_wave_id(df)
+        record['records'] = len(df)
+    return m0, df, record
 
-        store_key = df['wave_id'].iloc[0].strftime(STORE_FMT)
-        df.to_hdf(settings["merged_store"], store_key)
-        logger.info("Added merged {} to {}".format(store_key,
-                                                   settings['merged_store']))
+
+def _panel_fingerprint(manifest, start, columns):
+    """
+    Fingerprint of the panel starting in ``start``: those of its eight
+    monthly files, the columns, and the matching code.
+    """
+    start = pd.Period(start, freq='M')
+    months = [(start + offset).strftime('monthly/cpsm%Y-%m')
+              for offset in m.PANEL_OFFSETS]
+    return fingerprint([manifest.get(x) for x in months], columns,
+                       hash_fixups(m.MATCH_PREDICATES))
+
+
+def _merge_columns(columns):
+    """
+    The columns ``merge`` has to read: the requested ``columns`` plus
+    the ones used for matching and labeling waves. None for all of them.
+    """
+    if columns is None:
+        return None
+    needed = [c for c in MERGE_COLS if c not in columns]
+    return list(columns) + needed
 
 
 def main(config):
@@ -219,6 +480,8 @@ def main(config):
     if config.monthly_data_fixups:
         import importlib
         fixup_file = config.monthly_data_fixups.strip('.py')
+        # importing also adds any fixups decorated with
+        # ``monthly_data_fixups.fixup`` to its REGISTRY
         user_fixups = importlib.import_module(fixup_file).FIXUP_BY_DD
 
         if config.append_fixups:
@@ -233,25 +496,32 @@ def main(config):
                         FIXUP_BY_DD[dd].append(x)
 
         else:
-            FIXUP_BY_DD = user_fixups.FIXUP_BY_DD
+            FIXUP_BY_DD = user_fixups
     else:
         from pycps.monthly_data_fixups import FIXUP_BY_DD
 
     # Fixups will be passed and accessed via settings
     settings['FIXUP_BY_DD'] = FIXUP_BY_DD
+    # one for the run, so the Prometheus file has every stage
+    telemetry = open_telemetry(settings)
 
     if config.download_dictionaries:
-        download('dictionary', settings, overwrite=overwrite)
+        download('dictionary', settings, overwrite=overwrite,
+                 jobs=config.jobs, telemetry=telemetry)
     if config.download_monthly:
-        download('data', settings, overwrite=overwrite)
+        download('data', settings, overwrite=overwrite, jobs=config.jobs,
+                 telemetry=telemetry)
 
     if config.parse_dictionaries:
-        parse('dictionary', settings, overwrite=overwrite)
+        parse('dictionary', settings, overwrite=overwrite,
+              telemetry=telemetry)
     if config.parse_monthly:
-        parse('data', settings, overwrite=overwrite)
+        parse('data', settings, overwrite=overwrite, jobs=config.jobs,
+              telemetry=telemetry)
 
     if config.merge:
-        merge(settings, overwrite=overwrite)
+        merge(settings, overwrite=overwrite, jobs=config.jobs,
+              telemetry=telemetry)
 
 
 if __name__ == '__main__':
@@ -289,5 +559,9 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--overwrite", default=False,
                         action="store_true",
                         help="Overwrite existing cache")
+    parser.add_argument("-j", "--jobs", default=1, type=int, metavar='',
+                        help="Number of concurrent downloads, and of "
+                             "processes for parsing monthly files and "
+                             "merging panels")
     config = parser.parse_args()
     main(config)
@@ -1,17 +1,9 @@
 # -*- coding: utf-8 -*-
 """
-Aim for 2.7+
+Python 3.7+
 """
-import sys
+import os
+from io import StringIO
 
-ISPY2 = sys.version_info[0] == 2
-
-if ISPY2:
-    from StringIO import StringIO
-    from itertools import ifilter, imap
-    filter = ifilter
-    map = imap
-    str_types = (basestring,)
-else:
-    from io import StringIO
-    str_types = (str,)
+str_types = (str,)
+replace = os.replace
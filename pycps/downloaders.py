@@ -10,26 +10,36 @@ from http://www.nber.org/data/cps_basic.html
 TODO: March Supplements
 """
 import re
+import json
+import hashlib
 import logging
 import datetime
 from pathlib import Path
 from itertools import chain
 from functools import partial
 from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import arrow
 import requests
+from requests.adapters import HTTPAdapter
 from lxml import html
 from pandas.core.common import is_list_like
 
+from pycps.compat import replace
+from pycps.telemetry import measure
+
 logger = logging.getLogger(__name__)
 
 # Special pattern for dds from Jan 1994 - Jun 1995
 DATAWEB_MATCHER = re.compile(r"\w{3}\d{2}_\w{3}\d{2}_dd.txt")
 
+# bytes to write at a time when downloading
+CHUNK_SIZE = 2 ** 20
+
 
 def all_monthly_files(site='http://www.nber.org/data/cps_basic.html',
-                      kind='data'):
+                      kind='data', cache=None, session=None):
     """
     Find all matching monthly data files and data dictionaries
     from the NBER's CPS site.
@@ -39,8 +49,13 @@ def all_monthly_files(site='http://www.nber.org/data/cps_basic.html',
     site: str
     kind: {'data', 'dictionary'}
         whether to get the actual data file or the data-dictionary
+    cache: str or Path, optional
+        JSON file to keep the links from ``site`` in. With a cache,
+        ``site`` is only fetched and parsed again when the server says
+        it has changed (a conditional GET on its ETag / Last-Modified).
+    session: requests.Session, optional
+        used to fetch ``site`` when ``cache`` is given
     """
-    logger.info("Fetching monthly files from {}".format(site))
     if kind == 'data':
         regex = re.compile(r'cpsb\d{4}.Z|\w{3}\d{2}pub.zip')
     elif kind == 'dictionary':
@@ -48,10 +63,9 @@ def all_monthly_files(site='http://www.nber.org/data/cps_basic.html',
     else:
         raise ValueError("Kind must be one of `data`, or `dictionary`. "
                          "Got {} instead.".format(kind))
-    root = html.parse(site).getroot()
     partial_matcher = partial(_matcher, regex=regex)
 
-    for _, _, fname_, _ in filter(partial_matcher, root.iterlinks()):
+    for fname_ in filter(partial_matcher, _index_links(site, cache, session)):
         fname = fname_.split('/')[-1]
         yield fname, rename_cps_monthly(fname)
 
@@ -65,6 +79,54 @@ def all_monthly_files(site='http://www.nber.org/data/cps_basic.html',
             yield fname, rename_cps_monthly(fname)
 
 
+def _index_links(site, cache=None, session=None):
+    """
+    The targets of all the links on the page at ``site``, going through
+    the on-disk ``cache`` (see ``all_monthly_files``) for remote pages.
+    """
+    if cache is None or not re.match(r'https?://', site):
+        logger.info("Fetching monthly files from {}".format(site))
+        root = html.parse(site).getroot()
+        return [link for _, _, link, _ in root.iterlinks()]
+
+    cache = Path(cache)
+    try:
+        with cache.open() as f:
+            pages = json.load(f)
+    except (IOError, OSError, ValueError):
+        pages = {}
+    entry = pages.get(site, {})
+
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    session = session or requests.Session()
+    r = session.get(site, headers=headers)
+    if r.status_code == 304 and 'links' in entry:
+        logger.info("{} unchanged; using links cached in {}".format(site,
+                                                                   cache))
+        return entry['links']
+    r.raise_for_status()
+
+    logger.info("Fetching monthly files from {}".format(site))
+    root = html.fromstring(r.content, base_url=site)
+    links = [link for _, _, link, _ in root.iterlinks()]
+
+    pages[site] = {'etag': r.headers.get('ETag'),
+                   'last_modified': r.headers.get('Last-Modified'),
+                   'links': links}
+    if not cache.parent.exists():
+        cache.parent.mkdir(parents=True)
+    tmp = cache.parent / (cache.name + '.part')
+    with tmp.open('w') as f:
+        f.write(json.dumps(pages, indent=1))
+    replace(str(tmp), str(cache))
+    return links
+
+
 def rename_cps_monthly(cpsname):
     """
     hardcoded. cpsb9102.Z   -> cpsm1991-02.Z
@@ -201,7 +263,7 @@ def filter_monthly_files(files, months=None):
     return filtered
 
 
-def download_month(month, datapath):
+def download_month(month, datapath, session=None, base=None, sha256=None):
     """
     Fetch and write a single month's data
     from http://www.nber.org/cps-basic/ or
@@ -211,54 +273,278 @@ def download_month(month, datapath):
     ----------
     month: str
     datapath: Path
+    session: requests.Session, optional
+        reuse the connections of an existing session; see ``make_session``
+    base: str, optional
+        URL of the directory to fetch from. Defaults to the NBER or
+        Census directory ``month`` is kept in.
+    sha256: str, optional
+        expected hex digest of the file
 
     Returns
     -------
-    None: IO ()
-
+    record: dict
+        telemetry for the transfer; see ``telemetry.measure``
+
+    Raises
+    ------
+    IOError : If the transfer is cut short or the digest doesn't match
+
+    Notes
+    -----
+    Bytes are written to ``<name>.part`` and only renamed to ``<name>``
+    once the whole file has arrived (checked against the Content-Length)
+    and, if given, matches ``sha256``. A rerun after an interrupted
+    transfer resumes the ``.part`` file with a Range request; if the
+    server says there's nothing left to send (416), the ``.part`` is
+    kept when its size matches the remote file's, or it matches
+    ``sha256``, and otherwise downloaded again. The digest
+    of every finished download is recorded in ``<name>.sha256`` so that
+    ``verify_download`` can check it later.
     """
+    with measure('download', rename_cps_monthly(month),
+                 cache='miss') as record:
+        _fetch_month(month, datapath, session, base, sha256, record)
+    return record
+
+
+def _fetch_month(month, datapath, session, base, sha256, record):
     # special case January 1994 thru June 1995
     if DATAWEB_MATCHER.match(month):
         myname = rename_cps_monthly(month)
         dt_start = datetime.datetime.strptime(month[:5], '%b%y')
         dt_end = datetime.datetime.strptime(month[6:11], '%b%y')
-        base = "http://thedataweb.rm.census.gov/pub/cps/basic/{}-{}/".format(
-            dt_start.strftime("%Y%m"), dt_end.strftime("%Y%m"))
+        default = ("http://thedataweb.rm.census.gov/pub/cps/basic/"
+                   "{}-{}/".format(dt_start.strftime("%Y%m"),
+                                   dt_end.strftime("%Y%m")))
     else:
-        base = "http://www.nber.org/cps-basic/"
+        default = "http://www.nber.org/cps-basic/"
         myname = rename_cps_monthly(month)
 
     if myname is None:
         return None
 
+    if base is None:
+        base = default
+
+    if session is None:
+        session = requests
+
     if not isinstance(datapath, Path):
         datapath = Path(datapath)
 
     if not datapath.exists():
         datapath.mkdir(parents=True)
 
-    logger.info("Fetching monthly file from {}".format(base + month))
-    r = requests.get(base + month, stream=True)
     outpath = datapath / myname
-    logger.info("Writing {}".format(outpath))
-    with outpath.open('wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
+    partpath = datapath / (myname + '.part')
+
+    # pick up where an earlier attempt left off
+    sha = hashlib.sha256()
+    have = partpath.stat().st_size if partpath.exists() else 0
+    headers = {'Accept-Encoding': 'identity'}
+    if have:
+        _hash_file(partpath, sha)
+        headers['Range'] = 'bytes={}-'.format(have)
+
+    logger.info("Fetching monthly file from {}".format(base + month))
+    r = session.get(base + month, stream=True, headers=headers)
+    if r.status_code == 416 and have:
+        # nothing past the end of the .part, which is often because
+        # it's all there: the last attempt died before the rename
+        total = _expected_size(r, have)
+        r.close()
+        if total == have or (sha256 is not None and
+                             sha.hexdigest() == sha256.lower()):
+            logger.info("{} is already complete".format(partpath))
+            record['bytes_read'] = record['bytes_written'] = 0
+            return _finish(month, partpath, outpath, sha.hexdigest(),
+                           sha256)
+        # the partial file doesn't fit the remote one; start over
+        partpath.unlink()
+        return _fetch_month(month, datapath, session, base, sha256, record)
+    r.raise_for_status()
+
+    if r.status_code == 206:
+        mode = 'ab'
+        logger.info("Resuming {} from byte {}".format(partpath, have))
+    else:
+        mode = 'wb'
+        have = 0
+        sha = hashlib.sha256()
+    total = _expected_size(r, have)
+
+    logger.info("Writing {}".format(partpath))
+    with partpath.open(mode) as f:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
             f.write(chunk)
-            f.flush()
+            sha.update(chunk)
+
+    size = partpath.stat().st_size
+    record['bytes_read'] = record['bytes_written'] = size - have
+    if total is not None and size != total:
+        raise IOError("Incomplete download of {}: got {} of {} bytes. "
+                      "Run again to resume.".format(month, size, total))
+
+    _finish(month, partpath, outpath, sha.hexdigest(), sha256)
+
+
+def _finish(month, partpath, outpath, digest, sha256):
+    """
+    Check a complete ``.part`` file against ``sha256`` (if given), and
+    rename it into place with its digest recorded next to it.
+    """
+    if sha256 is not None and digest != sha256.lower():
+        partpath.unlink()
+        raise IOError("Checksum mismatch for {}: expected {}, "
+                      "got {}".format(month, sha256, digest))
+
+    _write_digest(outpath, digest)
+    replace(str(partpath), str(outpath))
+    logger.info("Wrote {}".format(outpath))
+
+
+def download_months(months, datapath, workers=1, session=None, base=None,
+                    telemetry=None):
+    """
+    Fetch several months concurrently, over a shared pool of
+    keep-alive connections.
+
+    Parameters
+    ----------
+    months: [str]
+        names as on the NBER site, like those from ``all_monthly_files``
+    datapath: Path
+    workers: int
+        number of files to download at once
+    session: requests.Session, optional
+        defaults to ``make_session(workers)``
+    base: str, optional
+        passed to ``download_month``
+    telemetry: Telemetry, optional
+        emits each download's record as it finishes
+
+    Returns
+    -------
+    months: generator of str
+        each month in ``months``, yielded as its download finishes
+    """
+    months = list(months)
+    if session is None:
+        session = make_session(pool_size=workers)
+
+    if not isinstance(datapath, Path):
+        datapath = Path(datapath)
+
+    # make sure the threads don't race to create it
+    if not datapath.exists():
+        datapath.mkdir(parents=True)
+
+    fetch = partial(download_month, datapath=datapath, session=session,
+                    base=base)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(fetch, month): month for month in months}
+        for future in as_completed(futures):
+            record = future.result()
+            if telemetry is not None:
+                telemetry.emit(record)
+            yield futures[future]
+
+
+def verify_download(path):
+    """
+    Check a downloaded file against the digest recorded next to it.
+
+    Parameters
+    ----------
+    path: str or Path
+
+    Returns
+    -------
+    ok: bool or None
+        None if no digest was recorded for ``path``.
+    """
+    if not isinstance(path, Path):
+        path = Path(path)
+    expected = recorded_digest(path)
+    if expected is None:
+        return None
+    return _hash_file(path).hexdigest() == expected
+
+
+def recorded_digest(path):
+    """
+    The SHA-256 recorded next to ``path`` when it was downloaded, or
+    None if there isn't one.
+    """
+    if not isinstance(path, Path):
+        path = Path(path)
+    digest_path = path.parent / (path.name + '.sha256')
+    try:
+        with digest_path.open() as f:
+            return f.read().split()[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+def _hash_file(path, sha=None):
+    sha = hashlib.sha256() if sha is None else sha
+    with path.open('rb') as f:
+        for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha
+
+
+def _write_digest(path, digest):
+    # same layout as `sha256sum`, so `sha256sum -c` works too
+    with (path.parent / (path.name + '.sha256')).open('w') as f:
+        f.write(u'{}  {}\n'.format(digest, path.name))
+
+
+def _expected_size(r, offset):
+    """
+    Total size of the remote file, from the headers of a (possibly
+    partial, or for 416 unsatisfiable) response. None if the server
+    didn't say.
+    """
+    content_range = r.headers.get('Content-Range')
+    if r.status_code in (206, 416) and content_range:
+        # "bytes 100-199/200", or "bytes */200" for a 416
+        total = content_range.rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
+    if r.status_code == 416:
+        # the Content-Length is the error page's
+        return None
+    length = r.headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        return offset + int(length)
+    return None
+
+
+def make_session(pool_size=1):
+    """
+    A ``requests.Session`` whose connection pool can keep ``pool_size``
+    connections per host alive.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 #-----------------------------------------------------------------------------
 
 def _matcher(link, regex):
     try:
-        _, fldr, file_ = link[2].split('/')
+        _, fldr, file_ = link.split('/')
         if regex.match(file_):
             return file_
     except ValueError:
         pass
 
 
-def check_cached(directory, kind='data'):
+def check_cached(directory, kind='data', verify=False):
     """
     Check for existing files on disk in 'directory'.
 
@@ -266,6 +552,10 @@ def check_cached(directory, kind='data'):
     ----------
     directory: str or Path
     kind: {'data', 'dictionary'}
+    verify: bool
+        Whether to leave out files that don't match the digest recorded
+        when they were downloaded (see ``verify_download``). Slow: every
+        file is read in full.
 
     Returns
     -------
@@ -281,10 +571,15 @@ def check_cached(directory, kind='data'):
     if not isinstance(directory, Path):
         directory = Path(directory)
     try:
-        cached = [x.name for x in directory.iterdir()
-                  if x.suffix in suffixes]
+        cached = [x for x in directory.iterdir() if x.suffix in suffixes]
     except OSError:
         # no cache files
         cached = []
 
-    return cached
+    if verify:
+        bad = [x for x in cached if verify_download(x) is False]
+        for x in bad:
+            logger.warning("{} doesn't match its recorded digest".format(x))
+        cached = [x for x in cached if x not in bad]
+
+    return [x.name for x in cached]
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming decoder for unix ``compress`` (``.Z``) files.
+
+The pre-1994 monthly files from the NBER (``cpsb7601.Z`` and friends)
+are LZW compressed. The stdlib has no reader for them, so this is a
+small, pure python port of the decompression side of ``ncompress``.
+It reads the compressed stream in chunks and never needs the whole
+archive (or the decompressed output) in memory or on disk.
+"""
+import io
+
+MAGIC = b'\x1f\x9d'
+INIT_BITS = 9
+BLOCK_MODE = 0x80
+BIT_MASK = 0x1f
+CLEAR = 256
+
+
+def iter_decompress(fileobj, chunk_size=2 ** 16):
+    """
+    Decompress a ``.Z`` stream, yielding chunks of decompressed bytes.
+
+    Parameters
+    ----------
+    fileobj: file-like
+        opened in binary mode, positioned at the start of the magic header
+    chunk_size: int
+        number of compressed bytes to read at a time
+
+    Returns
+    -------
+    chunks: generator of bytes
+
+    Notes
+    -----
+    ``compress`` writes codes in groups of eight. When the code width
+    changes, or the dictionary is cleared, the remainder of the current
+    group is padding. Reading the input one group (``n_bits`` bytes) at
+    a time keeps us aligned with those boundaries.
+    """
+    header = fileobj.read(3)
+    if len(header) < 3 or header[:2] != MAGIC:
+        raise ValueError("Not a compress (.Z) stream")
+
+    flags = bytearray(header)[2]
+    max_bits = flags & BIT_MASK
+    block_mode = flags & BLOCK_MODE
+    if max_bits < INIT_BITS or max_bits > 16:
+        raise ValueError("Unsupported max bits {}".format(max_bits))
+    max_max_code = 1 << max_bits
+
+    def reset():
+        table = [bytes(bytearray([i])) for i in range(256)]
+        if block_mode:
+            table.append(b'')   # placeholder for CLEAR
+        return table
+
+    table = reset()
+    n_bits = INIT_BITS
+    max_code = (1 << n_bits) - 1
+    prev = None
+
+    buf = b''
+    pos = 0
+    eof = False
+    out = []
+    while True:
+        # refill so we hold at least one full group
+        if not eof and len(buf) - pos < n_bits:
+            if out:
+                yield b''.join(out)
+                out = []
+            data = fileobj.read(chunk_size)
+            if not data:
+                eof = True
+            buf = buf[pos:] + data
+            pos = 0
+            continue
+        if pos >= len(buf):
+            break
+
+        group = buf[pos:pos + n_bits]
+        pos += n_bits
+        bits = int.from_bytes(group, 'little')
+        n_codes = (len(group) * 8) // n_bits
+        mask = (1 << n_bits) - 1
+
+        for i in range(n_codes):
+            code = (bits >> (i * n_bits)) & mask
+
+            if prev is None:
+                if code >= 256:
+                    raise ValueError("Corrupt .Z stream")
+                prev = table[code]
+                out.append(prev)
+                continue
+
+            if code == CLEAR and block_mode:
+                table = reset()
+                # the first entry after a clear is never referenced; this
+                # keeps the table numbering in step with the encoder
+                table.pop()
+                n_bits = INIT_BITS
+                max_code = (1 << n_bits) - 1
+                break
+
+            if code < len(table):
+                entry = table[code]
+            elif code == len(table):
+                entry = prev + prev[:1]     # KwKwK
+            else:
+                raise ValueError("Corrupt .Z stream")
+
+            out.append(entry)
+            if len(table) < max_max_code:
+                table.append(prev + entry[:1])
+            prev = entry
+
+            if len(table) > max_code:
+                # the rest of this group is padding
+                n_bits += 1
+                max_code = (max_max_code if n_bits == max_bits
+                            else (1 << n_bits) - 1)
+                break
+
+    if out:
+        yield b''.join(out)
+
+
+class LZWFile(io.RawIOBase):
+    """
+    Read-only file object over a ``.Z`` stream.
+
+    Parameters
+    ----------
+    fileobj: str or file-like
+        path to, or a binary file object of, a ``.Z`` file
+
+    Examples
+    --------
+    >>> with LZWFile('cpsm1976-01.Z') as f:
+    ...     first = f.readline()
+    """
+
+    def __init__(self, fileobj):
+        if isinstance(fileobj, (str, bytes)):
+            fileobj = open(fileobj, 'rb')
+            self._owns = True
+        else:
+            self._owns = False
+        self._fileobj = fileobj
+        self._chunks = iter_decompress(fileobj)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed and self._owns:
+            self._fileobj.close()
+        super(LZWFile, self).close()
+
+
+def open_lzw(fileobj, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    """
+    Open a ``.Z`` file for buffered, binary reading.
+    """
+    return io.BufferedReader(LZWFile(fileobj), buffer_size=buffer_size)
+
+
+def decompress(data):
+    """
+    Decompress ``bytes`` holding a whole ``.Z`` file.
+    """
+    return b''.join(iter_decompress(io.BytesIO(data)))
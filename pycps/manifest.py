@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Record what each stored artifact was built from.
+
+The manifest is a JSON file mapping an artifact (``monthly/cpsm2009-01``,
+``dd/cpsm2009-01``, ``merged/m2009_01``) to a fingerprint: a SHA-256 over
+everything that went into it. That means the raw file, the data dictionary
+rows, the columns, and the source of the fixup functions. A stage only
+redoes an artifact when its fingerprint has changed. Otherwise, a rerun
+with nothing new hashes a few small things and moves on.
+
+Raw files are hashed once. The manifest keeps their size and mtime, and
+only hashes them again when those change. If the download left a
+``.sha256`` file (see ``downloaders.verify_download``) that's at least
+as new as the file, that digest is used instead.
+"""
+import json
+import inspect
+import hashlib
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+from pycps.compat import replace
+from pycps.downloaders import recorded_digest
+
+logger = logging.getLogger(__name__)
+
+
+class Manifest(object):
+    """
+    Fingerprints of stored artifacts, kept in a JSON file at ``path``.
+
+    Parameters
+    ----------
+    path: str or Path
+
+    Examples
+    --------
+    >>> manifest = Manifest('data/manifest.json')
+    >>> fp = fingerprint(manifest.file_digest(raw), hash_frame(dd), cols)
+    >>> if not manifest.is_fresh('monthly/cpsm2009-01', fp):
+    ...     rebuild()
+    ...     manifest.record('monthly/cpsm2009-01', fp)
+    ...     manifest.save()
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            data = {}
+        self.artifacts = data.get('artifacts', {})
+        self.files = data.get('files', {})
+
+    def is_fresh(self, artifact, fp):
+        return self.artifacts.get(artifact) == fp
+
+    def get(self, artifact):
+        return self.artifacts.get(artifact)
+
+    def record(self, artifact, fp):
+        self.artifacts[artifact] = fp
+
+    def file_digest(self, path):
+        """
+        SHA-256 of the file at ``path``, rehashed only if its size or
+        modification time changed since last time.
+        """
+        path = Path(path)
+        stat = path.stat()
+        key = str(path.resolve())
+        seen = self.files.get(key)
+        if (seen is not None and seen['size'] == stat.st_size and
+                seen['mtime'] == stat.st_mtime):
+            return seen['sha256']
+
+        digest = _sidecar_digest(path, stat)
+        if digest is None:
+            logger.info("Hashing {}".format(path))
+            sha = hashlib.sha256()
+            with path.open('rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+        self.files[key] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                           'sha256': digest}
+        return digest
+
+    def save(self):
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+        tmp = self.path.parent / (self.path.name + '.part')
+        with tmp.open('w') as f:
+            f.write(json.dumps({'artifacts': self.artifacts,
+                                'files': self.files},
+                               indent=1, sort_keys=True))
+        replace(str(tmp), str(self.path))
+
+
+def _sidecar_digest(path, stat):
+    """
+    The digest recorded next to ``path`` when it was downloaded, unless
+    ``path`` was modified after that.
+    """
+    sidecar = path.parent / (path.name + '.sha256')
+    try:
+        if sidecar.stat().st_mtime < stat.st_mtime:
+            logger.info("{} is older than {}, ignoring it".format(sidecar,
+                                                                  path))
+            return None
+    except (IOError, OSError):
+        return None
+    return recorded_digest(path)
+
+
+def open_manifest(settings):
+    """
+    The ``Manifest`` at ``settings['manifest']``, or None if there's no
+    such setting (and each stage falls back to its own checks).
+    """
+    path = settings.get('manifest')
+    return None if path is None else Manifest(path)
+
+
+def fingerprint(*parts):
+    """
+    Hex SHA-256 of ``parts``, which must be JSON serializable.
+    Dict keys are sorted, so their order doesn't matter.
+    """
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def hash_frame(df):
+    """
+    Hex SHA-256 of a DataFrame's values and index.
+    """
+    values = pd.util.hash_pandas_object(df, index=True).values
+    sha = hashlib.sha256(values.tobytes())
+    sha.update(json.dumps([str(c) for c in df.columns]).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def hash_fixups(fixups):
+    """
+    Hex SHA-256 of the source of each fixup, and of its kwargs.
+
+    Parameters
+    ----------
+    fixups: list of functions, or of (function, kwargs) tuples
+
+    Notes
+    -----
+    A fixup is identified by the source of the whole module it's
+    defined in, so editing a helper it calls counts as a change too.
+    """
+    parts = []
+    for fixup in fixups or []:
+        func, kwargs = fixup if isinstance(fixup, tuple) else (fixup, {})
+        parts.append([func.__name__, _module_source(func), kwargs])
+    return fingerprint(parts)
+
+
+def _module_source(func):
+    module = inspect.getmodule(func)
+    try:
+        return inspect.getsource(module if module is not None else func)
+    except (IOError, OSError, TypeError):
+        return '{}.{}'.format(getattr(func, '__module__', ''),
+                              func.__name__)
+
@@ -2,13 +2,21 @@
 """
 Merge the different months by person.
 """
+import logging
 import datetime
 from operator import and_  # same as &
 from functools import reduce
+from collections import OrderedDict, defaultdict
 
 import arrow
+import numpy as np
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
+# months after the first that a household is interviewed
+PANEL_OFFSETS = [0, 1, 2, 3, 12, 13, 14, 15]
+
 
 def make_months(base):
     """
@@ -32,11 +40,215 @@ def make_months(base):
     if not isinstance(base, arrow.Arrow):
         base = arrow.get(base, format='%Y-%m')
 
-    months = [base.replace(months=d) for d in
-              [0, 1, 2, 3, 12, 13, 14, 15]]
+    months = [base.replace(months=d) for d in PANEL_OFFSETS]
     return months
 
 
+def stream_panels(starts, read, window=16):
+    """
+    Collect the eight months of each panel, reading every monthly file
+    at most once.
+
+    Months are read in order and split by month in sample (``HRMIS``)
+    as they come in. Only the partitions some panel still needs are
+    kept, for at most ``window`` months. A panel is yielded as soon as
+    its last month has been read.
+
+    Parameters
+    ----------
+    starts: iterable
+        first months of the panels, anything ``pd.Period`` takes
+    read: function
+        called with a name like ``cpsm2014-01`` and the list of months in
+        sample wanted from it; returns a DataFrame with (at least) those
+        rows, or raises KeyError if there's no such month
+    window: int
+        most months to hold on to. A panel spans 16 months, so anything
+        less means some months are read again.
+
+    Yields
+    ------
+    start: Period
+    parts: [(mis, name, DataFrame or None)]
+        the eight months of the panel, in order. ``None`` if the month
+        is missing.
+    """
+    starts = sorted(set(pd.Period(x, freq='M') for x in starts))
+    wanted = defaultdict(set)
+    for start in starts:
+        for mis, offset in enumerate(PANEL_OFFSETS, 1):
+            wanted[start + offset].add(mis)
+
+    def name(month):
+        return month.strftime('cpsm%Y-%m')
+
+    def load(month):
+        try:
+            df = read(name(month), sorted(wanted[month]))
+        except KeyError:
+            return None
+        positions = df.groupby('HRMIS').indices
+        none = np.array([], dtype=np.intp)
+        return {mis: df.take(positions.get(mis, none))
+                for mis in wanted[month]}
+
+    cache = LRUCache(window)
+    pending = list(reversed(starts))
+    for month in sorted(wanted):
+        cache[month] = load(month)
+        while pending and pending[-1] + PANEL_OFFSETS[-1] <= month:
+            start = pending.pop()
+            parts = []
+            for mis, offset in enumerate(PANEL_OFFSETS, 1):
+                current = start + offset
+                if current in cache:
+                    partitions = cache[current]
+                else:
+                    # only if ``window`` is too small to hold a panel
+                    partitions = load(current)
+                frame = None if partitions is None else partitions[mis]
+                parts.append((mis, name(current), frame))
+            yield start, parts
+
+        # nothing left needs months before the next panel starts
+        if pending:
+            for old in [x for x in cache if x < pending[-1]]:
+                del cache[old]
+
+
+class LRUCache(OrderedDict):
+    """
+    A dict that holds at most ``maxsize`` items, dropping the least
+    recently used one to make room.
+    """
+
+    def __init__(self, maxsize):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super(LRUCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super(LRUCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            oldest = next(iter(self))
+            logger.debug("Evicting {} from the month cache".format(oldest))
+            del self[oldest]
+
+
+#-----------------------------------------------------------------------------
+# Person ids
+
+PERSON_COLS = ['HRHHID', 'HRHHID2', 'PULINENO']
+PERSON_ID = 'PERSONID'
+# two words: all of HRHHID, then HRHHID2 and PULINENO side by side
+PACKED_COLS = ['HRHHID', PERSON_ID]
+PACKED_DTYPE = np.dtype([('HRHHID', np.int64), (PERSON_ID, np.int32)])
+_PULINENO_BITS = 8
+_MAX_HRHHID2 = 2 ** (31 - _PULINENO_BITS) - 1
+_MAX_PULINENO = 2 ** _PULINENO_BITS - 1
+
+
+def pack_person_ids(df):
+    """
+    Pack ``HRHHID``, ``HRHHID2`` and ``PULINENO`` into two words per
+    person: ``HRHHID`` as an ``int64``, and
+    ``HRHHID2 << 8 | PULINENO`` as an ``int32`` ``PERSONID``.
+
+    Parameters
+    ----------
+    df: DataFrame
+        with the three id columns
+
+    Returns
+    -------
+    ids: ndarray of ``PACKED_DTYPE``
+        with ``HRHHID`` and ``PERSONID`` fields
+
+    Raises
+    ------
+    ValueError : If an id is missing, negative, or too wide to pack.
+
+    Notes
+    -----
+    Every ``HRHHID`` fits, including the 15 digit ones. ``HRHHID2``
+    must be below 2**23 and ``PULINENO`` below 256, which the
+    5 and 2 digit fields always are. The words are signed because
+    PyTables can't index unsigned 64-bit columns.
+    """
+    limits = [('HRHHID', np.iinfo(np.int64).max),
+              ('HRHHID2', _MAX_HRHHID2),
+              ('PULINENO', _MAX_PULINENO)]
+    parts = []
+    for col, limit in limits:
+        if df[col].isnull().any():
+            raise ValueError("{} has missing values".format(col))
+        values = np.asarray(df[col], dtype=np.int64)
+        if values.size and (values.min() < 0 or values.max() > limit):
+            raise ValueError("{} must be between 0 and {} to be packed "
+                             "into a person id".format(col, limit))
+        parts.append(values)
+    hrhhid, hrhhid2, pulineno = parts
+    ids = np.empty(len(hrhhid), dtype=PACKED_DTYPE)
+    ids['HRHHID'] = hrhhid
+    ids[PERSON_ID] = (hrhhid2 << _PULINENO_BITS) | pulineno
+    return ids
+
+
+def unpack_person_ids(ids):
+    """
+    Inverse of ``pack_person_ids``.
+
+    Parameters
+    ----------
+    ids: ndarray of ``PACKED_DTYPE``, or DataFrame
+        with ``HRHHID`` and ``PERSONID``
+
+    Returns
+    -------
+    df: DataFrame
+        ``HRHHID``, ``HRHHID2`` and ``PULINENO`` as ``int64``
+    """
+    person = np.asarray(ids[PERSON_ID], dtype=np.int64)
+    return pd.DataFrame({'HRHHID': np.asarray(ids['HRHHID'], dtype=np.int64),
+                         'HRHHID2': person >> _PULINENO_BITS,
+                         'PULINENO': person & _MAX_PULINENO},
+                        columns=PERSON_COLS)
+
+
+def set_person_index(df, packed=False):
+    """
+    Index ``df`` by person: by the three id columns, or with
+    ``packed=True`` by the two words from ``pack_person_ids``.
+    """
+    if not packed:
+        return df.set_index(PERSON_COLS)
+    ids = pack_person_ids(df)
+    index = pd.MultiIndex.from_arrays([ids[col] for col in PACKED_COLS],
+                                      names=PACKED_COLS)
+    return df.drop(PERSON_COLS, axis=1).set_index(index)
+
+
+def reset_person_index(df):
+    """
+    Turn packed ``HRHHID`` and ``PERSONID`` index levels back into the
+    three id columns. Other index levels (like ``HRMIS`` after
+    ``merge``) are kept.
+    """
+    if PERSON_ID not in df.index.names:
+        return df
+    ids = unpack_person_ids({col: df.index.get_level_values(col)
+                             for col in PACKED_COLS})
+    df = df.reset_index(PACKED_COLS, drop=True)
+    for col in reversed(PERSON_COLS):
+        df.insert(0, col, ids[col].values)
+    return df
+
+
 def match(left, right, match_funcs):
     """
     Find the common people in left and right
@@ -80,6 +292,143 @@ def match(left, right, match_funcs):
     return right.loc[common]
 
 
+def match_positions(left, right, predicates):
+    """
+    Find the common people in left and right where every predicate
+    is true, with a single join on the index.
+
+    Parameters
+    ----------
+    left: DataFrame
+    right: DataFrame
+    predicates: [function]
+        each takes the aligned ``left`` and ``right`` (see Notes) and
+        returns a boolean array, one value per common person.
+
+    Returns
+    -------
+    left_positions, right_positions: ndarray
+        integer positions of the matched people in ``left`` and
+        ``right``; ``left_positions[i]`` is the same person as
+        ``right_positions[i]``.
+
+    Notes
+    -----
+    Unlike the functions passed to ``match``, predicates never align
+    anything themselves. ``left[col]`` and ``right[col]`` are plain
+    arrays holding ``col`` for the same people, in the same order, so
+    predicates are just elementwise comparisons (see ``age_matches``).
+    Missing values are NaN, and so never match.
+    """
+    left_pos, right_pos = align(left, right)
+    keep = np.ones(len(right_pos), dtype=bool)
+    aligned_left = _Aligned(left, left_pos)
+    aligned_right = _Aligned(right, right_pos)
+    for predicate in predicates:
+        keep &= np.asarray(predicate(aligned_left, aligned_right), dtype=bool)
+    return left_pos[keep], right_pos[keep]
+
+
+def join_match(left, right, predicates):
+    """
+    Like ``match``, with predicates for ``match_positions``.
+
+    Returns
+    -------
+    sub_right: DataFrame
+        a subset of right, in the same order
+    """
+    _, right_pos = match_positions(left, right, predicates)
+    return right.iloc[right_pos]
+
+
+def align(left, right):
+    """
+    Hash join of left and right on their index.
+
+    Returns
+    -------
+    left_positions, right_positions: ndarray
+        positions of the people in both; see ``match_positions``.
+
+    Raises
+    ------
+    ValueError : If a person is in left more than once.
+    """
+    left_keys, right_keys = person_keys(left.index, right.index)
+    table = pd.Index(left_keys)
+    if not table.is_unique:
+        raise ValueError("The index of left has duplicate entries")
+    left_pos = table.get_indexer(right_keys)
+    right_pos = np.flatnonzero(left_pos >= 0)
+    return left_pos[right_pos], right_pos
+
+
+def person_keys(left, right):
+    """
+    Pack each entry of two (Multi)Indexes into a single int64, equal for
+    equal entries.
+
+    Each level is factorized over both indexes together and the codes
+    are packed side by side, each in as few bits as its number of
+    distinct values needs. For a month pair of ``HRHHID``, ``HRHHID2``,
+    ``PULINENO`` that's well under 64 bits, even though the raw ids
+    need more.
+
+    Parameters
+    ----------
+    left: Index
+    right: Index
+
+    Returns
+    -------
+    left_keys, right_keys: ndarray of int64
+    """
+    if left.nlevels != right.nlevels:
+        raise ValueError("left and right have a different number of "
+                         "index levels")
+    if (left.nlevels == 1 and pd.api.types.is_integer_dtype(left) and
+            pd.api.types.is_integer_dtype(right)):
+        # already a key
+        return (np.asarray(left).astype(np.int64, copy=False),
+                np.asarray(right).astype(np.int64, copy=False))
+    n = len(left)
+    keys = np.zeros(n + len(right), dtype=np.int64)
+    used = 0
+    for level in range(left.nlevels):
+        values = left.get_level_values(level).append(
+            right.get_level_values(level))
+        codes, uniques = pd.factorize(values)
+        # missing values get code -1, so shift everything up by one
+        bits = (len(uniques) + 1).bit_length()
+        used += bits
+        if used > 63:
+            raise ValueError("Too many distinct index values to pack "
+                             "into 64 bits")
+        keys <<= bits
+        keys |= codes + 1
+    return keys[:n], keys[n:]
+
+
+class _Aligned(object):
+    """
+    Column access to ``df`` reordered by ``positions``, for predicates.
+    Only the columns a predicate asks for are gathered.
+    """
+
+    def __init__(self, df, positions):
+        self.df = df
+        self.positions = positions
+
+    def __getitem__(self, col):
+        s = self.df[col]
+        if pd.api.types.is_numeric_dtype(s.dtype):
+            values = s.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            values = s.to_numpy(dtype=object)
+        return values[self.positions]
+
+
 def merge(dfs):
     """
     Adds the month in sample to the index. Concats along the 0 axis.
@@ -117,6 +466,24 @@ def match_race(left, right):
     return race_idx
 
 
+
+# Predicates for match_positions
+
+def age_matches(left, right):
+    age_diff = left['PRTAGE'] - right['PRTAGE']
+    return (age_diff > -1) & (age_diff < 3)
+
+
+def sex_matches(left, right):
+    return left['PESEX'] == right['PESEX']
+
+
+def race_matches(left, right):
+    return left['PTDTRACE'] == right['PTDTRACE']
+
+
+MATCH_PREDICATES = [age_matches, sex_matches, race_matches]
+
 #-----------------------------------------------------------------------------
 #
 
@@ -130,7 +497,10 @@ def make_wave_id(df):
     df: DataFrame
         a frame containing observations for specific wave.
     """
-    A = slice(None)
-    year, month = df.loc[(A, A, A, 1), :].iloc[0][['HRYEAR4', 'HRMONTH']]
-    df['wave_id'] = pd.Timestamp(datetime.datetime(year, month, 1))
+    # month in sample is the last level, whatever identifies people
+    first = df.index.get_level_values(-1) == 1
+    year, month = df.loc[first].iloc[0][['HRYEAR4', 'HRMONTH']]
+    # floats when read from a compact HDFStore
+    df['wave_id'] = pd.Timestamp(datetime.datetime(int(year), int(month),
+                                                   1))
     return df
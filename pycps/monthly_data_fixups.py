@@ -13,16 +13,62 @@ practice only kwargs should be used.
 They should all return a DataFrame.
 
 The functions will be applied in order.
+
+Fixups registered with the ``fixup`` decorator also declare which
+columns they read and write. ``parsers.fixup_by_dd`` hands those just
+the columns they read, copies back the ones they write, and skips them
+altogether if none of what they write was asked for. Registered fixups
+can be named in ``FIXUP_BY_DD`` by their name instead of the function.
+User supplied fixup files (``--monthly-data-fixups``) can use the same
+decorator:
+
+    from pycps.monthly_data_fixups import fixup
+
+    @fixup(reads=['PRTAGE'], writes=['PRTAGE'])
+    def topcode_age(df, *args, **kwargs):
+        df['PRTAGE'] = df['PRTAGE'].clip(upper=85)
+        return df
+
+    FIXUP_BY_DD = {'cpsm2009-01': [(topcode_age, {})]}
 """
+import re
+import string
 import logging
 
 import numpy as np
 import pandas as pd
 
+from pycps.compat import str_types
 
 logger = logging.getLogger(__name__)
 
+# name -> fixup, for every function decorated with ``fixup``
+REGISTRY = {}
+
 
+def fixup(reads, writes, name=None):
+    """
+    Register a fixup, declaring the columns it reads and writes.
+
+    Parameters
+    ----------
+    reads: list of str
+        the columns the fixup needs. It's called with a DataFrame of
+        just these, and must return one with the same rows.
+    writes: list of str
+        the columns it sets on that DataFrame
+    name: str, optional
+        the key in ``REGISTRY``; defaults to the function's name
+    """
+    def decorate(func):
+        func.reads = tuple(reads)
+        func.writes = tuple(writes)
+        REGISTRY[name or func.__name__] = func
+        return func
+    return decorate
+
+
+@fixup(reads=['HRSAMPLE', 'HRSERSUF', 'HUHHNUM'], writes=['HRHHID2'])
 def compute_hrhhid2(df, *args, **kwargs):
     """
     pre may2004 need to fill out the ids by creating HRHHID2 manually:
@@ -41,36 +87,61 @@ def compute_hrhhid2(df, *args, **kwargs):
          75        Household Number (HUHHNUM)
 
     NOTE: not documented but sersuf of -1 seems to map to '00'
+
+    That's ``sample * 1000 + sersuf * 10 + hhnum``, computed on integer
+    arrays. ``HRSAMPLE`` and ``HRSERSUF`` have only a handful of distinct
+    values, so just those are converted, and the suffix letters through
+    ``SERSUF_LUT``. People missing any part (or with a ``HUHHNUM`` of -1)
+    get a missing ``HRHHID2``.
     """
-    import string
+    sample = _by_unique(df['HRSAMPLE'], _sample_number)
+    sersuf = _by_unique(df['HRSERSUF'], _sersuf_number)
+    hhnum = df['HUHHNUM'].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    valid = (sample >= 0) & (sersuf >= 0) & (hhnum >= 0)
+    hrhhid2 = sample * 1000 + sersuf * 10 + np.where(valid, hhnum, 0)
+    hrhhid2 = hrhhid2.astype(np.int64)
+    if not valid.all():
+        logger.info("{} people with no HRHHID2".format((~valid).sum()))
+        hrhhid2 = np.where(valid, hrhhid2, np.nan)
+    df['HRHHID2'] = hrhhid2
+    return df
 
-    hrsample = df['HRSAMPLE'].str.extract(r'(\d+)')
-    hrsersuf = df['HRSERSUF'].astype(str)
 
-    huhhnum = df['HUHHNUM'].replace(-1, np.nan)
+# serial suffix letter (by byte) -> its number, A or a is 1; -1 for others
+SERSUF_LUT = np.full(256, -1, dtype=np.int64)
+SERSUF_LUT[np.frombuffer(string.ascii_letters.encode('ascii'),
+                         dtype=np.uint8)] = np.tile(np.arange(1, 27), 2)
 
-    to_drop = df[pd.isnull(huhhnum)]
-    if to_drop.shape[1] > 0:
-        logger.info("Dropping {}".format(to_drop.index))
-    huhhnum = huhhnum.dropna().astype(str)
 
-    sersuf_d = {a: str(ord(a.lower()) - 96).zfill(2) for a in hrsersuf.unique()
-                if a in list(string.ascii_letters)}
-    sersuf_d['-1.0'] = '00'
-    sersuf_d['-1'] = '00'
-    hrsersuf = hrsersuf.map(sersuf_d)  # 10x faster than replace
+def _by_unique(values, func):
+    """
+    Apply ``func`` to each distinct value of ``values``, returning an
+    int64 array with -1 where it's missing.
+    """
+    codes, uniques = pd.factorize(values)
+    table = np.array([func(x) for x in uniques] + [-1], dtype=np.int64)
+    return table[codes]             # code -1 (missing) takes the last
 
-    hrhhid2 = hrsample + hrsersuf + huhhnum
-    to_drop = df[pd.isnull(hrhhid2)]
-    if to_drop.shape[1] > 0:
-        logger.info("Dropping {}".format(to_drop.index))
 
-    hrhhid2 = hrhhid2.dropna()
-    df = df.copy()
-    df['HRHHID2'] = hrhhid2.str.strip('.0').astype(np.int64)
-    return df
+def _sample_number(x):
+    if isinstance(x, (int, np.integer, float, np.floating)):
+        return int(x) if x == x and x >= 0 else -1
+    match = re.search(r'\d+', str(x))
+    return int(match.group()) if match else -1
+
+
+def _sersuf_number(x):
+    if isinstance(x, str_types) and len(x) == 1:
+        return SERSUF_LUT[ord(x) & 0xff]
+    try:
+        # undocumented, but -1 seems to mean '00'
+        return 0 if float(x) == -1 else -1
+    except (TypeError, ValueError):
+        return -1
 
 
+@fixup(reads=['HRYEAR4'], writes=['HRYEAR4'])
 def year2_to_year4(df, *args, **kwargs):
     """
     Some years are encoded as two digits.
@@ -84,8 +155,8 @@ def year2_to_year4(df, *args, **kwargs):
     -------
     fixed : DataFrame
     """
-    prefix = str(kwargs.get('prefix', '19'))
-    df['HRYEAR4'] = (prefix + df.HRYEAR4.astype(str)).astype(np.int64)
+    prefix = int(kwargs.get('prefix', '19'))
+    df['HRYEAR4'] = prefix * 100 + df.HRYEAR4
     return df
 
 
@@ -2,26 +2,34 @@
 """
 Read all the things.
 """
+import io
 import os
 import re
+import bisect
+import pickle
 import json
+import time
 import zipfile
 import logging
 import importlib
 from pathlib import Path
-from functools import partial, wraps
+from functools import wraps
 from itertools import dropwhile
 from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
 
-import arrow
+import numpy as np
 import pandas as pd
 
-from pycps.compat import StringIO, str_types
+from pycps.compat import StringIO, str_types, replace
+from pycps.lzw import open_lzw
+from pycps.storage import get_storage
+from pycps.telemetry import note_transform
 
 #-----------------------------------------------------------------------------
 # Globals
 logger = logging.getLogger(__name__)
+_HERE_ = Path(__file__).parent
 
 #-----------------------------------------------------------------------------
 # Settings
@@ -151,6 +159,9 @@ class DDParser:
         path to HDFStore for output
     store_name:
         key to use inside HDFStore
+    storage: HDFStorage or ParquetStorage
+        where the parsed dictionaries are written, from
+        ``settings['storage']``
 
     Notes
     -----
@@ -182,6 +193,8 @@ class DDParser:
 
         self.store_path = settings['dd_store']
         self.store_name = infile.stem
+        self.storage = get_storage(self.store_path,
+                                   settings.get('storage', 'hdf'))
 
         # default to most recent
         self.style = styles.get(self.store_name, max(styles.values()))
@@ -325,7 +338,7 @@ class DDParser:
     def write(self, df):
         """
         Once you have all the dataframes, write them to that outfile,
-        an HDFStore.
+        an HDFStore (or whichever ``storage`` backend is configured).
 
         Parameters
         ----------
@@ -338,7 +351,14 @@ class DDParser:
         """
         logger.info("Writing {} to {}".format(self.store_name,
                                               self.store_path))
-        df.to_hdf(self.store_path, key=self.store_name, format='f')
+        self._write(df, self.store_name)
+
+    def _write(self, df, key):
+        # the compiled layout goes next to the store, so it's never
+        # older than the dictionary it came from
+        self.storage.write(df, key)
+        RecordLayout.from_dd(df).save(layout_path(self.store_path, key),
+                                      self.storage.stamp(key))
 
     @staticmethod
     def handle_replacers(id_):
@@ -380,7 +400,7 @@ class DDParser:
             assert self.is_consistent(new)
 
             # write this out.
-            new.to_hdf(self.store_path, key=key, format='f')
+            self._write(new, key)
 
             # fix original (for aug. thru oct. 2005)
             return formatted.loc[:376]
@@ -400,83 +420,706 @@ class DDParser:
 #-----------------------------------------------------------------------------
 # Monthly Data Files
 
+# bytes and powers of ten for decoding fixed width fields
+ZERO, SPACE, MINUS, NEWLINE, CARRIAGE_RETURN = map(ord, '0 -\n\r')
+POW10 = 10 ** np.arange(19, dtype=np.int64)
+FPOW10 = POW10.astype(np.float64)
+
+
+def _month_key(month):
+    """
+    Months since year 0 for ``month``: ``year * 12 + (month - 1)``.
+
+    Parameters
+    ----------
+    month: str, datetime-like, or Arrow
+        strings only need to contain a ``YYYY-MM``, so file names like
+        ``data/monthly/cpsm2009-01.zip`` work too.
+
+    Returns
+    -------
+    key: int
+    """
+    if isinstance(month, str_types):
+        match = MONTH_PAT.search(month)
+        if match is None:
+            raise ValueError("No YYYY-MM in {}".format(month))
+        year, month = map(int, match.groups())
+    else:
+        year, month = month.year, month.month
+    return year * 12 + month - 1
+
+
+def _load_dd_starts(info_path=_HERE_ / 'info.json'):
+    """
+    Sorted start months (see ``_month_key``) and names of the data
+    dictionaries in ``info.json``'s ``dd_to_month``.
+    """
+    with info_path.open() as f:
+        dd_to_month = json.load(f)['dd_to_month']
+    starts = sorted((_month_key(v[0]), k) for k, v in dd_to_month.items())
+    keys, names = zip(*starts)
+    return np.array(keys, dtype=np.int64), np.array(names, dtype=object)
+
+
+MONTH_PAT = re.compile(r'(\d{4})-(\d{2})')
+# A dictionary is in force from its first month until the next one starts.
+DD_STARTS, DD_NAMES = _load_dd_starts()
+
+
 def _month_to_dd(month):
     """
     lookup dd for a given month.
+
+    Parameters
+    ----------
+    month: str, datetime-like, or Arrow
+        anything ``_month_key`` takes
+
+    Returns
+    -------
+    dd_name: str
+    """
+    key = _month_key(month)
+    i = bisect.bisect_right(DD_STARTS, key) - 1
+    if i < 0:
+        raise KeyError("No data dictionary for {}".format(month))
+    return DD_NAMES[i]
+
+
+def _months_to_dd(months):
     """
-    dd_to_month = {"cpsm1989-01": ["1989-01", "1991-12"],
-                   "cpsm1992-01": ["1992-01", "1993-12"],
-                   "cpsm1994-01": ["1994-01", "1994-03"],
-                   "cpsm1994-04": ["1994-04", "1995-05"],
-                   "cpsm1995-06": ["1995-06", "1995-08"],
-                   "cpsm1995-09": ["1995-09", "1997-12"],
-                   "cpsm1998-01": ["1998-01", "2002-12"],
-                   "cpsm2003-01": ["2003-01", "2004-04"],
-                   "cpsm2004-05": ["2004-05", "2005-07"],
-                   "cpsm2005-08": ["2005-08", "2005-10"],
-                   "cpsm2005-11": ["2005-11", "2006-12"],
-                   "cpsm2007-01": ["2007-01", "2008-12"],
-                   "cpsm2009-01": ["2009-01", "2009-12"],
-                   "cpsm2010-01": ["2010-01", "2012-04"],
-                   "cpsm2012-05": ["2012-05", "2012-12"],
-                   "cpsm2013-01": ["2013-01", "2014-05"]}
-
-    def mk_range(v):
-        return arrow.Arrow.range(start=arrow.get(v[0]),
-                                 end=arrow.get(v[1]),
-                                 frame='month')
-
-    rngs = {k: mk_range(v) for k, v in dd_to_month.items()}
-
-    def isin(value, key):
-        return value in rngs[key]
-
-    f = partial(isin, arrow.get(month))
-    dd = filter(f, dd_to_month)
-    return list(dd)[0]
+    Vectorized ``_month_to_dd``.
+
+    Parameters
+    ----------
+    months: sequence of str, datetime-like, or Arrow, or a
+        DatetimeIndex / PeriodIndex
+
+    Returns
+    -------
+    dd_names: ndarray of str (object dtype)
+    """
+    if hasattr(months, 'year') and hasattr(months, 'month'):
+        keys = (np.asarray(months.year, dtype=np.int64) * 12 +
+                np.asarray(months.month, dtype=np.int64) - 1)
+    else:
+        keys = np.array([_month_key(x) for x in months], dtype=np.int64)
+    idx = np.searchsorted(DD_STARTS, keys, side='right') - 1
+    if (idx < 0).any():
+        raise KeyError("No data dictionary for {}".format(
+            np.asarray(months)[idx < 0][0]))
+    return DD_NAMES[idx]
 
 
 @contextmanager
-def ensure_cleanup_zip(archive, filename, parent_dir):
-    path = os.path.join(parent_dir, filename)
-    archive.extract(filename, path=parent_dir)
-    yield
-    os.remove(path)
+def open_monthly(infile):
+    """
+    Open a monthly data file for streaming, binary reads.
+
+    Nothing is extracted to disk: ``.zip`` archives are read from the
+    member stream and ``.Z`` files are decompressed in process.
+
+    Parameters
+    ----------
+    infile: str, Path, or StringIO
+
+    Returns
+    -------
+    f: binary file-like
+    """
+    if isinstance(infile, StringIO):
+        yield io.BytesIO(infile.getvalue().encode('latin_1'))
+        return
+
+    infile = str(infile)
+    if infile.endswith('.zip'):
+        with zipfile.ZipFile(infile) as archive:
+            filename = archive.namelist()[0]
+            with archive.open(filename) as f:
+                yield f
+    elif infile.endswith('.Z'):
+        with open_lzw(infile) as f:
+            yield f
+    else:
+        with open(infile, 'rb') as f:
+            yield f
 
 
-def read_monthly(infile, dd):
+def read_monthly(infile, dd, columns=None, chunksize=2 ** 16, compact=False):
     """
     Parameters
     ----------
 
     infile: str
-    dd: DataFrame
+    dd: DataFrame or RecordLayout
+        the data dictionary, or a layout compiled from one
+    columns: list of str, optional
+        ids from ``dd`` to read; defaults to every field in ``dd``.
+        Only the bytes belonging to these fields are decoded. Not
+        allowed with a ``RecordLayout``; use ``RecordLayout.select``.
+    chunksize: int
+        number of records to read from ``infile`` at a time
+    compact: bool
+        use the narrowest dtypes that can hold each field (see
+        ``plan_dtypes``) instead of ``int64`` / ``float64`` / ``object``
 
     Returns
     -------
     df: DataFrame
 
+    Notes
+    -----
+    The file is read as fixed width records straight into a ``uint8``
+    array and each field is decoded with vectorized arithmetic on its
+    columns. Fields that are entirely numeric come back as ``int64``
+    (``float64`` if some records are blank), others as strings. Like
+    ``read_fwf``, a field that is numeric in some chunks but not in
+    others ends up as an object column of mixed types.
+
+    With ``compact=True`` each chunk is narrowed as soon as it's decoded,
+    so the full width columns never exist for the whole file. Numeric
+    fields become ``int8`` through ``int64`` depending on their width,
+    or the matching nullable ``Int`` dtype if some records are blank.
+    String fields become categoricals.
     """
-    widths = dd.length.tolist()
     logger.info("Reading monthly {}".format(infile))
+    layout = _as_layout(dd, columns)
 
-    if isinstance(infile, StringIO):
-        df = pd.read_fwf(infile, widths=widths, names=dd.id.values)
-    elif infile.endswith('.zip'):
-        archive = zipfile.ZipFile(infile)
-        filename = archive.namelist()[0]
-        parent_dir = str(Path(infile).parent)
-        colspec = pd.concat([dd.start - 1, dd.end], axis=1)
-        colspec = colspec.values.tolist()
-
-        with ensure_cleanup_zip(archive, filename, parent_dir):
-            df = pd.read_fwf(os.path.join(parent_dir, filename),
-                             colspecs=colspec, names=dd.id.values)
-    # TODO: Fix stripping of 0s
+    parts = [[] for _ in layout.names]
+    for fields in _iter_fields(infile, layout, chunksize):
+        for part, values, dtype in zip(parts, fields, layout.dtypes):
+            if compact:
+                values = _narrow(values, dtype)
+            part.append(values)
+
+    fields = [_concat_fields(part) for part in parts]
+    if compact:
+        fields = [pd.Categorical(x) if x.dtype == object else x
+                  for x in fields]
+    return _frame(fields, layout.names)
+
+
+def iter_monthly(infile, dd, columns=None, chunksize=2 ** 16, compact=False):
+    """
+    Read ``infile`` ``chunksize`` records at a time, so only one chunk
+    of the month is ever in memory.
+
+    Parameters
+    ----------
+    infile, dd, columns, compact:
+        see ``read_monthly``
+    chunksize: int
+        number of records in each DataFrame
+
+    Yields
+    ------
+    df: DataFrame
+        the next ``chunksize`` records, with a default index continuing
+        from the last chunk
+
+    Notes
+    -----
+    A column's dtype can't depend on the rest of the file, so every
+    chunk gets the same dtypes: numeric fields are nullable ``Int64``
+    (as if some record were blank), or with ``compact=True`` the
+    nullable ``Int`` dtype from ``plan_dtypes``. String fields are
+    objects, not categoricals. A field that's numeric in some chunks and
+    not in others can't be written a chunk at a time; use
+    ``read_monthly``.
+    """
+    logger.info("Reading monthly {} in chunks of {}".format(infile,
+                                                           chunksize))
+    layout = _as_layout(dd, columns)
+    start = 0
+    for fields in _iter_fields(infile, layout, chunksize):
+        fields = [_stable(values, dtype if compact else np.int64)
+                  for values, dtype in zip(fields, layout.dtypes)]
+        df = _frame(fields, layout.names)
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+
+def stable_dtypes(df):
+    """
+    Cast the integer columns of a chunk from ``iter_monthly`` (say, ones
+    made by a fixup) to nullable ``Int64``, so that a column gets the
+    same dtype in every chunk whether or not that chunk had missing
+    values. Float columns holding only whole numbers (and NaN), like
+    ``HRHHID2`` from ``compute_hrhhid2``, are taken to be integers with
+    missing values. Nullable integer columns are left as they are.
+    """
+    for col, dtype in df.dtypes.items():
+        if not isinstance(dtype, np.dtype) or dtype.kind not in 'iuf':
+            continue
+        values = df[col].values
+        if dtype.kind == 'f':
+            missing = np.isnan(values)
+            if not (values[~missing] % 1 == 0).all():
+                continue
+            values = pd.arrays.IntegerArray(
+                np.where(missing, 0, values).astype(np.int64), missing)
+        df[col] = pd.array(values, dtype='Int64')
     return df
 
 
-def write_monthly(df, storepath, key):
+def _as_layout(dd, columns):
+    if isinstance(dd, RecordLayout):
+        if columns is not None:
+            raise ValueError("columns can't be given with a RecordLayout")
+        return dd
+    return plan_columns(dd, columns)
+
+
+def _iter_fields(infile, layout, chunksize):
+    """
+    Decode ``chunksize`` records at a time, yielding a list with an
+    array of values for each field in ``layout``.
+    """
+    offsets = layout.offsets
+    with open_monthly(infile) as f:
+        for records in _iter_records(f, layout.width, chunksize):
+            # a single pass copies out just the requested bytes, laid out
+            # field-major so each field's bytes are contiguous
+            packed = records.T[layout.gather]
+            yield [_decode_field(packed[offsets[i]:offsets[i + 1]])
+                   for i in range(len(layout))]
+
+
+def _frame(fields, names):
+    # keyed by position in case the dictionary repeats an id
+    df = pd.DataFrame(dict(enumerate(fields)), columns=range(len(fields)))
+    df.columns = names
+    return df
+
+
+def _stable(values, dtype):
+    """
+    Cast one chunk of a field to the dtype every chunk of it gets from
+    ``iter_monthly``: the nullable version of ``dtype``.
+    """
+    if values.dtype.kind not in 'if':
+        return values
+    values = _narrow(values, dtype)
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'i':
+        values = pd.arrays.IntegerArray(values,
+                                        np.zeros(len(values), dtype=bool))
+    return values
+
+
+# bump when RecordLayout changes, so layouts saved before are recompiled
+LAYOUT_VERSION = 2
+
+
+class RecordLayout(object):
+    """
+    Where each field of a data dictionary sits in a fixed width record,
+    compiled into the arrays ``read_monthly`` decodes with.
+
+    Parameters
+    ----------
+    names: array of str
+        the field ids
+    starts, ends: arrays of int
+        zero-based start (inclusive) and end (exclusive) of each field
+
+    Attributes
+    ----------
+    width: int
+        bytes needed to hold every field of a record
+    gather: array of int
+        positions within a record of the fields' bytes, field by field
+    offsets: array of int
+        where each field starts and ends among the gathered bytes
+    dtypes: list of numpy dtypes
+        what each field narrows to with ``compact=True``; see
+        ``plan_dtypes``
+
+    Notes
+    -----
+    Layouts are plain arrays, so they pickle small: that's what's sent
+    to the worker processes in ``api.parse``, and what ``DDParser``
+    saves at ``layout_path`` next to every dictionary it writes. Saved
+    layouts are tagged with ``LAYOUT_VERSION`` and the ``stamp`` of
+    the file their dictionary is stored in, and ``load`` only hands back
+    ones that match.
+    """
+
+    def __init__(self, names, starts, ends):
+        self.names = np.asarray(names, dtype=object)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.width = int(self.ends.max()) if len(self.ends) else 0
+        # positions of the requested bytes within a record, and where
+        # each field lands once they're gathered together
+        self.gather = _gather_indices(self.starts, self.ends)
+        self.offsets = np.cumsum(np.r_[0, self.ends - self.starts])
+        self.dtypes = [_int_dtype(w) for w in self.ends - self.starts]
+
+    @classmethod
+    def from_dd(cls, dd):
+        """
+        Compile the data dictionary ``dd`` (with ``id``, ``start`` and
+        ``end`` columns, ``start`` and ``end`` 1-based and inclusive).
+        """
+        return cls(dd.id.values, (dd.start - 1).values, dd.end.values)
+
+    @classmethod
+    def load(cls, path, stamp=None):
+        """
+        The layout saved at ``path``, or None if it can't be read, was
+        saved with another ``LAYOUT_VERSION``, or (given ``stamp``) its
+        dictionary's file has changed since.
+        """
+        try:
+            with open(str(path), 'rb') as f:
+                saved = pickle.load(f)
+        except Exception as e:
+            # unpickling something stale can raise nearly anything
+            logger.info("Can't load the layout at {}: {}".format(path, e))
+            return None
+        if (not isinstance(saved, dict) or
+                saved.get('version') != LAYOUT_VERSION):
+            logger.info("The layout at {} is from another version of "
+                        "pycps".format(path))
+            return None
+        if stamp is not None and saved.get('stamp') != list(stamp):
+            logger.info("The layout at {} is out of date".format(path))
+            return None
+        return saved['layout']
+
+    def save(self, path, stamp=None):
+        """
+        Pickle the layout to ``path``, tagged with ``LAYOUT_VERSION`` and
+        the ``Storage.stamp`` of the dictionary it was compiled from.
+        """
+        path = Path(path)
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        tmp = path.parent / (path.name + '.part')
+        with tmp.open('wb') as f:
+            pickle.dump({'version': LAYOUT_VERSION,
+                         'stamp': None if stamp is None else list(stamp),
+                         'layout': self}, f, protocol=2)
+        replace(str(tmp), str(path))
+
+    def select(self, columns):
+        """
+        The layout of just ``columns``, in dictionary order.
+        Raises ValueError if any aren't in the dictionary.
+        """
+        missing = set(columns) - set(self.names)
+        if missing:
+            raise ValueError("IDs {} are not in the Data "
+                             "Dictionary".format(missing))
+        keep = np.in1d(self.names, list(columns))
+        return RecordLayout(self.names[keep], self.starts[keep],
+                            self.ends[keep])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "RecordLayout({} fields, {} bytes)".format(len(self),
+                                                          self.width)
+
+
+def plan_columns(dd, columns=None):
+    """
+    The ``RecordLayout`` of ``columns`` (default all) from the data
+    dictionary ``dd``.
+    """
+    layout = RecordLayout.from_dd(dd)
+    return layout if columns is None else layout.select(columns)
+
+
+def layout_path(dd_store, dd_name):
+    """
+    Where the compiled layout of ``dd_name`` is saved: a ``.layouts``
+    directory next to ``dd_store``.
+    """
+    return Path(str(dd_store).rstrip('/') + '.layouts') / (dd_name + '.pkl')
+
+
+class PlanCache(object):
+    """
+    Compiled ``RecordLayout``s of the data dictionaries in ``storage``,
+    and of each set of columns read with them, each made once.
+
+    About 16 dictionaries cover every month since 1989, so parsing many
+    months mostly hits the cache. A layout saved by ``DDParser`` at
+    ``layout_path`` is loaded instead of compiling it again, as long as
+    it was saved by this version of pycps and the file the dictionary is
+    in hasn't changed since (going by its ``Storage.stamp``, so the
+    dictionary itself isn't read). Otherwise it's compiled and saved
+    again.
+
+    Parameters
+    ----------
+    storage: Storage
+        where the parsed data dictionaries are
+
+    Examples
+    --------
+    >>> plans = PlanCache(get_storage(settings['dd_store']))
+    >>> layout = plans.plan('cpsm2009-01', ['HRHHID', 'PRTAGE'])
+    >>> df = read_monthly('cpsm2009-02.zip', layout)
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.dds = {}
+        self.layouts = {}
+        self.plans = {}
+
+    def dd(self, dd_name):
+        if dd_name not in self.dds:
+            self.dds[dd_name] = self.storage.read(dd_name)
+        return self.dds[dd_name]
+
+    def layout(self, dd_name):
+        if dd_name not in self.layouts:
+            stamp = self.storage.stamp(dd_name)
+            path = layout_path(self.storage.path, dd_name)
+            layout = None
+            if path.exists():
+                layout = RecordLayout.load(path, stamp)
+            if layout is None:
+                layout = RecordLayout.from_dd(self.dd(dd_name))
+                try:
+                    layout.save(path, stamp)
+                except (IOError, OSError) as e:
+                    logger.warning("Couldn't save the layout of {}: "
+                                   "{}".format(dd_name, e))
+            self.layouts[dd_name] = layout
+        return self.layouts[dd_name]
+
+    def plan(self, dd_name, columns=None):
+        key = (dd_name, None if columns is None else tuple(columns))
+        if key not in self.plans:
+            layout = self.layout(dd_name)
+            self.plans[key] = (layout if columns is None
+                               else layout.select(columns))
+        return self.plans[key]
+
+
+def _gather_indices(starts, ends):
+    ranges = [np.arange(start, end) for start, end in zip(starts, ends)]
+    return np.concatenate(ranges + [np.array([], dtype=np.intp)])
+
+
+def _iter_records(f, width, chunksize):
+    """
+    Read newline terminated, fixed width records from the binary
+    file-like ``f``.
+
+    Yields 2-D ``uint8`` arrays of up to ``chunksize`` records, one row
+    per record and at least ``width`` columns. Well formed files are
+    viewed with a constant stride, without splitting lines; short or
+    ragged records fall back to padding each line out to ``width``.
+    Blank lines, and lines of only whitespace, are skipped.
+    """
+    first = f.readline()
+    while first and not first.strip():
+        first = f.readline()
+    if not first:
+        return
+
+    stride = len(first)
+    data = first + f.read(stride * chunksize - stride)
+    while data:
+        n = len(data) // stride
+        tail = data[n * stride:]
+        records = np.frombuffer(data, dtype=np.uint8, count=n * stride)
+        records = records.reshape(n, stride)
+
+        if stride > width and (records[:, -1] == NEWLINE).all():
+            records = _drop_blank(records)
+        else:
+            tail = data[data.rfind(b'\n') + 1:]
+            records = _pad_records(data[:len(data) - len(tail)], width)
+        if len(records):
+            yield records
+
+        more = f.read(stride * chunksize)
+        if not more:
+            if tail.strip():
+                yield _pad_records(tail, width)
+            break
+        data = tail + more
+
+
+def _drop_blank(records):
+    """
+    ``records`` without the ones that are all whitespace. Only records
+    starting with a blank are looked at in full.
+    """
+    maybe = np.flatnonzero(records[:, 0] == SPACE)
+    if not len(maybe):
+        return records
+    content = records[maybe, :-1]
+    blank = ((content == SPACE) | (content == CARRIAGE_RETURN)).all(axis=1)
+    if not blank.any():
+        return records
+    return np.delete(records, maybe[blank], axis=0)
+
+
+def _pad_records(data, width):
+    lines = [line[:width].ljust(width) for line in data.splitlines()
+             if line.strip()]
+    records = np.frombuffer(b''.join(lines), dtype=np.uint8)
+    return records.reshape(len(lines), width)
+
+
+def _decode_field(raw):
+    """
+    Decode one field from a 2-D array of ASCII bytes, with one row per
+    character position and one column per record.
+
+    Right-justified integers (optionally negative) are converted in bulk
+    with a dot product against powers of ten. Fields with any other
+    content, like the letter codes in ``HRSERSUF``, or wider than the 18
+    digits an ``int64`` always holds, go through the slower
+    ``_decode_strings``.
+    """
+    w, n = raw.shape
+    if w > 18:
+        return _decode_strings(raw)
+    digits = raw - ZERO             # non-digits wrap around past 9
+    is_digit = digits < 10
+    is_blank = raw == SPACE
+    is_sign = raw == MINUS
+
+    # right-justified: blanks, an optional sign, then digits. So only
+    # a blank may come before a non-digit, and nothing else is allowed.
+    if (not (is_digit | is_blank | is_sign).all() or
+            (~is_blank[:-1] & ~is_digit[1:]).any() or
+            is_sign[-1].any()):
+        return _decode_strings(raw)
+
+    digits *= is_digit
+    if w <= 15:
+        # exact in float64 and far faster than an integer dot product
+        values = FPOW10[w - 1::-1].dot(digits)
+    else:
+        values = POW10[w - 1::-1].dot(digits.astype(np.int64))
+
+    negative = is_sign.any(axis=0)
+    if negative.any():
+        values[negative] *= -1
+
+    missing = is_blank[-1]
+    if missing.any():
+        values = values.astype(np.float64)
+        values[missing] = np.nan
+    else:
+        values = values.astype(np.int64)
+    return values
+
+
+def plan_dtypes(dd):
+    """
+    The narrowest integer dtype that can hold every value of each field
+    in ``dd``, going by the field's width: up to 2 digits fit in an
+    ``int8``, 4 in an ``int16``, 9 in an ``int32``.
+
+    Parameters
+    ----------
+    dd: DataFrame
+        data dictionary with ``start`` and ``end`` columns
+
+    Returns
+    -------
+    dtypes: list of numpy dtypes, one per row of ``dd``
+    """
+    return [_int_dtype(w) for w in (dd.end - dd.start + 1).values]
+
+
+def _int_dtype(width):
+    for dtype in (np.int8, np.int16, np.int32):
+        if 10 ** int(width) - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _narrow(values, dtype):
+    """
+    Cast one chunk of a decoded field to ``dtype``. Integral floats with
+    missing values become a nullable integer array; anything else that
+    isn't integral is left alone.
+    """
+    if values.dtype.kind == 'i':
+        return values.astype(dtype)
+    if values.dtype.kind == 'f':
+        missing = np.isnan(values)
+        if (values[~missing] % 1 == 0).all():
+            filled = np.where(missing, 0, values).astype(dtype)
+            return pd.arrays.IntegerArray(filled, missing)
+    return values
+
+
+def _concat_fields(parts):
+    if not parts:
+        return np.array([], dtype=np.int64)
+    if any(part.dtype == object for part in parts):
+        parts = [np.asarray(part, dtype=object) for part in parts]
+    elif any(isinstance(part, pd.arrays.IntegerArray) for part in parts):
+        return _concat_nullable(parts)
+    return np.concatenate(parts)
+
+
+def _concat_nullable(parts):
+    """
+    Join chunks from ``_narrow`` where some were nullable. They're all
+    of the same integer dtype unless one had fractions, in which case
+    the field is float64.
+    """
+    if any(part.dtype.kind == 'f' for part in parts):
+        return np.concatenate([
+            part.to_numpy(dtype=np.float64, na_value=np.nan)
+            if isinstance(part, pd.arrays.IntegerArray) else part
+            for part in parts])
+
+    values, masks = [], []
+    for part in parts:
+        if isinstance(part, pd.arrays.IntegerArray):
+            masks.append(np.asarray(part.isna()))
+            part = part.to_numpy(dtype=part.dtype.numpy_dtype, na_value=0)
+        else:
+            masks.append(np.zeros(len(part), dtype=bool))
+        values.append(part)
+    return pd.arrays.IntegerArray(np.concatenate(values),
+                                  np.concatenate(masks))
+
+
+def _decode_strings(raw):
+    """
+    Slow path for fields that aren't right-justified integers. Only the
+    distinct values are decoded.
+    """
+    w, n = raw.shape
+    values = np.ascontiguousarray(raw.T).view('S{}'.format(w)).ravel()
+    uniques, inverse = np.unique(values, return_inverse=True)
+    uniques = np.array([x.decode('latin_1').strip() or np.nan
+                        for x in uniques.tolist()], dtype=object)
+    try:
+        floats = uniques.astype(np.float64)
+    except ValueError:
+        return uniques[inverse]
+    if (np.abs(floats[~np.isnan(floats)]) >= 2 ** 53).any():
+        # too big to be exact as floats: int64s if they fit, else text
+        try:
+            return np.array([int(x) for x in uniques],
+                            dtype=np.int64)[inverse]
+        except (ValueError, OverflowError):
+            return uniques[inverse]
+    if not np.isnan(floats).any() and (floats % 1 == 0).all():
+        floats = floats.astype(np.int64)
+    return floats[inverse]
+
+
+def write_monthly(df, storepath, key, storage='hdf', by_mis=False):
     """
     Add a monthly datafile to the store.
 
@@ -484,17 +1127,42 @@ def write_monthly(df, storepath, key):
     ----------
     storepath: str
     key: name in store
+    storage: {'hdf', 'parquet'}
+        backend to write with; see ``pycps.storage``
+    by_mis: bool
+        split the month by month in sample, so that
+        ``read_rotation_group`` only reads the rows it returns
 
     Returns
     -------
     None: IO
 
     """
-    logger.info("Writing {} to {}".format(key, storepath))
-    df.to_hdf(storepath, key=key, format='f')
+    get_storage(storepath, storage, by_mis=by_mis).write(df, key)
+
+
+def read_rotation_group(storepath, key, mis, columns=None, storage='hdf'):
+    """
+    Read the people in their ``mis``-th month in sample from a month
+    written by ``write_monthly``.
 
+    Parameters
+    ----------
+    storepath: str
+    key: name in store
+    mis: int or list of int
+    columns: list of str, optional
+    storage: {'hdf', 'parquet'}
 
-def fixup_by_dd(df, fixups):
+    Returns
+    -------
+    df: DataFrame
+    """
+    return get_storage(storepath, storage).read_rotation_group(
+        key, mis, columns=columns)
+
+
+def fixup_by_dd(df, fixups, columns=None):
     """
     Fixup *data* by Data Dictionary.
 
@@ -504,29 +1172,76 @@ def fixup_by_dd(df, fixups):
     fixups: [(function, {kwargs})], a list of tuples of functions
         and dictionaries mapping kwargs to values for that function.
         Fixups should come from pycps.monthly_data_fixups or
-        a user supplied file.
+        a user supplied file. Registered fixups may be given by name.
+    columns: list of str, optional
+        the columns wanted in the end. Registered fixups that don't
+        write any of them are skipped.
 
     Returns
     -------
     fixed : DataFrame
+
+    Notes
+    -----
+    Fixups registered with ``monthly_data_fixups.fixup`` are called with
+    a frame of only the columns they read, sharing its data with ``df``,
+    and only the columns they write are put back. Others get all of
+    ``df``.
     """
-    for func, kwargs in fixups:
-        df = func(df, **kwargs)
+    for func, kwargs in resolve_fixups(fixups):
+        reads = getattr(func, 'reads', None)
+        writes = getattr(func, 'writes', None)
+        timed = log_transform('monthly data')(func)
+        if reads is None or writes is None:
+            df = timed(df, **kwargs)
+            continue
+
+        if columns is not None and not set(writes) & set(columns):
+            logger.info("Skipping {}; nothing it writes is "
+                        "wanted".format(func.__name__))
+            continue
+        missing = set(reads) - set(df.columns)
+        if missing:
+            raise KeyError("{} reads {}, which aren't in the "
+                           "data".format(func.__name__, sorted(missing)))
+        out = timed(df[list(reads)].copy(deep=False), **kwargs)
+        for col in writes:
+            df[col] = out[col]
 
     return df
 
 
+def resolve_fixups(fixups):
+    """
+    Look up fixups given by name in ``monthly_data_fixups.REGISTRY``.
+    """
+    from pycps.monthly_data_fixups import REGISTRY
+
+    resolved = []
+    for func, kwargs in fixups or []:
+        if isinstance(func, str_types):
+            try:
+                func = REGISTRY[func]
+            except KeyError:
+                raise KeyError("No fixup named {}".format(func))
+        resolved.append((func, kwargs))
+    return resolved
+
+
 def log_transform(obj_name):
     """
     Log that the object `obj_name` is being transformed by the function being
-    decorated.
+    decorated. The time it takes is added to the record being measured,
+    if any (see ``telemetry.measure``).
     """
     def decorate(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             logger.info("Transforming {} via {}".format(obj_name,
                                                         func.__name__))
+            t0 = time.time()
             result = func(*args, **kwargs)
+            note_transform(func.__name__, time.time() - t0)
             return result
         return wrapper
     return decorate
@@ -0,0 +1,676 @@
+# -*- coding: utf-8 -*-
+"""
+Where parsed frames are kept.
+
+Two backends, picked by the ``storage`` setting:
+
+- ``hdf`` (default): one fixed format HDFStore, one key per month.
+- ``parquet``: a directory with one Parquet file per month, partitioned
+  like ``year=2009/month=01/cpsm2009-01.parquet``. Reads can select
+  columns and filter on ``HRMIS`` without loading the whole month, and
+  separate months can be read concurrently.
+
+Both take keys named like ``cpsmYYYY-MM`` and hand back DataFrames
+with the index they were written with. ``catalog`` describes what's
+stored (columns, dtypes and number of rows for each key) from metadata
+alone, without reading any data: HDF keys carry it as an attribute
+written alongside the frame, and Parquet files have it in their footer.
+``read_rotation_group`` gets just the people in a given month in
+sample. For HDF that's only cheap
+with ``by_mis=True``, which writes each month as eight keys, one per
+``HRMIS``, or for a table from ``writer``, which PyTables filters on
+``HRMIS`` as it reads; Parquet files are always laid out so it's cheap.
+
+A month too big to hold in memory can be written a chunk at a time with
+``writer``: as an appendable ``table`` in the HDFStore, or as a row
+group at a time in Parquet.
+"""
+import os
+import re
+import json
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from pycps.compat import replace
+
+logger = logging.getLogger(__name__)
+
+KEY_PAT = re.compile(r'cpsm(\d{4})-(\d{2})$')
+
+
+def get_storage(path, kind='hdf', by_mis=False):
+    """
+    Storage backend for ``path``.
+
+    Parameters
+    ----------
+    path: str or Path
+        the HDFStore file, or the root directory for Parquet
+    kind: {'hdf', 'parquet'}
+    by_mis: bool
+        write each month split by month in sample (HDF only; see
+        ``HDFStorage``)
+
+    Returns
+    -------
+    storage: HDFStorage or ParquetStorage
+    """
+    try:
+        backend = BACKENDS[kind]
+    except KeyError:
+        raise ValueError("storage must be one of {}. Got {} "
+                         "instead.".format(sorted(BACKENDS), kind))
+    return backend(path, by_mis=by_mis)
+
+
+class Storage(object):
+    """
+    Methods shared by the backends.
+    """
+
+    def columns(self, key):
+        """
+        Names of the columns stored under ``key``.
+        Raises KeyError if there's no ``key``.
+        """
+        return self.describe(key)['columns']
+
+    def read_rotation_group(self, key, mis, columns=None):
+        """
+        Read the people in ``key`` who are in their ``mis``-th month
+        in sample.
+
+        Parameters
+        ----------
+        key: str
+        mis: int or list of int
+        columns: list of str, optional
+
+        Returns
+        -------
+        df: DataFrame
+        """
+        return self.read(key, columns=columns, mis=mis)
+
+    def writer(self, key, widths=None):
+        """
+        Write ``key`` a chunk at a time.
+
+        Parameters
+        ----------
+        key: str
+        widths: dict, optional
+            the most characters in each string column, needed up front
+            by HDF tables
+
+        Returns
+        -------
+        writer: context manager
+            giving a function to call with each chunk. Every chunk must
+            have the same columns and dtypes. If the block raises,
+            nothing partly written is left under ``key``.
+
+        Examples
+        --------
+        >>> with store.writer('cpsm2009-01') as append:
+        ...     for chunk in parsers.iter_monthly(infile, dd):
+        ...         append(chunk)
+        """
+        raise NotImplementedError
+
+
+class HDFStorage(Storage):
+    """
+    Months as keys in a fixed format HDFStore.
+
+    Fixed format stores can only be read whole, so ``columns`` and
+    ``mis`` are applied after reading. With ``by_mis=True`` months are
+    written as eight keys instead, ``<key>/mis1`` through ``<key>/mis8``,
+    and a read for some months in sample only touches those keys. Rows
+    without a valid ``HRMIS`` go in ``<key>/mis0``, with a warning.
+    Both layouts can be read whatever ``by_mis`` is.
+    """
+
+    def __init__(self, path, by_mis=False):
+        self.path = str(path)
+        self.by_mis = by_mis
+
+    def keys(self):
+        if not Path(self.path).exists():
+            return []
+        with pd.HDFStore(self.path, mode='r') as store:
+            keys = [MIS_PAT.sub('', k.lstrip('/')) for k in store.keys()]
+        return sorted(set(keys), key=keys.index)
+
+    def catalog(self):
+        """
+        Describe every key in the store. See ``describe``.
+
+        Returns
+        -------
+        catalog: dict
+            key -> {'columns': [...], 'dtypes': [...], 'rows': int}
+        """
+        if not Path(self.path).exists():
+            return {}
+        return self._describe(self.keys())
+
+    def describe(self, key):
+        """
+        Columns, dtypes and number of rows stored under ``key``, read
+        from the key's attributes. Raises KeyError if there's no ``key``.
+
+        Keys written before there were attributes are read in full the
+        first time they're described, and the attribute is added then.
+        """
+        if not Path(self.path).exists():
+            raise KeyError(key)
+        return self._describe([key])[key]
+
+    def nbytes(self, key):
+        """
+        Bytes taken by the data stored under ``key``, in either layout.
+        Raises KeyError if there's no ``key``.
+        """
+        if not Path(self.path).exists():
+            raise KeyError(key)
+        with pd.HDFStore(self.path, mode='r') as store:
+            node = store.get_node(key)
+            if node is None:
+                raise KeyError(key)
+            return sum(_leaf_nbytes(leaf)
+                       for leaf in node._f_walknodes('Leaf'))
+
+    def stamp(self, key):
+        """
+        Size and modification time of the file ``key`` is stored in,
+        which changes whenever it's written to. Every key in the store
+        shares the one file, and ``key`` isn't looked for.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            raise KeyError(key)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def write(self, df, key):
+        logger.info("Writing {} to {}".format(key, self.path))
+        df = _to_numpy_dtypes(df)
+        with pd.HDFStore(self.path) as store:
+            self._remove(store, key)
+            if not self.by_mis:
+                store.put(key, df, format='f')
+            else:
+                for part, rows in _split_by_mis(df, key):
+                    store.put(part, rows, format='f')
+            _set_entry(store, key, _describe(df))
+
+    def read(self, key, columns=None, mis=None):
+        """
+        Read ``key``.
+
+        Parameters
+        ----------
+        key: str
+        columns: list of str, optional
+            subset of columns to return (not including the index)
+        mis: int or list of int, optional
+            only return rows with these months in sample (``HRMIS``)
+
+        Returns
+        -------
+        df: DataFrame
+        """
+        if not Path(self.path).exists():
+            raise KeyError(key)
+        with pd.HDFStore(self.path, mode='r') as store:
+            parts = self._parts(store, key)
+            if not parts:
+                if mis is None:
+                    df = store.select(key)
+                elif store.get_storer(key).is_table:
+                    # written by ``writer``, with HRMIS as a data column
+                    df = store.select(key, where='HRMIS in {}'.format(
+                        [int(x) for x in _as_list(mis)]))
+                else:
+                    df = store.select(key)
+                    df = df[df['HRMIS'].isin(_as_list(mis))]
+            else:
+                if mis is not None:
+                    parts = [_mis_key(key, k) for k in _as_list(mis)]
+                df = pd.concat([store.select(part) for part in parts])
+            entry = getattr(store.get_node(key)._v_attrs, CATALOG_ATTR, None)
+        if columns is not None:
+            df = df[list(columns)]
+        if entry is not None:
+            df = _restore_ints(df, json.loads(entry))
+        return df
+
+    @contextmanager
+    def writer(self, key, widths=None):
+        logger.info("Writing {} to {} in chunks".format(key, self.path))
+        widths = widths or {}
+        with pd.HDFStore(self.path) as store:
+            self._remove(store, key)
+            log = {'first': None, 'rows': 0, 'ints': None,
+                   'missing': set()}
+
+            def append(df):
+                # nullable ints are stored as floats; note which ever
+                # had missing values, the rest are read back as ints
+                if log['ints'] is None:
+                    log['ints'] = _nullable_ints(df)
+                log['missing'].update(name for name in log['ints']
+                                      if _values(df, name).isnull().any())
+                df = _to_numpy_dtypes(df)
+                if log['first'] is None:
+                    log['first'] = df.iloc[:0]
+                log['rows'] += len(df)
+                # blanks are stored as the string 'nan'
+                sizes = dict((c, max(widths[c], 3)) for c in df.columns
+                             if c in widths and df[c].dtype == object)
+                data_columns = ['HRMIS'] if 'HRMIS' in df.columns else None
+                if not self.by_mis:
+                    parts = [(key, df)]
+                else:
+                    parts = [(part, rows) for part, rows
+                             in _split_by_mis(df, key) if len(rows)]
+                for part, chunk in parts:
+                    store.append(part, chunk, format='t',
+                                 data_columns=data_columns,
+                                 min_itemsize=sizes or None)
+
+            try:
+                yield append
+            except Exception:
+                self._remove(store, key)
+                raise
+
+            if log['first'] is None:
+                return
+            if self.by_mis:
+                # empty frames don't make tables; fill in the gaps
+                for mis in MIS:
+                    if _mis_key(key, mis) not in store:
+                        store.put(_mis_key(key, mis), log['first'],
+                                  format='f')
+            entry = _describe(log['first'])
+            entry['rows'] = log['rows']
+            ints = dict((name, dtype) for name, dtype in log['ints'].items()
+                        if name not in log['missing'])
+            entry['dtypes'] = [ints.get(col, dtype) for col, dtype
+                               in zip(entry['columns'], entry['dtypes'])]
+            entry['index_dtypes'] = dict(
+                (name, ints[name]) for name in log['first'].index.names
+                if name in ints)
+            _set_entry(store, key, entry)
+
+    def _remove(self, store, key):
+        # whichever layout is there
+        for part in self._parts(store, key) + ['/' + key]:
+            if part in store:
+                store.remove(part)
+
+    def _describe(self, keys):
+        """
+        Catalog entries for ``keys``. Keys without one are read, and
+        their entries recorded so the next call doesn't have to.
+        """
+        entries, missing = {}, []
+        with pd.HDFStore(self.path, mode='r') as store:
+            for key in keys:
+                node = store.get_node(key)
+                if node is None:
+                    raise KeyError(key)
+                entry = getattr(node._v_attrs, CATALOG_ATTR, None)
+                if entry is not None:
+                    entries[key] = json.loads(entry)
+                    continue
+                logger.info("No catalog entry for {}, reading it".format(key))
+                parts = self._parts(store, key) or [key]
+                entries[key] = _describe(pd.concat([store.select(part)
+                                                    for part in parts]))
+                missing.append(key)
+        if missing:
+            self._backfill(dict((key, entries[key]) for key in missing))
+        return entries
+
+    def _backfill(self, entries):
+        try:
+            with pd.HDFStore(self.path, mode='a') as store:
+                for key, entry in entries.items():
+                    _set_entry(store, key, entry)
+        except (IOError, OSError, ValueError) as e:
+            # a read-only store still works, just slowly
+            logger.warning("Couldn't record catalog entries in {}: "
+                           "{}".format(self.path, e))
+
+    @staticmethod
+    def _parts(store, key):
+        """
+        The ``<key>/misN`` keys if ``key`` was written ``by_mis``,
+        otherwise an empty list. ``<key>/mis0`` is only there if some
+        rows had no valid month in sample.
+        """
+        if store.get_node(_mis_key(key, MIS[0])) is None:
+            return []
+        parts = [_mis_key(key, mis) for mis in MIS]
+        if store.get_node(_mis_key(key, 0)) is not None:
+            parts.append(_mis_key(key, 0))
+        return parts
+
+
+MIS = list(range(1, 9))
+MIS_PAT = re.compile(r'/mis\d$')
+CATALOG_ATTR = 'pycps_catalog'
+
+
+def _set_entry(store, key, entry):
+    setattr(store.get_node(key)._v_attrs, CATALOG_ATTR, json.dumps(entry))
+
+
+def _describe(df):
+    return {'columns': [str(c) for c in df.columns],
+            'dtypes': [str(d) for d in df.dtypes],
+            'rows': len(df)}
+
+
+def _leaf_nbytes(leaf):
+    try:
+        return leaf.size_on_disk
+    except NotImplementedError:
+        # object columns are VLArrays, which only know their data's size
+        return leaf.size_in_memory
+
+
+def _mis_key(key, mis):
+    return '/{}/mis{}'.format(key, mis)
+
+
+def _split_by_mis(df, key):
+    """
+    ``(<key>/misN, rows)`` for each month in sample, and for the rows
+    without a valid one (``HRMIS`` missing or not 1-8), which are kept
+    under ``<key>/mis0`` rather than dropped.
+    """
+    positions = df.groupby('HRMIS').indices
+    none = np.array([], dtype=np.intp)
+    parts = [(_mis_key(key, mis), df.take(positions.get(mis, none)))
+             for mis in MIS]
+    other = ~df['HRMIS'].isin(MIS).values
+    if other.any():
+        logger.warning("{} rows of {} have no valid HRMIS; keeping them "
+                       "in {}".format(other.sum(), key, _mis_key(key, 0)))
+        parts.append((_mis_key(key, 0), df[other]))
+    return parts
+
+
+def _as_list(mis):
+    return [mis] if np.ndim(mis) == 0 else list(mis)
+
+
+def _is_nullable_int(dtype):
+    return (isinstance(dtype, pd.api.extensions.ExtensionDtype) and
+            pd.api.types.is_integer_dtype(dtype))
+
+
+def _float_dtype(dtype):
+    # float32 is exact for the up to 4 digit values in Int8 and Int16
+    return np.float32 if dtype.itemsize <= 2 else np.float64
+
+
+def _values(df, name):
+    if name in df.columns:
+        return df[name]
+    return df.index.get_level_values(name)
+
+
+def _nullable_ints(df):
+    """
+    The nullable integer columns and index levels of ``df``, with the
+    NumPy dtype each would have if nothing were missing.
+    """
+    names = list(df.columns) + list(df.index.names)
+    dtypes = list(df.dtypes) + [df.index.get_level_values(i).dtype
+                                for i in range(df.index.nlevels)]
+    return dict((name, dtype.numpy_dtype.name)
+                for name, dtype in zip(names, dtypes)
+                if _is_nullable_int(dtype))
+
+
+def _to_numpy_dtypes(df):
+    """
+    HDFStores can't hold categoricals or nullable integers (from
+    ``read_monthly(compact=True)`` or ``iter_monthly``). Store them as
+    object and float columns (or index levels) instead.
+    """
+    converted = {}
+    for col, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            converted[col] = df[col].astype(object)
+        elif _is_nullable_int(dtype):
+            converted[col] = df[col].to_numpy(dtype=_float_dtype(dtype),
+                                              na_value=np.nan)
+    levels = [df.index.get_level_values(i) for i in range(df.index.nlevels)]
+    index = None
+    if any(_is_nullable_int(level.dtype) for level in levels):
+        index = pd.MultiIndex.from_arrays(
+            [level.to_numpy(dtype=_float_dtype(level.dtype), na_value=np.nan)
+             if _is_nullable_int(level.dtype) else level for level in levels],
+            names=df.index.names)
+        if df.index.nlevels == 1:
+            index = index.get_level_values(0)
+    if not converted and index is None:
+        return df
+    df = df.copy()
+    for col, values in converted.items():
+        df[col] = values
+    if index is not None:
+        df.index = index
+    return df
+
+
+def _restore_ints(df, entry):
+    """
+    Cast the float columns and index levels that ``writer`` stored for
+    nullable integers without missing values back to integers, going
+    by the dtypes in the catalog ``entry``.
+    """
+    def wanted(dtype, values):
+        return dtype.startswith(('int', 'uint')) and values.dtype.kind == 'f'
+
+    casts = dict((col, dtype) for col, dtype
+                 in zip(entry['columns'], entry['dtypes'])
+                 if col in df.columns and wanted(dtype, df[col]))
+    if casts:
+        df = df.astype(casts)
+    index_dtypes = entry.get('index_dtypes', {})
+    levels = [df.index.get_level_values(i) for i in range(df.index.nlevels)]
+    if any(wanted(index_dtypes.get(level.name, ''), level)
+           for level in levels):
+        levels = [level.astype(index_dtypes[level.name])
+                  if wanted(index_dtypes.get(level.name, ''), level)
+                  else level for level in levels]
+        index = pd.MultiIndex.from_arrays(levels, names=df.index.names)
+        df.index = index if len(levels) > 1 else index.get_level_values(0)
+    return df
+
+
+def _numpy_ints(schema):
+    """
+    ``schema`` with its pandas metadata giving NumPy dtypes for the
+    nullable integer columns, which pyarrow reads as ``float64`` where
+    there are nulls.
+    """
+    metadata = schema.pandas_metadata
+    for column in metadata['columns']:
+        if (column['numpy_type'].startswith(('Int', 'UInt')) and
+                column['pandas_type'].startswith(('int', 'uint'))):
+            column['numpy_type'] = column['pandas_type']
+    return schema.with_metadata({b'pandas': json.dumps(metadata).encode()})
+
+
+class ParquetStorage(Storage):
+    """
+    Months as Parquet files under a ``year=YYYY/month=MM`` directory tree.
+
+    Rows are written sorted by ``HRMIS`` (when there is one), in row
+    groups of ``row_group_size``, so that a filter on ``HRMIS`` can skip
+    most of a file from the row group statistics alone. That's always
+    the layout, so ``by_mis`` is accepted but doesn't change anything.
+    """
+    row_group_size = 2 ** 14
+
+    def __init__(self, path, by_mis=False):
+        try:
+            import pyarrow           # noqa
+        except ImportError:
+            raise ImportError("The parquet storage backend requires pyarrow")
+        self.path = Path(path)
+
+    def _path(self, key):
+        match = KEY_PAT.match(key)
+        if match is None:
+            raise ValueError("Expected a key like cpsmYYYY-MM. "
+                             "Got {} instead.".format(key))
+        year, month = match.groups()
+        return (self.path / 'year={}'.format(year) /
+                'month={}'.format(month) / (key + '.parquet'))
+
+    def keys(self):
+        files = self.path.glob('year=*/month=*/*.parquet')
+        return sorted(p.stem for p in files)
+
+    def catalog(self):
+        """
+        Describe every file in the store. See ``describe``.
+        """
+        return {key: self.describe(key) for key in self.keys()}
+
+    def describe(self, key):
+        """
+        Columns, dtypes and number of rows stored under ``key``, read
+        from the file's footer. Raises KeyError if there's no ``key``.
+        """
+        import pyarrow.parquet as pq
+
+        path = self._path(key)
+        if not path.exists():
+            raise KeyError(key)
+        metadata = pq.read_metadata(str(path))
+        schema = metadata.schema.to_arrow_schema()
+        pandas_metadata = schema.pandas_metadata
+        index = [x for x in pandas_metadata['index_columns']
+                 if isinstance(x, str)]
+        dtypes = {c['field_name']: c['numpy_type']
+                  for c in pandas_metadata['columns']}
+        columns = [x for x in schema.names if x not in index]
+        return {'columns': columns,
+                'dtypes': [dtypes.get(c, 'object') for c in columns],
+                'rows': metadata.num_rows}
+
+    def stamp(self, key):
+        """
+        Size and modification time of ``key``'s file. Raises KeyError
+        if there's no ``key``.
+        """
+        try:
+            stat = self._path(key).stat()
+        except OSError:
+            raise KeyError(key)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def nbytes(self, key):
+        """
+        Size of ``key``'s file. Raises KeyError if there's no ``key``.
+        """
+        path = self._path(key)
+        if not path.exists():
+            raise KeyError(key)
+        return path.stat().st_size
+
+    def write(self, df, key):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = self._path(key)
+        logger.info("Writing {} to {}".format(key, path))
+        if 'HRMIS' in df.columns:
+            df = df.sort_values('HRMIS', kind='mergesort')
+        table = pa.Table.from_pandas(df)
+
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        tmp = path.parent / (path.name + '.part')
+        pq.write_table(table, str(tmp), row_group_size=self.row_group_size)
+        replace(str(tmp), str(path))
+
+    @contextmanager
+    def writer(self, key, widths=None):
+        """
+        Write ``key`` a row group at a time. Each chunk is sorted by
+        ``HRMIS`` before it's written, so row group statistics still
+        let reads skip most of the other months in sample.
+
+        Nullable integer columns (and index levels) are recorded as
+        NumPy ones, so that like a month written all at once they're
+        read as integers, or as floats where values are missing.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = self._path(key)
+        logger.info("Writing {} to {} in chunks".format(key, path))
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        tmp = path.parent / (path.name + '.part')
+        state = {'writer': None}
+
+        def append(df):
+            if 'HRMIS' in df.columns:
+                df = df.sort_values('HRMIS', kind='mergesort')
+            writer = state['writer']
+            if writer is None:
+                schema = _numpy_ints(pa.Table.from_pandas(df).schema)
+                writer = state['writer'] = pq.ParquetWriter(str(tmp), schema)
+            table = pa.Table.from_pandas(df, schema=writer.schema)
+            writer.write_table(table, row_group_size=self.row_group_size)
+
+        try:
+            yield append
+        except Exception:
+            if state['writer'] is not None:
+                state['writer'].close()
+                tmp.unlink()
+            raise
+
+        if state['writer'] is not None:
+            state['writer'].close()
+            replace(str(tmp), str(path))
+
+    def read(self, key, columns=None, mis=None):
+        """
+        Read ``key``. See ``HDFStorage.read``.
+
+        Only ``columns`` (and the index) are deserialized, and the
+        ``mis`` filter is pushed down to the Parquet reader.
+        """
+        import pyarrow.parquet as pq
+
+        path = self._path(key)
+        if not path.exists():
+            raise KeyError(key)
+        filters = None if mis is None else [('HRMIS', 'in', _as_list(mis))]
+        table = pq.read_table(str(path), columns=columns, filters=filters,
+                              use_pandas_metadata=True)
+        df = table.to_pandas()
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+
+BACKENDS = {'hdf': HDFStorage, 'parquet': ParquetStorage}
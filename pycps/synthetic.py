@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Make up monthly files that look like the real ones.
+
+Given a data dictionary, as returned by ``DDParser.run``, and a number
+of households, ``write_month`` writes a zipped fixed-width file like
+NBER's ``jan98pub.zip``. It can be read by ``parsers.read_monthly`` and
+``api.parse`` like a downloaded month.
+
+The same households come back month after month. Each month has eight
+rotation groups. The group in its ``HRMIS``-th month started
+``merge.PANEL_OFFSETS[HRMIS - 1]`` months earlier. A household's ids, and
+the age, sex, and race of each person in it, are a hash of the seed, the
+start of its panel, and its position in that panel. So every month that
+household is in agrees, and ``api.merge`` has people to match. To get
+match rates more like the real thing, some households don't respond in a
+given month (``nonresponse``), and some people have their sex miscoded
+(``miscoded``).
+
+Nothing is kept between chunks, so a month of any size is written in
+memory proportional to ``chunksize``.
+
+Examples
+--------
+>>> dd = DDParser('cpsm2014-01.ddf', settings, info).run()
+>>> write_months('data/monthly', dd, pd.period_range('2014-01', '2015-04',
+...                                                  freq='M'),
+...              households=60000)
+"""
+import zlib
+import logging
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pycps.merge import PANEL_OFFSETS
+from pycps.parsers import ZERO, SPACE, NEWLINE
+
+logger = logging.getLogger(__name__)
+
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+_SHIFTS = [np.uint64(x) for x in (11, 27, 30, 31)]
+
+# the most digits a made up value has; leading digits of wider fields
+# are zeros
+MAX_DIGITS = 9
+
+
+def write_month(path, dd, month, households, seed=0, nonresponse=0.1,
+                miscoded=0.01, chunksize=2 ** 14):
+    """
+    Write a synthetic month to a zip archive at ``path``.
+
+    Parameters
+    ----------
+    path: str or Path
+    dd: DataFrame
+        data dictionary with ``id``, ``length``, ``start`` and ``end``
+        columns
+    month: str or Period
+    households: int
+        number of households asked to respond; about an eighth of them
+        in each rotation group
+    seed: int
+        different seeds give different households
+    nonresponse: float
+        chance a household is missing from a month
+    miscoded: float
+        chance a person's sex is wrong in a month
+    chunksize: int
+        number of households generated at a time
+
+    Returns
+    -------
+    records: int
+        number of records written
+    """
+    month = pd.Period(month, freq='M')
+    member = month.strftime('%b%ypub.dat').lower()
+    chunks = iter_month(dd, month, households, seed=seed,
+                        nonresponse=nonresponse, miscoded=miscoded,
+                        chunksize=chunksize)
+    logger.info("Writing synthetic {} to {}".format(month, path))
+    # made up digits barely compress, so don't try hard
+    n = 0
+    with zipfile.ZipFile(str(path), 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True, compresslevel=1) as archive:
+        with archive.open(member, 'w', force_zip64=True) as f:
+            for chunk in chunks:
+                f.write(chunk.tobytes())
+                n += len(chunk)
+    return n
+
+
+def write_months(directory, dd, months, households, **kwargs):
+    """
+    ``write_month`` for each of ``months``, named like downloaded months
+    (``cpsm2014-01.zip``) in ``directory``.
+
+    Returns
+    -------
+    paths: list of Path
+    """
+    directory = Path(directory)
+    if not directory.exists():
+        directory.mkdir(parents=True)
+    paths = []
+    for month in months:
+        month = pd.Period(month, freq='M')
+        path = directory / month.strftime('cpsm%Y-%m.zip')
+        write_month(path, dd, month, households, **kwargs)
+        paths.append(path)
+    return paths
+
+
+def iter_month(dd, month, households, seed=0, nonresponse=0.1,
+               miscoded=0.01, chunksize=2 ** 14):
+    """
+    The records of a synthetic month, in chunks.
+
+    Yields
+    ------
+    records: ndarray
+        2-D ``uint8``, one newline terminated record per row
+    """
+    month = pd.Period(month, freq='M')
+    dd = dd.drop_duplicates('id')
+    width = int(dd.end.max())
+    per_group = -(-households // len(PANEL_OFFSETS))
+    for mis, offset in enumerate(PANEL_OFFSETS, 1):
+        start = month - offset
+        for lo in range(0, per_group, chunksize):
+            hh = np.arange(lo, min(lo + chunksize, per_group),
+                           dtype=np.int64)
+            people = _people(hh, start, month, mis, seed, nonresponse,
+                             miscoded)
+            if len(people['PULINENO']):
+                yield _records(dd, width, people, month, mis)
+
+
+def _people(hh, start, month, mis, seed, nonresponse, miscoded):
+    """
+    Everyone in households ``hh`` of the panel starting in ``start``
+    that responded in ``month``.
+    """
+    panel = start.ordinal
+    responded = _uniform(_hash(seed, panel, hh, month.ordinal)) >= nonresponse
+    hh = hh[responded]
+
+    h = _hash(seed, panel, hh)
+    size = (1 + h % np.uint64(4)).astype(np.int64)
+    first = np.cumsum(size) - size
+    line = np.arange(size.sum()) - np.repeat(first, size) + 1
+    sample = 1 + h % np.uint64(99)
+    sersuf = 1 + (h >> _SHIFTS[1]) % np.uint64(26)
+    hhnum = 1 + (h >> _SHIFTS[2]) % np.uint64(9)
+
+    person = np.repeat(hh, size)
+    p = _hash(seed, panel, person, line)
+    sex = 1 + (p % np.uint64(2)).astype(np.int64)
+    flip = _uniform(_hash(seed, panel, person, line, month.ordinal)) < miscoded
+    sex[flip] = 3 - sex[flip]
+    return {
+        'HRHHID': 10 ** 14 + (panel % 10 ** 4) * 10 ** 10 + person,
+        'HRHHID2': np.repeat((sample * 1000 + sersuf * 10 +
+                              hhnum).astype(np.int64), size),
+        'HRSAMPLE': np.repeat(sample.astype(np.int64), size),
+        'HRSERSUF': np.repeat(sersuf.astype(np.int64), size),
+        'HUHHNUM': np.repeat(hhnum.astype(np.int64), size),
+        'PULINENO': line,
+        'PRTAGE': ((p >> _SHIFTS[0]) % np.uint64(91)).astype(np.int64),
+        'PESEX': sex,
+        'PTDTRACE': 1 + ((p >> _SHIFTS[3]) % np.uint64(21)).astype(np.int64),
+        '_key': _hash(seed, panel, person, line, month.ordinal),
+    }
+
+
+def _records(dd, width, people, month, mis):
+    n = len(people['PULINENO'])
+    out = np.full((n, width + 1), SPACE, dtype=np.uint8)
+    out[:, -1] = NEWLINE
+    for id_, start, end in zip(dd.id, dd.start, dd.end):
+        w = end - start + 1
+        field = out[:, start - 1:end]
+        if id_ == 'HRSAMPLE':
+            # letter codes like 'A55'
+            _put_digits(field[:, 1:], people['HRSAMPLE'], w - 1)
+            field[:, 0] = ord('A')
+        elif id_ == 'HRSERSUF':
+            field[:, 0] = ord('A') - 1 + people['HRSERSUF']
+        elif id_ in people:
+            _put_digits(field, people[id_], w)
+        elif id_ == 'HRYEAR4':
+            _put_digits(field, np.full(n, month.year), w)
+        elif id_ == 'HRMONTH':
+            _put_digits(field, np.full(n, month.month), w)
+        elif id_ == 'HRMIS':
+            _put_digits(field, np.full(n, mis), w)
+        else:
+            key = zlib.crc32(id_.encode('utf-8')) & 0xffffffff
+            values = _mix(people['_key'] ^ np.uint64(key)) % np.uint64(
+                10 ** min(w, MAX_DIGITS))
+            _put_digits(field, values.astype(np.int64), w)
+    return out
+
+
+def _put_digits(field, values, w):
+    """
+    Write ``values`` into ``field``, right-justified and zero-padded to
+    ``w`` digits. Wider values are truncated to their last ``w`` digits.
+    """
+    k = min(w, 18)      # the most that fit in an int64
+    powers = 10 ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    field[:, w - k:] = (np.asarray(values)[:, None] // powers) % 10 + ZERO
+    field[:, :w - k] = ZERO
+
+
+def _hash(*keys):
+    """
+    Hash integer keys (scalars or arrays) to ``uint64``, elementwise.
+    """
+    h = np.uint64(0)
+    for key in keys:
+        key = np.asarray(key, dtype=np.int64).astype(np.uint64)
+        h = _mix(h ^ key)
+    return h
+
+
+def _mix(x):
+    # splitmix64's finalizer
+    with np.errstate(over='ignore'):
+        x = x + _GOLDEN
+        x = (x ^ (x >> _SHIFTS[2])) * _MIX1
+        x = (x ^ (x >> _SHIFTS[1])) * _MIX2
+    return x ^ (x >> _SHIFTS[3])
+
+
+def _uniform(h):
+    """
+    ``uint64`` hashes to floats in [0, 1).
+    """
+    return (h >> _SHIFTS[0]).astype(np.float64) * 2.0 ** -53
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Machine readable timings for each stage, and each file or panel in it.
+
+Each unit of work (a download, a parsed file, a merged panel) gets a
+record. A record holds:
+
+- ``wall_seconds`` and ``cpu_seconds``
+- ``bytes_read`` and ``bytes_written``
+- ``records``: rows decoded or written
+- ``peak_rss_bytes``
+- ``cache``: ``'hit'`` if cached output was used, else ``'miss'``
+- ``transforms``: seconds spent in each function decorated with
+  ``parsers.log_transform``, by function name
+
+Every stage also gets a record with ``item`` set to None. It holds the
+totals for the stage, its cache ``hits`` and ``misses``, and the time
+and CPU of the whole stage, including the CPU of any worker processes.
+Its ``kind`` says whether dictionaries or data were worked on.
+
+Records are appended to ``settings['telemetry']``, one JSON object per
+line. If ``settings['telemetry_prometheus']`` is set, the totals for
+each stage are also written there in Prometheus' text format, for node
+exporter's textfile collector. The file is rewritten after every stage.
+
+Unknown values are None: a cached month has no timings, and a merged
+panel doesn't know how many bytes it read.
+
+``peak_rss_bytes`` is the peak of the process that did the work over
+its lifetime so far, not just while doing that unit. That's what the
+OS tracks, and it's what matters for sizing workers.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+from pycps.compat import replace
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ['time', 'stage', 'item', 'pid', 'wall_seconds', 'cpu_seconds',
+          'peak_rss_bytes', 'bytes_read', 'bytes_written', 'records',
+          'cache', 'transforms']
+# summed over a stage's items
+TOTALS = ['bytes_read', 'bytes_written', 'records']
+
+_local = threading.local()
+
+
+def make_record(stage, item=None, **fields):
+    """
+    A record for ``stage`` and ``item``, with None for what isn't known.
+    """
+    record = dict.fromkeys(FIELDS)
+    record.update(stage=stage, item=item, pid=os.getpid(), **fields)
+    return record
+
+
+@contextmanager
+def measure(stage, item=None, **fields):
+    """
+    Time the work done in the block, in this process.
+
+    Yields the record, for the caller to fill in what it knows (like
+    ``bytes_read``). The timings are added on the way out.
+
+    Examples
+    --------
+    >>> with measure('parse', 'cpsm2009-01', cache='miss') as record:
+    ...     df = read_monthly(path, dd)
+    ...     record['records'] = len(df)
+    """
+    record = make_record(stage, item, transforms={}, **fields)
+    stack = _stack()
+    stack.append(record)
+    wall, cpu = time.time(), time.process_time()
+    try:
+        yield record
+    finally:
+        stack.pop()
+        record['wall_seconds'] = time.time() - wall
+        record['cpu_seconds'] = time.process_time() - cpu
+        record['peak_rss_bytes'] = peak_rss()
+        record['time'] = _now()
+
+
+def note_transform(name, seconds):
+    """
+    Add ``seconds`` spent in ``name`` to the innermost ``measure``d
+    record in this thread, if there is one.
+    """
+    stack = _stack()
+    if stack:
+        transforms = stack[-1]['transforms']
+        transforms[name] = transforms.get(name, 0) + seconds
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None where
+    that isn't available.
+    """
+    if resource is None:
+        return None
+    return _rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+class Telemetry(object):
+    """
+    Where records go.
+
+    Parameters
+    ----------
+    path: str, optional
+        JSON lines file to append records to. Without one, records
+        are dropped.
+    prometheus: str, optional
+        file to write stage totals to in Prometheus' text format
+
+    Notes
+    -----
+    ``emit`` may be called from several threads. Records from worker
+    processes should be returned to the process that owns this object
+    and emitted there.
+    """
+
+    def __init__(self, path=None, prometheus=None):
+        self.path = path
+        self.prometheus = prometheus
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._current = None
+
+    def emit(self, record):
+        with self._lock:
+            if self._current is not None:
+                _add(self._current, record)
+            if self.path is None:
+                return
+            _ensure_parent(self.path)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    @contextmanager
+    def stage(self, stage, kind=None):
+        """
+        Measure a whole stage. Every record emitted in the block is
+        added to its totals, and the stage's own record is emitted on
+        the way out.
+
+        Parameters
+        ----------
+        stage: str
+            like ``'parse'``
+        kind: str, optional
+            what's being worked on, like ``'dictionary'`` or ``'data'``
+        """
+        children = _children_usage()
+        with measure(stage, kind=kind, hits=0, misses=0,
+                     **dict.fromkeys(TOTALS, 0)) as record:
+            self._current = record
+            try:
+                yield record
+            finally:
+                self._current = None
+        # worker processes count once they've finished
+        cpu, rss = _children_usage()
+        record['cpu_seconds'] += cpu - children[0]
+        if rss is not None:
+            record['peak_rss_bytes'] = max(record['peak_rss_bytes'], rss)
+        self.emit(record)
+        self.stages[stage, kind] = record
+        if self.prometheus is not None:
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        """
+        Write the totals of each stage measured so far.
+        """
+        metrics = [
+            ('wall_seconds', 'Wall time of the last run.'),
+            ('cpu_seconds', 'CPU time of the last run, with workers.'),
+            ('peak_rss_bytes', 'Peak resident set size.'),
+            ('bytes_read', 'Bytes read.'),
+            ('bytes_written', 'Bytes written.'),
+            ('records', 'Records decoded or written.'),
+            ('hits', 'Items taken from the cache.'),
+            ('misses', 'Items (re)built.'),
+        ]
+        lines = []
+        for name, doc in metrics:
+            metric = 'pycps_stage_' + name
+            lines.append('# HELP {} {}'.format(metric, doc))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for (stage, kind), record in sorted(self.stages.items(),
+                                                key=lambda x: str(x[0])):
+                value = record.get(name)
+                if value is None:
+                    continue
+                labels = 'stage="{}"'.format(stage)
+                if kind is not None:
+                    labels += ',kind="{}"'.format(kind)
+                lines.append('{}{{{}}} {}'.format(metric, labels, value))
+        _ensure_parent(self.prometheus)
+        tmp = self.prometheus + '.part'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        replace(tmp, self.prometheus)
+
+
+def open_telemetry(settings):
+    """
+    A ``Telemetry`` writing where ``settings`` say, if anywhere.
+    """
+    return Telemetry(settings.get('telemetry'),
+                     settings.get('telemetry_prometheus'))
+
+
+def _add(totals, record):
+    for field in TOTALS:
+        totals[field] += record.get(field) or 0
+    if record.get('cache') == 'hit':
+        totals['hits'] += 1
+    elif record.get('cache') == 'miss':
+        totals['misses'] += 1
+    for name, seconds in (record.get('transforms') or {}).items():
+        totals['transforms'][name] = (totals['transforms'].get(name, 0) +
+                                      seconds)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _children_usage():
+    if resource is None:
+        return 0, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, _rss_bytes(usage.ru_maxrss)
+
+
+def _rss_bytes(maxrss):
+    # kilobytes, except on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _ensure_parent(path):
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
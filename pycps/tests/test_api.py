@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import logging
+import zipfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import pandas.util.testing as tm
+
+from pycps import api
+from pycps import merge as m
+from pycps import synthetic as s
+from pycps.storage import get_storage
+
+logging.disable(logging.CRITICAL)
+
+
+def _skip_if_no_tables():
+    try:
+        import tables
+    except ImportError:
+        import nose
+        raise(nose.SkipTest("tables not installed"))
+
+
+def _square(x):
+    return x * x
+
+
+class TestMapMonths(unittest.TestCase):
+
+    def test_bounded(self):
+        submitted = []
+
+        def todo():
+            for i in range(20):
+                submitted.append(i)
+                yield (i,)
+
+        results = []
+        for result in api._map_months(_square, todo(), jobs=2):
+            results.append(result)
+            # at most 2 * jobs taken from todo and not yet handed back
+            self.assertLessEqual(len(submitted) - len(results), 4)
+        self.assertEqual(sorted(results), [i * i for i in range(20)])
+
+    def test_serial(self):
+        result = list(api._map_months(_square, [(1,), (2,)], jobs=1))
+        self.assertEqual(result, [1, 4])
+
+
+class TestParse(unittest.TestCase):
+
+    def setUp(self):
+        _skip_if_no_tables()
+        self.tmpdir = os.path.abspath('_testapi_')
+        monthly = os.path.join(self.tmpdir, 'monthly')
+        os.makedirs(monthly)
+
+        self.dd = pd.DataFrame([['HRHHID', 15, 1, 15],
+                                ['HRHHID2', 5, 16, 20],
+                                ['PULINENO', 2, 21, 22],
+                                ['HRMIS', 1, 23, 23],
+                                ['PRTAGE', 2, 24, 25]],
+                               columns=['id', 'length', 'start', 'end'])
+        self.settings = {
+            'dd_store': os.path.join(self.tmpdir, 'dds.hdf'),
+            'monthly_path': monthly,
+            'monthly_store': os.path.join(self.tmpdir, 'monthly.hdf'),
+            'info': os.path.join(self.tmpdir, 'info.json'),
+            'info_path': os.path.join(self.tmpdir, 'info.json'),
+            'FIXUP_BY_DD': {'cpsm2009-01': []},
+        }
+        self.dd.to_hdf(self.settings['dd_store'], key='cpsm2009-01',
+                       format='f')
+        with open(self.settings['info'], 'w') as f:
+            json.dump({'columns_by_dd':
+                       {'cpsm2009-01': list(self.dd.id.values)}}, f)
+
+        # HRHHID, HRHHID2, PULINENO, HRMIS, PRTAGE
+        rows = {'cpsm2009-02': ['000000000000001' '65001' '01' '1' '24',
+                                '000000000000002' '65001' '02' '2' '25'],
+                'cpsm2009-03': ['000000000000001' '65001' '01' '2' '24',
+                                '000000000000003' '65001' '02' '8' '81']}
+        for month, lines in rows.items():
+            path = os.path.join(monthly, month + '.zip')
+            with zipfile.ZipFile(path, 'w') as archive:
+                archive.writestr('pub.dat', '\n'.join(lines) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        store_path = self.settings['monthly_store']
+        return {k: pd.read_hdf(store_path, key=k)
+                for k in ['cpsm2009-02', 'cpsm2009-03']}
+
+    def test_parse_jobs(self):
+        api.parse('data', self.settings)
+        expected = self._read()
+        os.remove(self.settings['monthly_store'])
+
+        api.parse('data', self.settings, jobs=2)
+        result = self._read()
+        for k in expected:
+            tm.assert_frame_equal(result[k], expected[k])
+
+        df = result['cpsm2009-03']
+        self.assertEqual(df.index.names, api.ID_COLS)
+        self.assertEqual(df['PRTAGE'].tolist(), [24, 81])
+
+    def test_parse_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            import nose
+            raise(nose.SkipTest("pyarrow not installed"))
+
+        api.parse('data', self.settings)
+        expected = self._read()
+
+        self.settings['storage'] = 'parquet'
+        self.settings['dd_store'] = os.path.join(self.tmpdir, 'dds')
+        self.settings['monthly_store'] = os.path.join(self.tmpdir, 'parquet')
+        get_storage(self.settings['dd_store'], 'parquet').write(
+            self.dd, 'cpsm2009-01')
+        api.parse('data', self.settings)
+
+        store = get_storage(self.settings['monthly_store'], 'parquet')
+        self.assertEqual(store.keys(), ['cpsm2009-02', 'cpsm2009-03'])
+        for k in expected:
+            tm.assert_frame_equal(store.read(k).sort_index(),
+                                  expected[k].sort_index())
+
+    def test_parse_compact(self):
+        self.settings['compact_dtypes'] = True
+        api.parse('data', self.settings)
+        df = self._read()['cpsm2009-03']
+        self.assertEqual(df['PRTAGE'].dtype, np.int8)
+        self.assertEqual(df['PRTAGE'].tolist(), [24, 81])
+        self.assertEqual(df.index.get_level_values('HRHHID').dtype, np.int64)
+
+    def test_parse_packed(self):
+        self.settings['packed_person_id'] = True
+        api.parse('data', self.settings)
+        df = self._read()['cpsm2009-03']
+        self.assertEqual(df.index.names, ['HRHHID', 'PERSONID'])
+        self.assertEqual(df.index.tolist(), [(1, 65001 << 8 | 1),
+                                             (3, 65001 << 8 | 2)])
+        self.assertEqual(df['PRTAGE'].tolist(), [24, 81])
+
+        # table format HDF can index the packed levels too
+        os.remove(self.settings['monthly_store'])
+        self.settings['parse_chunksize'] = 1
+        api.parse('data', self.settings)
+        result = self._read()['cpsm2009-03']
+        self.assertEqual(result.index.tolist(), df.index.tolist())
+
+    def test_parse_chunked(self):
+        api.parse('data', self.settings)
+        expected = self._read()
+        os.remove(self.settings['monthly_store'])
+
+        self.settings['parse_chunksize'] = 1
+        api.parse('data', self.settings, jobs=2)
+        store = get_storage(self.settings['monthly_store'])
+        for k in expected:
+            tm.assert_frame_equal(store.read(k), expected[k])
+
+    def test_parse_manifest(self):
+        self.settings['manifest'] = os.path.join(self.tmpdir, 'manifest.json')
+        api.parse('data', self.settings)
+        store_path = self.settings['monthly_store']
+        mtime = os.path.getmtime(store_path)
+        with open(self.settings['manifest']) as f:
+            artifacts = json.load(f)['artifacts']
+        self.assertEqual(sorted(artifacts),
+                         ['monthly/cpsm2009-02', 'monthly/cpsm2009-03'])
+
+        # nothing changed
+        api.parse('data', self.settings)
+        self.assertEqual(os.path.getmtime(store_path), mtime)
+
+        # a new fixup for the dictionary reparses both months
+        def add_one(df, *args, **kwargs):
+            df['PRTAGE'] = df['PRTAGE'] + 1
+            return df
+
+        self.settings['FIXUP_BY_DD'] = {'cpsm2009-01': [(add_one, {})]}
+        api.parse('data', self.settings)
+        self.assertEqual(self._read()['cpsm2009-03']['PRTAGE'].tolist(),
+                         [25, 82])
+
+        # and a changed raw file only that month
+        path = os.path.join(self.settings['monthly_path'], 'cpsm2009-02.zip')
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('pub.dat', '000000000000001' '65001' '01' '1'
+                                        '30\n')
+        api.parse('data', self.settings)
+        with open(self.settings['manifest']) as f:
+            result = json.load(f)['artifacts']
+        self.assertNotEqual(result['monthly/cpsm2009-02'],
+                            artifacts['monthly/cpsm2009-02'])
+        self.assertEqual(self._read()['cpsm2009-02']['PRTAGE'].tolist(),
+                         [31])
+
+    def test_parse_telemetry(self):
+        self.settings['telemetry'] = os.path.join(self.tmpdir, 'tm.jsonl')
+        self.settings['telemetry_prometheus'] = os.path.join(self.tmpdir,
+                                                             'tm.prom')
+
+        def add_one(df, *args, **kwargs):
+            df['PRTAGE'] = df['PRTAGE'] + 1
+            return df
+
+        self.settings['FIXUP_BY_DD'] = {'cpsm2009-01': [(add_one, {})]}
+        api.parse('data', self.settings)
+
+        with open(self.settings['telemetry']) as f:
+            records = [json.loads(line) for line in f]
+        months, stage = records[:-1], records[-1]
+        self.assertEqual(sorted(x['item'] for x in months),
+                         ['cpsm2009-02', 'cpsm2009-03'])
+        for record in months:
+            self.assertEqual(record['stage'], 'parse')
+            self.assertEqual(record['cache'], 'miss')
+            self.assertEqual(record['records'], 2)
+            self.assertGreater(record['bytes_read'], 0)
+            self.assertGreater(record['bytes_written'], 0)
+            self.assertEqual(list(record['transforms']), ['add_one'])
+        self.assertIsNone(stage['item'])
+        self.assertEqual(stage['kind'], 'data')
+        self.assertEqual(stage['records'], 4)
+        self.assertEqual((stage['hits'], stage['misses']), (0, 2))
+
+        with open(self.settings['telemetry_prometheus']) as f:
+            prom = f.read()
+        self.assertIn('pycps_stage_records{stage="parse",kind="data"} 4',
+                      prom)
+
+        # cached the second time around
+        api.parse('data', self.settings)
+        with open(self.settings['telemetry']) as f:
+            stage = [json.loads(line) for line in f][-1]
+        self.assertEqual((stage['hits'], stage['misses']), (2, 0))
+
+    def test_parse_by_mis(self):
+        self.settings['partition_by_mis'] = True
+        api.parse('data', self.settings)
+        store = get_storage(self.settings['monthly_store'])
+        self.assertEqual(sorted(store.keys()), ['cpsm2009-02', 'cpsm2009-03'])
+        df = store.read_rotation_group('cpsm2009-03', 8)
+        self.assertEqual(df['PRTAGE'].tolist(), [81])
+
+
+class TestParseMergeChunked(unittest.TestCase):
+    """
+    Parsing a chunk at a time gives the same monthly data, and so the
+    same merged panels, as parsing a month at a time.
+    """
+
+    def setUp(self):
+        _skip_if_no_tables()
+        self.tmpdir = os.path.abspath('_testapichunked_')
+        os.makedirs(self.tmpdir)
+        # before 2004-05: HRHHID2 is made by a fixup
+        fields = [('HRHHID', 15), ('HRSAMPLE', 4), ('HRSERSUF', 2),
+                  ('HUHHNUM', 2), ('PULINENO', 2), ('HRMIS', 2),
+                  ('HRYEAR4', 4), ('HRMONTH', 2), ('PRTAGE', 2),
+                  ('PESEX', 2), ('PTDTRACE', 2)]
+        widths = np.array([w for _, w in fields])
+        ends = np.cumsum(widths)
+        self.dd = dd = pd.DataFrame(
+            {'id': [x for x, _ in fields], 'length': widths,
+             'start': ends - widths + 1, 'end': ends},
+            columns=['id', 'length', 'start', 'end'])
+        monthly = os.path.join(self.tmpdir, 'monthly')
+        self.settings = {
+            'dd_store': os.path.join(self.tmpdir, 'dds.hdf'),
+            'monthly_path': monthly,
+            'info': os.path.join(self.tmpdir, 'info.json'),
+            'info_path': os.path.join(self.tmpdir, 'info.json'),
+            'FIXUP_BY_DD': {'cpsm1998-01': [('compute_hrhhid2', {})]},
+            'date_start': '1998-01',
+            'date_end': '1998-03',
+        }
+        dd.to_hdf(self.settings['dd_store'], key='cpsm1998-01', format='f')
+        with open(self.settings['info'], 'w') as f:
+            json.dump({'columns_by_dd': {'cpsm1998-01': list(dd.id)}}, f)
+        months = pd.period_range('1998-01', '1999-05', freq='M')
+        paths = s.write_months(monthly, dd, months, households=16)
+
+        # a household without a number, so without an HRHHID2
+        with zipfile.ZipFile(str(paths[0])) as archive:
+            member = archive.namelist()[0]
+            lines = archive.read(member).decode('ascii').splitlines()
+        start = int(dd.set_index('id').loc['HUHHNUM', 'start']) - 1
+        lines[0] = lines[0][:start] + '-1' + lines[0][start + 2:]
+        with zipfile.ZipFile(str(paths[0]), 'w') as archive:
+            archive.writestr(member, '\n'.join(lines) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _parse_and_merge(self, name, **options):
+        settings = dict(self.settings, **options)
+        settings['monthly_store'] = os.path.join(self.tmpdir, name)
+        settings['merged_store'] = os.path.join(self.tmpdir,
+                                                'merged_' + name)
+        api.parse('data', settings)
+        api.merge(settings)
+        monthly = get_storage(settings['monthly_store'],
+                              settings.get('storage', 'hdf'))
+        merged = dict((k, pd.read_hdf(settings['merged_store'], key=k))
+                      for k in ['m1998_01', 'm1998_02'])
+        return monthly, merged
+
+    def _check(self, **options):
+        expected_monthly, expected = self._parse_and_merge(
+            'whole', **options)
+        monthly, result = self._parse_and_merge(
+            'chunked', parse_chunksize=10, **options)
+        for key in ['cpsm1998-01', 'cpsm1998-02']:
+            tm.assert_frame_equal(monthly.read(key).sort_index(),
+                                  expected_monthly.read(key).sort_index())
+        for k in expected:
+            tm.assert_frame_equal(result[k], expected[k])
+        self.assertTrue((result['m1998_01']['wave_id'] ==
+                         pd.Timestamp('1998-01-01')).all())
+
+        df = monthly.read('cpsm1998-01')
+        hhid2 = df.index.get_level_values('HRHHID2')
+        self.assertEqual(hhid2.isnull().sum(), 1)
+        self.assertEqual(df['HUHHNUM'].min(), -1)
+
+    def test_hdf(self):
+        self._check()
+
+    def test_hdf_compact_by_mis(self):
+        self._check(compact_dtypes=True, partition_by_mis=True)
+
+    def test_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            import nose
+            raise(nose.SkipTest("pyarrow not installed"))
+        self.settings['dd_store'] = os.path.join(self.tmpdir, 'dds')
+        get_storage(self.settings['dd_store'], 'parquet').write(
+            self.dd, 'cpsm1998-01')
+        self._check(storage='parquet')
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        _skip_if_no_tables()
+        self.tmpdir = os.path.abspath('_testapimerge_')
+        os.makedirs(self.tmpdir)
+        self.settings = {
+            'monthly_store': os.path.join(self.tmpdir, 'monthly.hdf'),
+            'merged_store': os.path.join(self.tmpdir, 'merged.hdf'),
+            'date_start': '2009-01',
+            'date_end': '2009-03',
+        }
+        # two people per panel; the second one changes sex in month 4
+        rows = []
+        for hh, start in [(1, pd.Period('2009-01', 'M')),
+                          (2, pd.Period('2009-02', 'M'))]:
+            for mis, offset in enumerate(m.PANEL_OFFSETS, 1):
+                month = start + offset
+                for line, sex in [(1, 1), (2, 2 if mis < 4 else 1)]:
+                    rows.append([hh, 65001, line, mis, month.year,
+                                 month.month, 30 + line, sex, 1])
+        df = pd.DataFrame(rows, columns=['HRHHID', 'HRHHID2', 'PULINENO',
+                                         'HRMIS', 'HRYEAR4', 'HRMONTH',
+                                         'PRTAGE', 'PESEX', 'PTDTRACE'])
+        store = get_storage(self.settings['monthly_store'])
+        for (year, month), month_df in df.groupby(['HRYEAR4', 'HRMONTH']):
+            key = 'cpsm{}-{:02d}'.format(year, month)
+            store.write(month_df.set_index(api.ID_COLS), key)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        store_path = self.settings['merged_store']
+        return {k: pd.read_hdf(store_path, key=k)
+                for k in ['m2009_01', 'm2009_02']}
+
+    def test_merge_jobs(self):
+        api.merge(self.settings, overwrite=True)
+        expected = self._read()
+        os.remove(self.settings['merged_store'])
+
+        api.merge(self.settings, overwrite=True, jobs=2)
+        result = self._read()
+        for k in expected:
+            tm.assert_frame_equal(result[k], expected[k])
+
+        df = result['m2009_02']
+        self.assertEqual(len(df), 8 + 3)
+        self.assertEqual(df.index.names, api.ID_COLS + ['HRMIS'])
+        self.assertTrue((df['wave_id'] == pd.Timestamp('2009-02-01')).all())
+
+    def test_merge_telemetry(self):
+        self.settings['telemetry'] = os.path.join(self.tmpdir, 'tm.jsonl')
+        api.merge(self.settings, jobs=2)
+        with open(self.settings['telemetry']) as f:
+            records = [json.loads(line) for line in f]
+        panels = {x['item']: x for x in records[:-1]}
+        self.assertEqual(sorted(panels), ['m2009_01', 'm2009_02'])
+        self.assertEqual(panels['m2009_02']['records'], 8 + 3)
+        self.assertGreater(panels['m2009_02']['bytes_written'], 0)
+        self.assertEqual(records[-1]['stage'], 'merge')
+        self.assertEqual(records[-1]['misses'], 2)
+
+    def test_merge_cached(self):
+        api.merge(self.settings)
+        self.settings['telemetry'] = os.path.join(self.tmpdir, 'tm.jsonl')
+        api.merge(self.settings)
+        with open(self.settings['telemetry']) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(sorted(x['item'] for x in records[:-1]),
+                         ['m2009_01', 'm2009_02'])
+        self.assertEqual([x['cache'] for x in records[:-1]], ['hit', 'hit'])
+
+    def test_merge_manifest(self):
+        self.settings['manifest'] = os.path.join(self.tmpdir, 'manifest.json')
+        api.merge(self.settings)
+        with open(self.settings['manifest']) as f:
+            artifacts = json.load(f)['artifacts']
+        self.assertEqual(sorted(artifacts),
+                         ['merged/m2009_01', 'merged/m2009_02'])
+        mtime = os.path.getmtime(self.settings['merged_store'])
+
+        api.merge(self.settings)
+        self.assertEqual(os.path.getmtime(self.settings['merged_store']),
+                         mtime)
+
+        # a reparsed month makes the panels it's in stale
+        manifest = api.open_manifest(self.settings)
+        manifest.record('monthly/cpsm2009-05', 'new')
+        manifest.save()
+        api.merge(self.settings)
+        with open(self.settings['manifest']) as f:
+            result = json.load(f)['artifacts']
+        self.assertEqual(result['merged/m2009_01'],
+                         artifacts['merged/m2009_01'])
+        self.assertNotEqual(result['merged/m2009_02'],
+                            artifacts['merged/m2009_02'])
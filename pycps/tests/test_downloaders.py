@@ -1,12 +1,101 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
 import unittest
+import threading
+import hashlib
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 
 from pycps import downloaders as d
 
 curdir = os.path.dirname(__file__)
 
 
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves files from ``server.directory``, with support for Range
+    requests. Set ``server.truncate`` to drop the connection halfway
+    through a response.
+    """
+    # keep-alive, so we can see connections being reused
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+
+    def send_response(self, code, message=None):
+        self.server.codes.append(code)
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def do_GET(self):
+        path = os.path.join(self.server.directory, self.path.lstrip('/'))
+        byte_range = self.headers.get('Range')
+        self.server.requests.append((self.path, byte_range))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        if byte_range:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range',
+                                 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.server.truncate:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(directory):
+    """
+    Serve ``directory`` over HTTP on localhost from a background thread.
+    Returns the server and the base URL.
+    """
+    server = _Server(('127.0.0.1', 0), _Handler)
+    server.directory = directory
+    server.connections = []
+    server.requests = []
+    server.codes = []
+    server.truncate = False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+
 class TestDownloaders(unittest.TestCase):
 
     def test_all_monthly_files(self):
@@ -183,3 +272,185 @@ class TestCached(unittest.TestCase):
         os.rmdir(self.tmpdir)
         result = d.check_cached(self.tmpdir)
         self.assertEqual(result, expected)
+
+
+class TestDownloadMonth(unittest.TestCase):
+
+    def setUp(self):
+        self.served = os.path.abspath('_served_')
+        self.outdir = os.path.abspath('_downloaded_')
+        os.mkdir(self.served)
+        self.files = {'cpsb7601.Z': os.urandom(3 * d.CHUNK_SIZE + 7),
+                      'jan94pub.zip': b'jan94',
+                      'feb94pub.zip': b'feb94'}
+        for name, data in self.files.items():
+            with open(os.path.join(self.served, name), 'wb') as f:
+                f.write(data)
+        self.server, self.base = serve(self.served)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.served)
+        if os.path.exists(self.outdir):
+            shutil.rmtree(self.outdir)
+
+    def _read(self, name):
+        with open(os.path.join(self.outdir, name), 'rb') as f:
+            return f.read()
+
+    def test_download_month(self):
+        record = d.download_month('cpsb7601.Z', self.outdir, base=self.base)
+        self.assertEqual(self._read('cpsm1976-01.Z'),
+                         self.files['cpsb7601.Z'])
+        self.assertEqual(record['stage'], 'download')
+        self.assertEqual(record['item'], 'cpsm1976-01.Z')
+        self.assertEqual(record['bytes_read'], 3 * d.CHUNK_SIZE + 7)
+        self.assertEqual(record['cache'], 'miss')
+        self.assertGreaterEqual(record['wall_seconds'], 0)
+
+    def test_download_month_missing(self):
+        import requests
+        with self.assertRaises(requests.HTTPError):
+            d.download_month('mar94pub.zip', self.outdir, base=self.base)
+
+    def test_download_months_concurrent(self):
+        result = d.download_months(list(self.files), self.outdir, workers=3,
+                                   base=self.base)
+        self.assertEqual(sorted(result), sorted(self.files))
+        for name, data in self.files.items():
+            self.assertEqual(self._read(d.rename_cps_monthly(name)), data)
+
+    def test_download_months_reuses_connection(self):
+        list(d.download_months(list(self.files), self.outdir, workers=1,
+                               base=self.base))
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_download_month_resume(self):
+        os.mkdir(self.outdir)
+        data = self.files['cpsb7601.Z']
+        with open(os.path.join(self.outdir, 'cpsm1976-01.Z.part'), 'wb') as f:
+            f.write(data[:100])
+
+        d.download_month('cpsb7601.Z', self.outdir, base=self.base)
+        self.assertEqual(self._read('cpsm1976-01.Z'), data)
+        self.assertEqual(self.server.requests,
+                         [('/cpsb7601.Z', 'bytes=100-')])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.outdir, 'cpsm1976-01.Z.part')))
+
+    def test_download_month_resume_complete(self):
+        # all there, but not renamed yet
+        os.mkdir(self.outdir)
+        data = self.files['cpsb7601.Z']
+        part = os.path.join(self.outdir, 'cpsm1976-01.Z.part')
+        with open(part, 'wb') as f:
+            f.write(data)
+
+        record = d.download_month('cpsb7601.Z', self.outdir, base=self.base)
+        self.assertEqual(self._read('cpsm1976-01.Z'), data)
+        self.assertEqual(self.server.codes, [416])
+        self.assertEqual(record['bytes_read'], 0)
+        self.assertFalse(os.path.exists(part))
+
+    def test_download_month_resume_too_long(self):
+        os.mkdir(self.outdir)
+        data = self.files['jan94pub.zip']
+        part = os.path.join(self.outdir, 'cpsm1994-01.zip.part')
+        with open(part, 'wb') as f:
+            f.write(data + b'junk')
+
+        d.download_month('jan94pub.zip', self.outdir, base=self.base)
+        self.assertEqual(self._read('cpsm1994-01.zip'), data)
+        self.assertEqual(self.server.codes, [416, 200])
+
+    def test_download_month_interrupted(self):
+        self.server.truncate = True
+        with self.assertRaises(IOError):
+            d.download_month('cpsb7601.Z', self.outdir, base=self.base)
+        self.assertEqual(d.check_cached(self.outdir), [])
+
+        self.server.truncate = False
+        d.download_month('cpsb7601.Z', self.outdir, base=self.base)
+        self.assertEqual(self._read('cpsm1976-01.Z'),
+                         self.files['cpsb7601.Z'])
+        self.assertEqual(self.server.requests[-1][0], '/cpsb7601.Z')
+        self.assertIsNotNone(self.server.requests[-1][1])
+
+    def test_download_month_checksum(self):
+        data = self.files['jan94pub.zip']
+        good = hashlib.sha256(data).hexdigest()
+        d.download_month('jan94pub.zip', self.outdir, base=self.base,
+                         sha256=good)
+        self.assertEqual(self._read('cpsm1994-01.zip'), data)
+
+        with self.assertRaises(IOError):
+            d.download_month('feb94pub.zip', self.outdir, base=self.base,
+                             sha256=good)
+        self.assertEqual(sorted(os.listdir(self.outdir)),
+                         ['cpsm1994-01.zip', 'cpsm1994-01.zip.sha256'])
+
+    def test_verify_download(self):
+        d.download_month('jan94pub.zip', self.outdir, base=self.base)
+        path = os.path.join(self.outdir, 'cpsm1994-01.zip')
+        self.assertTrue(d.verify_download(path))
+        self.assertEqual(d.check_cached(self.outdir, verify=True),
+                         ['cpsm1994-01.zip'])
+
+        with open(path, 'ab') as f:
+            f.write(b'corrupt')
+        self.assertFalse(d.verify_download(path))
+        self.assertEqual(d.check_cached(self.outdir, verify=True), [])
+        self.assertEqual(d.check_cached(self.outdir), ['cpsm1994-01.zip'])
+
+
+class TestIndexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.served = os.path.abspath('_served_index_')
+        os.mkdir(self.served)
+        shutil.copy(os.path.join(curdir, 'files', 'trimmed_nber.html'),
+                    os.path.join(self.served, 'cps_basic.html'))
+        self.server, base = serve(self.served)
+        self.site = base + 'cps_basic.html'
+        self.cache = os.path.join(self.served, 'cache', 'index.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.served)
+
+    def test_not_modified(self):
+        expected = [('cpsb7601.Z', 'cpsm1976-01.Z'),
+                    ('jan94pub.zip', 'cpsm1994-01.zip')]
+        result = list(d.all_monthly_files(self.site, cache=self.cache))
+        self.assertEqual(result, expected)
+        self.assertTrue(os.path.exists(self.cache))
+
+        result = list(d.all_monthly_files(self.site, cache=self.cache))
+        self.assertEqual(result, expected)
+        result = list(d.all_monthly_files(self.site, kind='dictionary',
+                                          cache=self.cache))
+        self.assertEqual(result[0], ('cpsbjan03.ddf', 'cpsm2003-01.ddf'))
+        self.assertEqual(self.server.codes, [200, 304, 304])
+
+    def test_modified(self):
+        list(d.all_monthly_files(self.site, cache=self.cache))
+        page = os.path.join(self.served, 'cps_basic.html')
+        with open(page) as f:
+            html = f.read()
+        with open(page, 'w') as f:
+            f.write(html.replace('</table>', '<a href="/cps-basic/'
+                                             'feb94pub.zip">Feb</a></table>'))
+
+        result = list(d.all_monthly_files(self.site, cache=self.cache))
+        self.assertEqual(result[-1], ('feb94pub.zip', 'cpsm1994-02.zip'))
+        self.assertEqual(self.server.codes, [200, 200])
+
+    def test_bad_cache(self):
+        os.mkdir(os.path.dirname(self.cache))
+        with open(self.cache, 'w') as f:
+            f.write('not json')
+        result = list(d.all_monthly_files(self.site, cache=self.cache))
+        self.assertEqual(len(result), 2)
+        self.assertEqual(self.server.codes, [200])
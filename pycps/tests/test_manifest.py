@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+import logging
+import unittest
+
+import pandas as pd
+
+from pycps import monthly_data_fixups as mdf
+from pycps.manifest import (Manifest, open_manifest, fingerprint,
+                            hash_frame, hash_fixups)
+
+logging.disable(logging.CRITICAL)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.abspath('_testmanifest_')
+        os.mkdir(self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'manifest.json')
+        self.raw = os.path.join(self.tmpdir, 'cpsm2009-01.zip')
+        with open(self.raw, 'wb') as f:
+            f.write(b'some data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        manifest = Manifest(self.path)
+        self.assertFalse(manifest.is_fresh('monthly/cpsm2009-01', 'abc'))
+        manifest.record('monthly/cpsm2009-01', 'abc')
+        manifest.save()
+
+        result = Manifest(self.path)
+        self.assertTrue(result.is_fresh('monthly/cpsm2009-01', 'abc'))
+        self.assertFalse(result.is_fresh('monthly/cpsm2009-01', 'abd'))
+        self.assertIsNone(result.get('monthly/cpsm2009-02'))
+
+    def test_open_manifest(self):
+        self.assertIsNone(open_manifest({}))
+        manifest = open_manifest({'manifest': self.path})
+        self.assertEqual(manifest.artifacts, {})
+
+    def test_file_digest(self):
+        manifest = Manifest(self.path)
+        expected = hashlib.sha256(b'some data').hexdigest()
+        self.assertEqual(manifest.file_digest(self.raw), expected)
+
+        # unchanged size and mtime: not hashed again
+        key = list(manifest.files)[0]
+        manifest.files[key]['sha256'] = 'cached'
+        self.assertEqual(manifest.file_digest(self.raw), 'cached')
+
+        with open(self.raw, 'wb') as f:
+            f.write(b'other data!')
+        expected = hashlib.sha256(b'other data!').hexdigest()
+        self.assertEqual(manifest.file_digest(self.raw), expected)
+
+    def test_file_digest_sidecar(self):
+        with open(self.raw + '.sha256', 'w') as f:
+            f.write('recorded  cpsm2009-01.zip\n')
+        manifest = Manifest(self.path)
+        self.assertEqual(manifest.file_digest(self.raw), 'recorded')
+
+    def test_file_digest_stale_sidecar(self):
+        with open(self.raw + '.sha256', 'w') as f:
+            f.write('recorded  cpsm2009-01.zip\n')
+        # the file changed after its digest was recorded
+        mtime = os.stat(self.raw + '.sha256').st_mtime
+        os.utime(self.raw, (mtime + 10, mtime + 10))
+        manifest = Manifest(self.path)
+        self.assertEqual(manifest.file_digest(self.raw),
+                         hashlib.sha256(b'some data').hexdigest())
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_fingerprint(self):
+        a = fingerprint('x', [1, 2], {'a': 1, 'b': 2})
+        b = fingerprint('x', [1, 2], {'b': 2, 'a': 1})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, fingerprint('x', [2, 1], {'a': 1, 'b': 2}))
+
+    def test_hash_frame(self):
+        df = pd.DataFrame({'id': ['A', 'B'], 'length': [1, 2]})
+        self.assertEqual(hash_frame(df), hash_frame(df.copy()))
+        other = df.copy()
+        other.loc[1, 'length'] = 3
+        self.assertNotEqual(hash_frame(df), hash_frame(other))
+        self.assertNotEqual(hash_frame(df),
+                            hash_frame(df.rename(columns={'id': 'ID'})))
+
+    def test_hash_fixups(self):
+        fixups = [mdf.year2_to_year4, (mdf.year2_to_year4, {'x': 1})]
+        self.assertEqual(hash_fixups(fixups), hash_fixups(list(fixups)))
+        self.assertNotEqual(hash_fixups(fixups), hash_fixups(fixups[:1]))
+        self.assertNotEqual(hash_fixups(fixups[:1]), hash_fixups(None))
+
+        def year2_to_year4(df):
+            return df
+
+        self.assertNotEqual(hash_fixups([mdf.year2_to_year4]),
+                            hash_fixups([year2_to_year4]))
@@ -3,6 +3,7 @@ import datetime
 import unittest
 
 import arrow
+import numpy as np
 import pandas as pd
 import pandas.util.testing as tm
 
@@ -77,6 +78,131 @@ class TestMerge(unittest.TestCase):
                                 index=['b', 'c'])
         tm.assert_frame_equal(result, expected)
 
+    def test_match_positions(self):
+        left = pd.DataFrame({'A': [1, 3, 5, 7]}, index=['a', 'b', 'c', 'd'])
+        right = pd.DataFrame({'A': [8, 3, 0, 1]}, index=['d', 'b', 'e', 'a'])
+        f = lambda x, y: x['A'] >= y['A']
+        lpos, rpos = m.match_positions(left, right, [f])
+        np.testing.assert_array_equal(lpos, [1, 0])
+        np.testing.assert_array_equal(rpos, [1, 3])
+
+    def test_join_match(self):
+        idx = pd.MultiIndex.from_tuples([(17156360780, 65001, 1),
+                                         (17156360780, 65001, 2),
+                                         (45110260160, 65001, 1),
+                                         (92129160240, 65001, -1)])
+        left = self.left.iloc[:4].set_index(idx)
+        right = self.right.iloc[[3, 0, 2, 1]].set_index(idx[[3, 0, 2, 1]])
+        expected = m.match(left, right, [m.match_age, m.match_sex,
+                                         m.match_race])
+        result = m.join_match(left, right, m.MATCH_PREDICATES)
+        tm.assert_frame_equal(result.sort_index(), expected.sort_index())
+
+        result = m.join_match(left, right, [m.age_matches])
+        self.assertEqual(list(result.index), [idx[3], idx[0]])
+
+    def test_join_match_missing(self):
+        left = pd.DataFrame({'PESEX': [1, np.nan, 2]})
+        right = pd.DataFrame({'PESEX': [1, np.nan, 1]})
+        result = m.join_match(left, right, [m.sex_matches])
+        tm.assert_frame_equal(result, right.iloc[[0]])
+
+    def test_align_duplicates(self):
+        left = pd.DataFrame({'A': [1, 2]}, index=['a', 'a'])
+        with self.assertRaises(ValueError):
+            m.align(left, left)
+
+    def test_person_keys(self):
+        left = pd.MultiIndex.from_tuples([(10 ** 14, 65001, 1),
+                                          (10 ** 14, 65001, 2),
+                                          (3, 99999, 1)])
+        right = pd.MultiIndex.from_tuples([(3, 99999, 1),
+                                           (10 ** 14, 65001, 3),
+                                           (10 ** 14, 65001, 1)])
+        lkeys, rkeys = m.person_keys(left, right)
+        self.assertEqual(lkeys.dtype, np.int64)
+        self.assertEqual(len(set(lkeys) | set(rkeys)), 4)
+        self.assertEqual(lkeys[0], rkeys[2])
+        self.assertEqual(lkeys[2], rkeys[0])
+
+    def test_person_keys_narrow(self):
+        # like a PERSONID level read back from compact dtypes
+        for dtype in [np.int32, 'Int32']:
+            left = pd.Index(pd.array([5, -1, 70000], dtype=dtype))
+            right = pd.Index(pd.array([70000, 5], dtype=dtype))
+            lkeys, rkeys = m.person_keys(left, right)
+            self.assertEqual(lkeys.tolist(), [5, -1, 70000])
+            self.assertEqual(rkeys.tolist(), [70000, 5])
+
+    def test_pack_person_ids(self):
+        df = pd.DataFrame({'HRHHID': [17156360780, 0, 990103020050117],
+                           'HRHHID2': [65001, 0, 99999],
+                           'PULINENO': [1, 0, 99]})
+        result = m.pack_person_ids(df)
+        self.assertEqual(result.dtype, m.PACKED_DTYPE)
+        self.assertEqual(result['HRHHID'][2], 990103020050117)
+        self.assertEqual(result[m.PERSON_ID][0], 65001 << 8 | 1)
+        tm.assert_frame_equal(m.unpack_person_ids(result),
+                              df[m.PERSON_COLS])
+
+    def test_pack_person_ids_bad(self):
+        good = {'HRHHID': [1], 'HRHHID2': [65001], 'PULINENO': [1]}
+        bad = [('HRHHID', -1), ('HRHHID2', 2 ** 23), ('PULINENO', 256),
+               ('PULINENO', -1), ('PULINENO', np.nan)]
+        for col, value in bad:
+            df = pd.DataFrame(dict(good, **{col: [value]}))
+            with self.assertRaises(ValueError):
+                m.pack_person_ids(df)
+
+    def test_person_index(self):
+        df = pd.DataFrame({'HRHHID': [45110260160, 17156360780],
+                           'HRHHID2': [65001, 65001],
+                           'PULINENO': [1, 2],
+                           'HRMIS': [1, 1],
+                           'PRTAGE': [30, 40]},
+                          columns=['HRHHID', 'HRHHID2', 'PULINENO',
+                                   'HRMIS', 'PRTAGE'])
+        packed = m.set_person_index(df, packed=True)
+        self.assertEqual(packed.index.names, m.PACKED_COLS)
+        self.assertEqual(list(packed.columns), ['HRMIS', 'PRTAGE'])
+        tm.assert_frame_equal(m.reset_person_index(packed), df)
+
+        merged = m.merge([packed])
+        self.assertEqual(merged.index.names, m.PACKED_COLS + ['HRMIS'])
+        expected = df.set_index('HRMIS')
+        tm.assert_frame_equal(m.reset_person_index(merged), expected)
+
+    def test_join_match_packed(self):
+        # 15 digit household ids, like the real ones
+        idx = pd.MultiIndex.from_tuples([(990103020050117, 65001, 1),
+                                         (990103020050117, 65001, 2),
+                                         (451102601600001, 65001, 1),
+                                         (921291602400001, 65001, 3)],
+                                        names=m.PERSON_COLS)
+        left = self.left.iloc[3:].set_index(idx)
+        right = self.right.iloc[3:].iloc[[3, 0, 2, 1]].set_index(
+            idx[[3, 0, 2, 1]])
+        expected = m.join_match(left, right, m.MATCH_PREDICATES)
+        self.assertEqual(len(expected), 1)
+
+        def pack(df):
+            return m.set_person_index(df.reset_index(), packed=True)
+
+        result = m.join_match(pack(left), pack(right), m.MATCH_PREDICATES)
+        tm.assert_frame_equal(result, pack(expected))
+        tm.assert_frame_equal(m.reset_person_index(result),
+                              expected.reset_index())
+
+    def test_make_wave_id_packed(self):
+        idx = pd.MultiIndex.from_tuples([(17156360780, 65001 << 8 | 4, 4),
+                                         (45110260160, 65001 << 8 | 1, 1)],
+                                        names=m.PACKED_COLS + ['HRMIS'])
+        df = pd.DataFrame({'HRYEAR4': [1999, 1999],
+                           'HRMONTH': [4, 1]}, index=idx)
+        result = m.make_wave_id(df)
+        self.assertEqual(result['wave_id'].iloc[0],
+                         pd.Timestamp('1999-01-01'))
+
     def test_make_wave_id(self):
         # unsorted, just in case
         idx = pd.MultiIndex.from_tuples([(17156360780, 65001, -1, 4),
@@ -118,3 +244,69 @@ class TestMerge(unittest.TestCase):
                                  "PTDTRACE": [1, 1]},
                                 index=idx)
         tm.assert_frame_equal(result, expected)
+
+
+class TestStreamPanels(unittest.TestCase):
+
+    def setUp(self):
+        self.reads = []
+        self.wanted = {}
+
+    def read(self, name, mis):
+        self.reads.append(name)
+        self.wanted[name] = mis
+        if name == 'cpsm2014-03':
+            raise KeyError(name)
+        return pd.DataFrame({'HRMIS': [1, 2, 3, 4, 5, 6, 7, 8, 1],
+                             'month': name})
+
+    def test_read_once(self):
+        starts = ['2014-01', '2014-02', '2014-03', '2014-06']
+        result = list(m.stream_panels(starts, self.read))
+        self.assertEqual(len(self.reads), len(set(self.reads)))
+        self.assertEqual(self.reads, sorted(self.reads))
+        self.assertEqual([str(start) for start, _ in result], starts)
+
+        for start, parts in result:
+            months = [x.strftime('cpsm%Y-%m')
+                      for x in m.make_months(str(start))]
+            self.assertEqual([name for _, name, _ in parts], months)
+            for mis, name, df in parts:
+                if name == 'cpsm2014-03':
+                    self.assertIsNone(df)
+                else:
+                    self.assertTrue((df['HRMIS'] == mis).all())
+                    self.assertTrue((df['month'] == name).all())
+
+        # the first month in sample is duplicated in the data
+        first = result[0][1][0][2]
+        self.assertEqual(len(first), 2)
+
+    def test_wanted_mis(self):
+        list(m.stream_panels(['2014-01', '2014-02'], self.read))
+        self.assertEqual(self.wanted['cpsm2014-01'], [1])
+        self.assertEqual(self.wanted['cpsm2014-02'], [1, 2])
+        self.assertEqual(self.wanted['cpsm2015-05'], [8])
+
+    def test_small_window(self):
+        starts = ['2014-01', '2014-02']
+        expected = list(m.stream_panels(starts, self.read))
+        self.reads = []
+        result = list(m.stream_panels(starts, self.read, window=2))
+        self.assertGreater(len(self.reads), len(set(self.reads)))
+        for (s1, p1), (s2, p2) in zip(result, expected):
+            self.assertEqual(s1, s2)
+            for (mis1, n1, df1), (mis2, n2, df2) in zip(p1, p2):
+                self.assertEqual((mis1, n1), (mis2, n2))
+                if df1 is None:
+                    self.assertIsNone(df2)
+                else:
+                    tm.assert_frame_equal(df1, df2)
+
+    def test_lru_cache(self):
+        cache = m.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        cache['c'] = 3
+        self.assertEqual(list(cache), ['a', 'c'])
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import logging
+import unittest
+
+import numpy as np
+import pandas as pd
+import pandas.util.testing as tm
+
+import pycps.parsers as p
+import pycps.monthly_data_fixups as mdf
+
+logging.disable(logging.CRITICAL)
+
+
+class TestComputeHRHHID2(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'HRSAMPLE': ['A55', 'A55', 'B05', 'C61', 'A55', 'A55'],
+            'HRSERSUF': ['A', 'z', '-1', 'B', np.nan, 'C'],
+            'HUHHNUM': [1, 2, 1, 0, 1, -1]})
+
+    def test_compute_hrhhid2(self):
+        result = mdf.compute_hrhhid2(self.df)
+        expected = pd.Series([55011, 55262, 5001, 61020, np.nan, np.nan],
+                             name='HRHHID2')
+        tm.assert_series_equal(result['HRHHID2'], expected)
+
+    def test_all_valid(self):
+        df = self.df.iloc[:4].copy()
+        result = mdf.compute_hrhhid2(df)
+        self.assertEqual(result['HRHHID2'].dtype, np.int64)
+        self.assertEqual(result['HRHHID2'].tolist(),
+                         [55011, 55262, 5001, 61020])
+
+    def test_numeric_codes(self):
+        # chunks where every suffix is -1 decode as numbers
+        df = pd.DataFrame({'HRSAMPLE': [55, 61], 'HRSERSUF': [-1, -1],
+                           'HUHHNUM': pd.array([1, None], dtype='Int8')})
+        result = mdf.compute_hrhhid2(df)
+        tm.assert_series_equal(result['HRHHID2'],
+                               pd.Series([55001, np.nan], name='HRHHID2'))
+
+    def test_lut(self):
+        self.assertEqual(mdf.SERSUF_LUT.shape, (256,))
+        self.assertEqual(mdf.SERSUF_LUT[ord('A')], 1)
+        self.assertEqual(mdf.SERSUF_LUT[ord('z')], 26)
+        self.assertEqual(mdf.SERSUF_LUT[ord('1')], -1)
+
+
+class TestYear2ToYear4(unittest.TestCase):
+
+    def test_year2_to_year4(self):
+        df = pd.DataFrame({'HRYEAR4': [94, 99]})
+        result = mdf.year2_to_year4(df)
+        self.assertEqual(result['HRYEAR4'].tolist(), [1994, 1999])
+
+
+class TestFixupByDD(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({'HRYEAR4': [94, 95], 'PRTAGE': [30, 40]})
+
+    def test_registry(self):
+        self.assertIs(mdf.REGISTRY['compute_hrhhid2'], mdf.compute_hrhhid2)
+        self.assertEqual(mdf.year2_to_year4.reads, ('HRYEAR4',))
+        self.assertEqual(mdf.year2_to_year4.writes, ('HRYEAR4',))
+
+    def test_declared_columns(self):
+        seen = []
+
+        @mdf.fixup(reads=['PRTAGE'], writes=['AGE2'], name='_test_age2')
+        def age2(df, *args, **kwargs):
+            seen.append(list(df.columns))
+            df['AGE2'] = df['PRTAGE'] * 2
+            return df
+
+        try:
+            result = p.fixup_by_dd(self.df, [('_test_age2', {}),
+                                             (mdf.year2_to_year4, {})])
+        finally:
+            del mdf.REGISTRY['_test_age2']
+        self.assertEqual(seen, [['PRTAGE']])
+        self.assertEqual(result['AGE2'].tolist(), [60, 80])
+        self.assertEqual(result['HRYEAR4'].tolist(), [1994, 1995])
+        self.assertEqual(list(result.columns), ['HRYEAR4', 'PRTAGE', 'AGE2'])
+
+    def test_skip_unwanted(self):
+        result = p.fixup_by_dd(self.df, [(mdf.year2_to_year4, {})],
+                               columns=['PRTAGE'])
+        self.assertEqual(result['HRYEAR4'].tolist(), [94, 95])
+
+    def test_undeclared(self):
+        def drop_young(df, *args, **kwargs):
+            return df[df['PRTAGE'] > 35]
+
+        result = p.fixup_by_dd(self.df, [(drop_young, {})],
+                               columns=['PRTAGE'])
+        self.assertEqual(result['PRTAGE'].tolist(), [40])
+
+    def test_errors(self):
+        with self.assertRaises(KeyError):
+            p.fixup_by_dd(self.df, [('no_such_fixup', {})])
+        with self.assertRaises(KeyError):
+            p.fixup_by_dd(self.df, [(mdf.compute_hrhhid2, {})])
@@ -2,10 +2,13 @@
 import os
 from os.path import sep
 import json
+import pickle
+import shutil
 import logging
 import unittest
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pandas.util.testing as tm
 
@@ -259,6 +262,28 @@ class TestDDParser(unittest.TestCase):
             result = p._month_to_dd(month)
             self.assertEqual(result, dd)
 
+        result = p._months_to_dd(months)
+        self.assertEqual(list(result), dds)
+
+    def test_month_to_dd_inputs(self):
+        self.assertEqual(p._month_to_dd('data/monthly/cpsm2009-06.zip'),
+                         'cpsm2009-01')
+        self.assertEqual(p._month_to_dd(pd.Timestamp('2012-05-01')),
+                         'cpsm2012-05')
+        # open ended; the latest dictionary is used for new months
+        self.assertEqual(p._month_to_dd('2015-01'), 'cpsm2014-01')
+        with self.assertRaises(KeyError):
+            p._month_to_dd('1988-12')
+        with self.assertRaises(ValueError):
+            p._month_to_dd('jan09')
+
+        idx = pd.period_range('2013-11', '2014-02', freq='M')
+        result = p._months_to_dd(idx)
+        expected = ['cpsm2013-01', 'cpsm2013-01', 'cpsm2014-01', 'cpsm2014-01']
+        self.assertEqual(list(result), expected)
+        with self.assertRaises(KeyError):
+            p._months_to_dd(['1989-01', '1988-01'])
+
     def test_full_run(self):
         result = self.parser.run()
         expected = pd.read_csv('files/jan08expected.csv')
@@ -302,3 +327,268 @@ class testHDFStore(unittest.TestCase):
                                 columns=['HRHHID', 'HRMONTH', 'HRYEAR4'])
 
         tm.assert_frame_equal(result, expected)
+
+
+class TestReadMonthly(unittest.TestCase):
+
+    def setUp(self):
+        self.dd = pd.DataFrame([['HRHHID', 15, 1, 15],
+                                ['HRMONTH', 2, 16, 17],
+                                ['HRYEAR4', 4, 18, 21]],
+                               columns=['id', 'length', 'start', 'end'])
+        self.raw = ("000000000000000111999\n000000000000001121999\n"
+                    "000000000000002012000\n000000000000003022000\n")
+        self.expected = pd.DataFrame([[0, 11, 1999],
+                                      [1, 12, 1999],
+                                      [2, 1, 2000],
+                                      [3, 2, 2000]],
+                                     columns=['HRHHID', 'HRMONTH', 'HRYEAR4'])
+        self.tmpdir = '_readmonthly_'
+        os.mkdir(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_monthly_zip_no_extract(self):
+        import zipfile
+        path = os.path.join(self.tmpdir, 'cpsm1999-11.zip')
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('nov99pub.dat', self.raw)
+
+        result = p.read_monthly(path, self.dd)
+        tm.assert_frame_equal(result, self.expected)
+        self.assertEqual(os.listdir(self.tmpdir), ['cpsm1999-11.zip'])
+
+    def test_read_monthly_ragged(self):
+        dd = pd.DataFrame([['A', 3, 1, 3], ['B', 2, 4, 5], ['C', 2, 6, 7]],
+                          columns=['id', 'length', 'start', 'end'])
+        infile = StringIO("  1 A-1\r\n-12 B 5\r\n 34\r\n999 C 7")
+        result = p.read_monthly(infile, dd)
+        expected = pd.DataFrame({'A': [1, -12, 34, 999],
+                                 'B': ['A', 'B', np.nan, 'C'],
+                                 'C': [-1, 5, np.nan, 7]},
+                                columns=['A', 'B', 'C'])
+        tm.assert_frame_equal(result, expected)
+
+    def test_read_monthly_wide(self):
+        # 19 digits don't all fit in an int64; blank filler can be wider
+        dd = pd.DataFrame([['A', 19, 1, 19], ['B', 18, 20, 37],
+                           ['FILLER', 45, 38, 82]],
+                          columns=['id', 'length', 'start', 'end'])
+        raw = ('9999999999999999999' + '9' * 18 + ' ' * 45 + '\n' +
+               '0000000000000000001' + '-' + '1' * 17 + ' ' * 45 + '\n')
+        result = p.read_monthly(StringIO(raw), dd)
+        self.assertEqual(result['A'].tolist(), ['9999999999999999999',
+                                                '0000000000000000001'])
+        self.assertEqual(result['B'].tolist(), [10 ** 18 - 1,
+                                                -11111111111111111])
+        self.assertTrue(result['FILLER'].isnull().all())
+
+        raw = raw.replace('9999999999999999999', '1234567890123456789')
+        result = p.read_monthly(StringIO(raw), dd)
+        self.assertEqual(result['A'].tolist(), [1234567890123456789, 1])
+
+    def test_read_monthly_chunks(self):
+        result = p.read_monthly(StringIO(self.raw), self.dd, chunksize=3)
+        tm.assert_frame_equal(result, self.expected)
+
+    def test_read_monthly_blank_lines(self):
+        lines = self.raw.splitlines(True)
+        blank = ' ' * 21 + '\n'
+        cases = [
+            # an empty line inside, and whitespace at the end
+            ''.join(lines[:2]) + '\n' + ''.join(lines[2:]) + '   \n',
+            # full width blank records keep the stride
+            ''.join(lines[:2]) + blank + ''.join(lines[2:]) + blank,
+            # leading and trailing
+            '\n' + self.raw + '\n',
+        ]
+        for raw in cases:
+            for chunksize in [2, 100]:
+                result = p.read_monthly(StringIO(raw), self.dd,
+                                        chunksize=chunksize)
+                tm.assert_frame_equal(result, self.expected)
+
+    def test_read_monthly_columns(self):
+        # garbage outside the requested fields is never looked at
+        infile = StringIO("000000000000000xx1999\n000000000000001??1999\n")
+        result = p.read_monthly(infile, self.dd, columns=['HRYEAR4', 'HRHHID'])
+        expected = pd.DataFrame([[0, 1999], [1, 1999]],
+                                columns=['HRHHID', 'HRYEAR4'])
+        tm.assert_frame_equal(result, expected)
+
+    def test_read_monthly_columns_missing(self):
+        with self.assertRaises(ValueError):
+            p.read_monthly(StringIO(self.raw), self.dd, columns=['foo'])
+
+    def test_read_monthly_Z(self):
+        result = p.read_monthly('files/fwf_sample.Z', self.dd)
+        tm.assert_frame_equal(result, self.expected)
+
+    def test_open_monthly_Z(self):
+        with p.open_monthly('files/fwf_sample.Z') as f:
+            result = f.read()
+        self.assertEqual(result, self.raw.encode('ascii'))
+
+    def test_read_monthly_plan(self):
+        plan = p.plan_columns(self.dd, ['HRYEAR4', 'HRMONTH'])
+        self.assertEqual(list(plan.names), ['HRMONTH', 'HRYEAR4'])
+        result = p.read_monthly(StringIO(self.raw), plan)
+        expected = p.read_monthly(StringIO(self.raw), self.dd,
+                                  columns=['HRYEAR4', 'HRMONTH'])
+        tm.assert_frame_equal(result, expected)
+
+        with self.assertRaises(ValueError):
+            p.read_monthly(StringIO(self.raw), plan, columns=['HRYEAR4'])
+
+    def _storage(self, reads=None, stamp=(100, 1)):
+        dd = self.dd
+
+        class Storage(object):
+            path = os.path.join(self.tmpdir, 'dds.hdf')
+
+            def read(self, key):
+                if reads is not None:
+                    reads.append(key)
+                return dd
+
+            def stamp(self, key):
+                return list(stamp)
+
+        return Storage()
+
+    def test_plan_cache(self):
+        reads = []
+        plans = p.PlanCache(self._storage(reads))
+        a = plans.plan('cpsm2009-01', ['HRYEAR4'])
+        b = plans.plan('cpsm2009-01', ['HRYEAR4'])
+        c = plans.plan('cpsm2009-01', ['HRYEAR4', 'HRMONTH'])
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+        self.assertEqual(reads, ['cpsm2009-01'])
+
+        # a saved layout is used without reading the dictionary
+        reads = []
+        storage = self._storage(reads)
+        path = p.layout_path(storage.path, 'cpsm2009-02')
+        saved = p.RecordLayout.from_dd(self.dd)
+        saved.marker = True
+        saved.save(path, storage.stamp('cpsm2009-02'))
+        layout = p.PlanCache(storage).plan('cpsm2009-02')
+        self.assertEqual(list(layout.names), list(self.dd.id))
+        self.assertTrue(getattr(layout, 'marker', False))
+        self.assertEqual(reads, [])
+
+    def test_plan_cache_stale(self):
+        storage = self._storage()
+        path = p.layout_path(storage.path, 'cpsm2009-01')
+        stamp = storage.stamp('cpsm2009-01')
+        other = self.dd.copy()
+        other.loc[1, 'end'] = 18
+
+        def dump(obj):
+            with open(str(path), 'wb') as f:
+                pickle.dump(obj, f)
+
+        def rewritten():
+            # the dictionary's file has changed since
+            p.RecordLayout.from_dd(other).save(path, [100, 0])
+
+        def old_version():
+            dump({'version': p.LAYOUT_VERSION - 1, 'stamp': stamp,
+                  'layout': p.RecordLayout.from_dd(other)})
+
+        def untagged():
+            # saved before layouts were tagged
+            dump(p.RecordLayout.from_dd(other))
+
+        def garbage():
+            with open(str(path), 'wb') as f:
+                f.write(b'not a pickle')
+
+        expected = p.RecordLayout.from_dd(self.dd)
+        for write in [rewritten, old_version, untagged, garbage]:
+            write()
+            self.assertIsNone(p.RecordLayout.load(path, stamp))
+            layout = p.PlanCache(storage).layout('cpsm2009-01')
+            self.assertEqual(layout.ends.tolist(), expected.ends.tolist())
+            # and saved again, up to date
+            saved = p.RecordLayout.load(path, stamp)
+            self.assertEqual(saved.ends.tolist(), expected.ends.tolist())
+
+    def test_record_layout(self):
+        layout = p.RecordLayout.from_dd(self.dd)
+        self.assertEqual(layout.width, 21)
+        self.assertEqual(layout.offsets.tolist(), [0, 15, 17, 21])
+        self.assertEqual(layout.gather.tolist(), list(range(21)))
+        self.assertEqual(layout.dtypes, [np.dtype(np.int64),
+                                         np.dtype(np.int8),
+                                         np.dtype(np.int16)])
+
+        result = pickle.loads(pickle.dumps(layout))
+        self.assertEqual(result.width, layout.width)
+        tm.assert_numpy_array_equal(result.gather, layout.gather)
+        tm.assert_frame_equal(p.read_monthly(StringIO(self.raw), result),
+                              p.read_monthly(StringIO(self.raw), self.dd))
+
+        sub = layout.select(['HRYEAR4', 'HRHHID'])
+        self.assertEqual(list(sub.names), ['HRHHID', 'HRYEAR4'])
+        self.assertEqual(sub.gather.tolist(),
+                         list(range(15)) + [17, 18, 19, 20])
+        with self.assertRaises(ValueError):
+            layout.select(['foo'])
+
+    def test_iter_monthly(self):
+        raw = self.raw.replace('0120', '  20')
+        expected = p.read_monthly(StringIO(raw), self.dd)
+        chunks = list(p.iter_monthly(StringIO(raw), self.dd, chunksize=3))
+        self.assertEqual([len(x) for x in chunks], [3, 1])
+        for chunk in chunks:
+            self.assertEqual([str(x) for x in chunk.dtypes], ['Int64'] * 3)
+        tm.assert_frame_equal(pd.concat(chunks), expected.astype('Int64'))
+
+        chunks = list(p.iter_monthly(StringIO(raw), self.dd, chunksize=3,
+                                     compact=True))
+        for chunk in chunks:
+            self.assertEqual([str(x) for x in chunk.dtypes],
+                             ['Int64', 'Int8', 'Int16'])
+        self.assertEqual(pd.concat(chunks)['HRMONTH'].tolist(),
+                         [11, 12, pd.NA, 2])
+
+    def test_stable_dtypes(self):
+        df = pd.DataFrame({'a': [1, 2], 'b': [1., np.nan], 'c': [.5, 1.],
+                           'd': ['x', 'y']})
+        result = p.stable_dtypes(df)
+        self.assertEqual([str(x) for x in result.dtypes],
+                         ['Int64', 'Int64', 'float64', 'object'])
+        self.assertEqual(result['b'].tolist(), [1, pd.NA])
+
+    def test_plan_dtypes(self):
+        dd = pd.DataFrame([['A', 1, 1, 1], ['B', 2, 2, 3], ['C', 4, 4, 7],
+                           ['D', 9, 8, 16], ['E', 15, 17, 31]],
+                          columns=['id', 'length', 'start', 'end'])
+        result = p.plan_dtypes(dd)
+        expected = [np.int8, np.int8, np.int16, np.int32, np.int64]
+        self.assertEqual(result, [np.dtype(x) for x in expected])
+
+    def test_read_monthly_compact(self):
+        for chunksize in [1, 3, 10]:
+            result = p.read_monthly(StringIO(self.raw), self.dd,
+                                    chunksize=chunksize, compact=True)
+            expected = self.expected.astype({'HRMONTH': np.int8,
+                                             'HRYEAR4': np.int16})
+            tm.assert_frame_equal(result, expected)
+
+    def test_read_monthly_compact_missing(self):
+        dd = pd.DataFrame([['A', 3, 1, 3], ['B', 2, 4, 5], ['C', 2, 6, 7]],
+                          columns=['id', 'length', 'start', 'end'])
+        raw = "  1 A-1\n-12 B 5\n 34\n999 C 7\n"
+        for chunksize in [1, 2, 10]:
+            result = p.read_monthly(StringIO(raw), dd, chunksize=chunksize,
+                                    compact=True)
+            expected = pd.DataFrame(
+                {'A': np.array([1, -12, 34, 999], dtype=np.int16),
+                 'B': pd.Categorical(['A', 'B', np.nan, 'C']),
+                 'C': pd.array([-1, 5, None, 7], dtype='Int8')},
+                columns=['A', 'B', 'C'])
+            tm.assert_frame_equal(result, expected)
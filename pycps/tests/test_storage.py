@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import logging
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pandas.util.testing as tm
+
+from pycps.storage import (get_storage, HDFStorage, ParquetStorage,
+                           CATALOG_ATTR)
+
+logging.disable(logging.CRITICAL)
+
+
+def _skip_if_no_tables():
+    try:
+        import tables
+    except ImportError:
+        import nose
+        raise(nose.SkipTest("tables not installed"))
+
+
+def _skip_if_no_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        import nose
+        raise(nose.SkipTest("pyarrow not installed"))
+
+
+class Base(object):
+
+    def setUp(self):
+        self.tmpdir = os.path.abspath('_teststorage_')
+        os.mkdir(self.tmpdir)
+        self.df = pd.DataFrame({'HRHHID': [1, 2, 3, 4],
+                                'HRHHID2': [11, 11, 12, 12],
+                                'PULINENO': [1, 1, 2, 1],
+                                'HRMIS': [1, 5, 1, 8],
+                                'PRTAGE': [24, 25, 81, 30],
+                                'PESEX': [1, 2, 2, 1]},
+                               columns=['HRHHID', 'HRHHID2', 'PULINENO',
+                                        'HRMIS', 'PRTAGE', 'PESEX'])
+        self.df = self.df.set_index(['HRHHID', 'HRHHID2', 'PULINENO'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        self.store.write(self.df, 'cpsm2009-01')
+        result = self.store.read('cpsm2009-01')
+        tm.assert_frame_equal(result.sort_index(), self.df.sort_index())
+        self.assertEqual(self.store.keys(), ['cpsm2009-01'])
+        self.assertEqual(self.store.columns('cpsm2009-01'),
+                         ['HRMIS', 'PRTAGE', 'PESEX'])
+
+    def test_catalog(self):
+        self.assertEqual(self.store.catalog(), {})
+        self.store.write(self.df, 'cpsm2009-01')
+        self.store.write(self.df.iloc[:2, :2], 'cpsm2009-02')
+        result = self.store.catalog()
+        self.assertEqual(sorted(result), ['cpsm2009-01', 'cpsm2009-02'])
+        self.assertEqual(result['cpsm2009-01'],
+                         {'columns': ['HRMIS', 'PRTAGE', 'PESEX'],
+                          'dtypes': ['int64', 'int64', 'int64'],
+                          'rows': 4})
+        self.assertEqual(result['cpsm2009-02']['columns'],
+                         ['HRMIS', 'PRTAGE'])
+        self.assertEqual(result['cpsm2009-02']['rows'], 2)
+        self.assertEqual(self.store.describe('cpsm2009-02'),
+                         result['cpsm2009-02'])
+
+    def test_writer(self):
+        self.df['NAME'] = ['a', np.nan, 'bb', 'c']
+        with self.store.writer('cpsm2009-01', widths={'NAME': 2}) as append:
+            append(self.df.iloc[:3])
+            append(self.df.iloc[3:])
+        result = self.store.read('cpsm2009-01')
+        tm.assert_frame_equal(result.sort_index(), self.df.sort_index())
+        self.assertEqual(self.store.describe('cpsm2009-01')['rows'], 4)
+        result = self.store.read_rotation_group('cpsm2009-01', 1)
+        self.assertEqual(sorted(result['PRTAGE']), [24, 81])
+
+    def test_writer_fails(self):
+        self.store.write(self.df.iloc[:1], 'cpsm2009-01')
+        with self.assertRaises(ZeroDivisionError):
+            with self.store.writer('cpsm2009-01') as append:
+                append(self.df)
+                1 / 0
+        # never half written: either gone, or what was there before
+        if self.store.keys():
+            tm.assert_frame_equal(self.store.read('cpsm2009-01'),
+                                  self.df.iloc[:1])
+
+    def test_nbytes(self):
+        self.df['NAME'] = ['a', 'b', 'c', 'd']
+        self.store.write(self.df, 'cpsm2009-01')
+        self.store.write(self.df.iloc[:1], 'cpsm2009-02')
+        self.assertGreater(self.store.nbytes('cpsm2009-01'), 0)
+        self.assertGreater(self.store.nbytes('cpsm2009-01'),
+                           self.store.nbytes('cpsm2009-02'))
+        with self.assertRaises(KeyError):
+            self.store.nbytes('cpsm2009-03')
+
+    def test_stamp(self):
+        with self.assertRaises(KeyError):
+            self.store.stamp('cpsm2009-01')
+        self.store.write(self.df, 'cpsm2009-01')
+        stamp = self.store.stamp('cpsm2009-01')
+        self.assertEqual(self.store.stamp('cpsm2009-01'), stamp)
+        self.store.write(self.df.iloc[:1], 'cpsm2009-01')
+        self.assertNotEqual(self.store.stamp('cpsm2009-01'), stamp)
+
+    def test_read_subset(self):
+        self.store.write(self.df, 'cpsm2009-01')
+        result = self.store.read('cpsm2009-01', columns=['PRTAGE'], mis=1)
+        expected = self.df.loc[self.df.HRMIS == 1, ['PRTAGE']]
+        tm.assert_frame_equal(result.sort_index(), expected)
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            self.store.read('cpsm2009-01')
+        with self.assertRaises(KeyError):
+            self.store.columns('cpsm2009-01')
+
+    def test_read_rotation_group(self):
+        self.store.write(self.df, 'cpsm2009-01')
+        result = self.store.read_rotation_group('cpsm2009-01', 1)
+        expected = self.df[self.df.HRMIS == 1]
+        tm.assert_frame_equal(result.sort_index(), expected)
+
+        result = self.store.read_rotation_group('cpsm2009-01', [5, 8],
+                                                columns=['PESEX'])
+        expected = self.df.loc[self.df.HRMIS.isin([5, 8]), ['PESEX']]
+        tm.assert_frame_equal(result.sort_index(), expected)
+
+        result = self.store.read_rotation_group('cpsm2009-01', 2)
+        self.assertEqual(len(result), 0)
+        self.assertEqual(list(result.columns), list(self.df.columns))
+
+    def test_unindexed(self):
+        dd = pd.DataFrame({'id': ['HRHHID', 'HRMIS'], 'length': [15, 2]})
+        self.store.write(dd, 'cpsm2009-01')
+        tm.assert_frame_equal(self.store.read('cpsm2009-01'), dd)
+
+
+class TestHDFStorageByMIS(Base, unittest.TestCase):
+
+    def setUp(self):
+        _skip_if_no_tables()
+        super(TestHDFStorageByMIS, self).setUp()
+        self.path = os.path.join(self.tmpdir, 'store.hdf')
+        self.store = get_storage(self.path, by_mis=True)
+
+    def test_unindexed(self):
+        # data dictionaries have no HRMIS to split on
+        pass
+
+    def test_layout(self):
+        self.store.write(self.df, 'cpsm2009-01')
+        with pd.HDFStore(self.path) as store:
+            keys = store.keys()
+        self.assertEqual(sorted(keys), ['/cpsm2009-01/mis{}'.format(i)
+                                        for i in range(1, 9)])
+        result = pd.read_hdf(self.path, 'cpsm2009-01/mis5')
+        tm.assert_frame_equal(result, self.df[self.df.HRMIS == 5])
+
+    def test_invalid_mis(self):
+        df = self.df.copy()
+        df['HRMIS'] = [1, 9, np.nan, 8]
+        self.store.write(df, 'cpsm2009-01')
+        tm.assert_frame_equal(self.store.read('cpsm2009-01').sort_index(),
+                              df.sort_index())
+        self.assertEqual(self.store.describe('cpsm2009-01')['rows'], 4)
+        self.assertEqual(len(self.store.read('cpsm2009-01', mis=[1, 8])), 2)
+
+        with self.store.writer('cpsm2009-02') as append:
+            append(df.iloc[:2])
+            append(df.iloc[2:])
+        tm.assert_frame_equal(self.store.read('cpsm2009-02').sort_index(),
+                              df.sort_index())
+        self.assertEqual(sorted(self.store.keys()),
+                         ['cpsm2009-01', 'cpsm2009-02'])
+
+    def test_change_layout(self):
+        flat = get_storage(self.path)
+        flat.write(self.df, 'cpsm2009-01')
+        self.store.write(self.df, 'cpsm2009-01')
+        self.assertEqual(flat.keys(), ['cpsm2009-01'])
+        flat.write(self.df, 'cpsm2009-01')
+        tm.assert_frame_equal(self.store.read('cpsm2009-01'), self.df)
+
+
+class TestHDFStorage(Base, unittest.TestCase):
+
+    def setUp(self):
+        _skip_if_no_tables()
+        super(TestHDFStorage, self).setUp()
+        self.store = get_storage(os.path.join(self.tmpdir, 'store.hdf'))
+        self.assertIsInstance(self.store, HDFStorage)
+
+
+    def test_read_table_where(self):
+        with self.store.writer('cpsm2009-01') as append:
+            append(self.df)
+        selects = []
+        select = pd.HDFStore.select
+
+        def recording(store, key, where=None, **kwargs):
+            selects.append(where)
+            return select(store, key, where=where, **kwargs)
+
+        with mock.patch.object(pd.HDFStore, 'select', recording):
+            result = self.store.read('cpsm2009-01', mis=[1, 8])
+        tm.assert_frame_equal(result, self.df[self.df.HRMIS != 5])
+        # filtered by PyTables, not after reading the whole month
+        self.assertEqual(selects, ['HRMIS in [1, 8]'])
+
+    def test_catalog_unrecorded(self):
+        # written by something other than HDFStorage
+        self.df.to_hdf(self.store.path, 'cpsm2009-01', format='f')
+        self.assertEqual(self.store.describe('cpsm2009-01')['rows'], 4)
+        self.assertEqual(self.store.columns('cpsm2009-01'),
+                         ['HRMIS', 'PRTAGE', 'PESEX'])
+
+    def test_catalog_backfilled(self):
+        self.df.to_hdf(self.store.path, 'cpsm2009-01', format='f')
+        expected = self.store.catalog()
+
+        # the entry is recorded, so the data isn't read again
+        with pd.HDFStore(self.store.path, mode='r') as store:
+            attrs = store.get_node('cpsm2009-01')._v_attrs
+            entry = json.loads(getattr(attrs, CATALOG_ATTR))
+        self.assertEqual(entry, expected['cpsm2009-01'])
+        self.assertEqual(self.store.catalog(), expected)
+
+
+class TestParquetStorage(Base, unittest.TestCase):
+
+    def setUp(self):
+        _skip_if_no_pyarrow()
+        super(TestParquetStorage, self).setUp()
+        self.store = get_storage(os.path.join(self.tmpdir, 'store'),
+                                 kind='parquet')
+        self.assertIsInstance(self.store, ParquetStorage)
+
+    def test_layout(self):
+        self.store.write(self.df, 'cpsm2009-01')
+        path = os.path.join(self.tmpdir, 'store', 'year=2009', 'month=01',
+                            'cpsm2009-01.parquet')
+        self.assertTrue(os.path.exists(path))
+
+    def test_bad_key(self):
+        with self.assertRaises(ValueError):
+            self.store.write(self.df, 'm2009_01')
+
+    def test_mis_pushdown(self):
+        import pyarrow.parquet as pq
+
+        self.store.row_group_size = 1
+        self.store.write(self.df, 'cpsm2009-01')
+        path = self.store._path('cpsm2009-01')
+        # sorted by HRMIS, so each row group has a single value
+        meta = pq.ParquetFile(str(path)).metadata
+        mis = [meta.row_group(i).column(0).statistics.min
+               for i in range(meta.num_row_groups)]
+        self.assertEqual(mis, [1, 1, 5, 8])
+
+
+class TestGetStorage(unittest.TestCase):
+
+    def test_other(self):
+        with self.assertRaises(ValueError):
+            get_storage('foo', kind='csv')
+
+
+class TestCompactDtypes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.abspath('_teststorage_')
+        os.mkdir(self.tmpdir)
+        self.df = pd.DataFrame({'A': pd.array([1, None], dtype='Int8'),
+                                'B': pd.Categorical(['a', np.nan]),
+                                'C': np.array([1, 2], dtype=np.int8)},
+                               columns=['A', 'B', 'C'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hdf(self):
+        _skip_if_no_tables()
+        store = get_storage(os.path.join(self.tmpdir, 'store.hdf'))
+        store.write(self.df, 'cpsm2009-01')
+        result = store.read('cpsm2009-01')
+        expected = pd.DataFrame({'A': np.array([1, np.nan], dtype=np.float32),
+                                 'B': ['a', np.nan],
+                                 'C': np.array([1, 2], dtype=np.int8)},
+                                columns=['A', 'B', 'C'])
+        tm.assert_frame_equal(result, expected)
+
+    def test_parquet(self):
+        _skip_if_no_pyarrow()
+        store = get_storage(os.path.join(self.tmpdir, 'store'), 'parquet')
+        store.write(self.df, 'cpsm2009-01')
+        tm.assert_frame_equal(store.read('cpsm2009-01'), self.df)
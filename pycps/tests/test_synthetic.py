@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import logging
+import zipfile
+import unittest
+
+import pandas as pd
+
+import pycps.parsers as p
+import pycps.synthetic as s
+from pycps import merge as m
+from pycps import monthly_data_fixups as mdf
+
+logging.disable(logging.CRITICAL)
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.abspath('_testsynthetic_')
+        os.mkdir(self.tmpdir)
+        # with a gap at 29-30 and a field no one knows about
+        self.dd = pd.DataFrame([['HRHHID', 15, 1, 15],
+                                ['HRHHID2', 5, 16, 20],
+                                ['PULINENO', 2, 21, 22],
+                                ['HRMIS', 1, 23, 23],
+                                ['HRYEAR4', 4, 24, 27],
+                                ['HRMONTH', 2, 28, 29],
+                                ['PRTAGE', 2, 32, 33],
+                                ['PESEX', 2, 34, 35],
+                                ['PTDTRACE', 2, 36, 37],
+                                ['PEMLR', 2, 38, 39]],
+                               columns=['id', 'length', 'start', 'end'])
+        self.path = os.path.join(self.tmpdir, 'cpsm2009-01.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, month, **kwargs):
+        path = os.path.join(self.tmpdir, month + '.zip')
+        s.write_month(path, self.dd, month, 80, **kwargs)
+        return p.read_monthly(path, self.dd).set_index(m.PERSON_COLS)
+
+    def test_write_month(self):
+        n = s.write_month(self.path, self.dd, '2009-01', 80)
+        with zipfile.ZipFile(self.path) as archive:
+            self.assertEqual(archive.namelist(), ['jan09pub.dat'])
+        df = p.read_monthly(self.path, self.dd)
+        self.assertEqual(len(df), n)
+        self.assertEqual(sorted(df.HRMIS.unique()), list(range(1, 9)))
+        self.assertTrue((df.HRYEAR4 == 2009).all())
+        self.assertTrue((df.HRMONTH == 1).all())
+        self.assertTrue(df.PRTAGE.between(0, 90).all())
+        self.assertTrue(df.PESEX.isin([1, 2]).all())
+        self.assertFalse(df.set_index(m.PERSON_COLS).index.has_duplicates)
+
+    def test_chunksize(self):
+        s.write_month(self.path, self.dd, '2009-01', 80, chunksize=3)
+        expected = p.read_monthly(self.path, self.dd)
+        s.write_month(self.path, self.dd, '2009-01', 80)
+        result = p.read_monthly(self.path, self.dd)
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_rotation(self):
+        # the second rotation group in February is January's first
+        jan = self._read('2009-01', nonresponse=0, miscoded=0)
+        feb = self._read('2009-02', nonresponse=0, miscoded=0)
+        left, right = jan[jan.HRMIS == 1], feb[feb.HRMIS == 2]
+        cols = ['PRTAGE', 'PESEX', 'PTDTRACE']
+        pd.testing.assert_frame_equal(right[cols], left[cols])
+        self.assertEqual(len(m.join_match(left, right, m.MATCH_PREDICATES)),
+                         len(left))
+
+        # the fifth a year later
+        jan10 = self._read('2010-01', nonresponse=0, miscoded=0)
+        pd.testing.assert_frame_equal(jan10.loc[jan10.HRMIS == 5, cols],
+                                      left[cols])
+
+    def test_nonresponse(self):
+        jan = self._read('2009-01', nonresponse=0.5, miscoded=0.5)
+        feb = self._read('2009-02', nonresponse=0.5, miscoded=0.5)
+        left, right = jan[jan.HRMIS == 1], feb[feb.HRMIS == 2]
+        matched = m.join_match(left, right, m.MATCH_PREDICATES)
+        self.assertGreater(len(matched), 0)
+        self.assertLess(len(matched), len(left))
+
+    def test_old_household_ids(self):
+        # before 2004-05 HRHHID2 is made from these
+        old = pd.DataFrame([['HRHHID', 15, 1, 15],
+                            ['HRSAMPLE', 4, 16, 19],
+                            ['HRSERSUF', 2, 20, 21],
+                            ['HUHHNUM', 1, 22, 22],
+                            ['PULINENO', 2, 23, 24],
+                            ['HRMIS', 2, 25, 26],
+                            ['HRYEAR4', 2, 27, 28]],
+                           columns=['id', 'length', 'start', 'end'])
+        s.write_month(self.path, self.dd, '1998-01', 80)
+        expected = p.read_monthly(self.path, self.dd)
+        s.write_month(self.path, old, '1998-01', 80)
+        result = mdf.compute_hrhhid2(p.read_monthly(self.path, old))
+        self.assertEqual(result.HRHHID2.tolist(), expected.HRHHID2.tolist())
+        self.assertTrue((result.HRYEAR4 == 98).all())
+
+    def test_write_months(self):
+        months = pd.period_range('2009-01', periods=3, freq='M')
+        paths = s.write_months(os.path.join(self.tmpdir, 'monthly'),
+                               self.dd, months, 16)
+        self.assertEqual([x.name for x in paths],
+                         ['cpsm2009-01.zip', 'cpsm2009-02.zip',
+                          'cpsm2009-03.zip'])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import logging
+import unittest
+
+from pycps import parsers as p
+from pycps.telemetry import Telemetry, measure, make_record, note_transform
+
+logging.disable(logging.CRITICAL)
+
+
+class TestMeasure(unittest.TestCase):
+
+    def test_measure(self):
+        with measure('parse', 'cpsm2009-01', cache='miss') as record:
+            record['records'] = 10
+        self.assertEqual(record['stage'], 'parse')
+        self.assertEqual(record['item'], 'cpsm2009-01')
+        self.assertEqual(record['records'], 10)
+        self.assertEqual(record['pid'], os.getpid())
+        self.assertGreaterEqual(record['wall_seconds'], 0)
+        self.assertGreaterEqual(record['cpu_seconds'], 0)
+        self.assertIsNone(record['bytes_read'])
+        self.assertTrue(record['time'].endswith('Z'))
+
+    def test_transforms(self):
+        @p.log_transform('a frame')
+        def double(x):
+            return x * 2
+
+        with measure('parse') as outer:
+            double(1)
+            with measure('parse') as inner:
+                double(1)
+                double(1)
+        self.assertEqual(list(outer['transforms']), ['double'])
+        self.assertEqual(list(inner['transforms']), ['double'])
+
+        # nothing to add to
+        note_transform('double', 1.0)
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = os.path.abspath('_testtelemetry_')
+        os.mkdir(self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'telemetry.jsonl')
+        self.prom = os.path.join(self.tmpdir, 'telemetry.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_stage(self):
+        telemetry = Telemetry(self.path, self.prom)
+        with telemetry.stage('parse', kind='data'):
+            telemetry.emit(make_record('parse', 'cpsm2009-01', cache='hit'))
+            telemetry.emit(make_record('parse', 'cpsm2009-02', cache='miss',
+                                       records=5, bytes_read=100,
+                                       transforms={'f': 1.5}))
+        records = self._read()
+        self.assertEqual([x['item'] for x in records],
+                         ['cpsm2009-01', 'cpsm2009-02', None])
+        stage = records[-1]
+        self.assertEqual(stage['records'], 5)
+        self.assertEqual(stage['bytes_read'], 100)
+        self.assertEqual(stage['bytes_written'], 0)
+        self.assertEqual((stage['hits'], stage['misses']), (1, 1))
+        self.assertEqual(stage['transforms'], {'f': 1.5})
+
+        with telemetry.stage('merge'):
+            pass
+        with open(self.prom) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# TYPE pycps_stage_records gauge', lines)
+        self.assertIn('pycps_stage_records{stage="parse",kind="data"} 5',
+                      lines)
+        self.assertIn('pycps_stage_records{stage="merge"} 0', lines)
+        self.assertFalse(os.path.exists(self.prom + '.part'))
+
+    def test_no_path(self):
+        telemetry = Telemetry()
+        with telemetry.stage('parse') as record:
+            telemetry.emit(make_record('parse', 'cpsm2009-01', records=1))
+        self.assertEqual(record['records'], 1)
+        self.assertEqual(os.listdir(self.tmpdir), [])
@@ -54,30 +54,34 @@ setup(
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.1',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7'
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
+    # zipfile's compresslevel, concurrent.futures, int.from_bytes
+    python_requires='>=3.7',
 
     # What does your project relate to?
     keywords='pycps, cps',
 
     # Don't directly use numexpr or Cython but PyTables depends on them
     # and I think they messed up their setup.py file.
+    # pandas 1.0 for pd.NA backed nullable integers and
+    # hash_pandas_object; numpy 1.13.3 is the least it supports.
     install_requires = ['arrow>=0.4.0',
                         'requests>=2.4.0',
-                        'pathlib>=1.0.1',
                         'lxml>=3.3.5',
-                        'numpy>=1.8.0',
-                        'pandas>=0.14.1'],
+                        'numpy>=1.13.3',
+                        'pandas>=1.0.0'],
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages.
     packages=find_packages(exclude=["contrib", "docs", "tests*"]),
     # If there are data files included in your packages, specify them here.
     package_data={
-        'pycps': ['data.json', 'settings.json', 'logging.json',
+        'pycps': ['data.json', 'info.json', 'settings.json', 'logging.json',
                   'cpsm2014-01.ddf'],
     },
 